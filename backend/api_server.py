@@ -0,0 +1,450 @@
+# -----------------------------------------------
+# api_server.py  ——  asyncio HTTP API in front of backend_main
+# -----------------------------------------------
+"""
+Several front-ends can share one warm backend (and one WebUI) through this
+server instead of each spawning its own worker. Standard library only.
+
+Routes
+    GET    /healthz                      liveness + queue / back-end status
+    POST   /generate                     prompt → images   (generate_image_from_prompt)
+    POST   /chat                         description → images (chat → image job)
+    POST   /prompt                       description → {tags, prompt} (chat_generate_prompt)
+    GET    /jobs/<id>?cursor=N&wait=S    long-poll job events
+    GET    /jobs/<id>/events             server-sent events until the job ends
+    DELETE /jobs/<id>                    cancel
+    GET    /outputs/<file>               static files (ETag, Range)
+    GET    /logs?limit=N                 tail of backend.log
+
+/generate and /chat wait for the result by default; send "wait": false to
+get 202 + job id and follow /jobs/<id>. A waited-for job answers 200 when it
+completes, 409 if it was cancelled (DELETE /jobs/<id>) and 500 if it failed.
+When a queue is full the server answers 429 with Retry-After instead of
+queueing without bound.
+A /chat (or /prompt with "model") aimed at the local back-end warms the
+WebUI and checkpoint while the LLM runs; the warm-up is cancelled if the
+job is cancelled or the /prompt client disconnects.
+
+Usage:
+    python api_server.py [--host 127.0.0.1] [--port 8000]
+"""
+
+import os, sys, json, asyncio, hashlib, mimetypes, time, threading
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs, unquote
+
+PROJ_ROOT = Path(__file__).resolve().parents[1]
+
+# postprocess pool children re-run this file as __mp_main__ (spawn); they
+# must not change directory or load the whole backend
+_IS_SERVER = __name__ != "__mp_main__"
+if _IS_SERVER:
+    os.chdir(PROJ_ROOT.as_posix())                # outputs/ etc. relative to the project root, as in the worker
+    import backend_main, singleflight, local_scheduler
+    from backend_main import submit_chat_job, submit_prompt_job, get_job, chat_generate_prompt
+
+OUTPUTS = Path(os.getenv("API_OUTPUTS_DIR", PROJ_ROOT / "outputs")).resolve()
+LOG_PATH = PROJ_ROOT / "backend.log"
+MAX_QUEUE = {"generate": int(os.getenv("API_MAX_GENERATE_QUEUE", "16")),
+             "chat": int(os.getenv("API_MAX_CHAT_QUEUE", "16")),
+             "prompt": int(os.getenv("API_MAX_PROMPT_QUEUE", "8"))}
+MAX_BODY = 1024 * 1024
+SSE_HEARTBEAT_S = 15
+_CHUNK = 64 * 1024
+_REASONS = {200: "OK", 202: "Accepted", 204: "No Content", 206: "Partial Content",
+            304: "Not Modified", 400: "Bad Request", 404: "Not Found",
+            405: "Method Not Allowed", 409: "Conflict", 413: "Payload Too Large", 416: "Range Not Satisfiable",
+            429: "Too Many Requests", 500: "Internal Server Error"}
+_GEN_FIELDS = ("size", "model", "n", "negative_prompt", "preset", "sd_params", "prefetch",
+               "max_latency_s", "max_cost", "deadline_s", "priority")
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str, headers: dict | None = None):
+        super().__init__(message)
+        self.status, self.headers = status, headers or {}
+
+def _num(value, name: str, cast=int):
+    """int() / float() of a client-supplied value; malformed → 400, not 500."""
+    try:
+        x = cast(value)
+    except (TypeError, ValueError):
+        raise HttpError(400, f"{name} must be a number") from None
+    if x != x or x in (float("inf"), float("-inf")):
+        raise HttpError(400, f"{name} must be finite")
+    return x
+
+# ---------- job bookkeeping (thread → event loop bridge) ----------
+_loop: asyncio.AbstractEventLoop | None = None
+_wakeups: dict[str, asyncio.Event] = {}
+_inflight = {k: 0 for k in MAX_QUEUE}
+
+def _on_job_event(job, stage, status):
+    """Pipeline listener (worker thread): wake coroutines following this job."""
+    if _loop is not None:
+        _loop.call_soon_threadsafe(_wake, job.id)
+
+def _wake(job_id: str):
+    ev = _wakeups.pop(job_id, None)
+    if ev is not None:
+        ev.set()
+
+async def _next_change(job_id: str, timeout: float) -> None:
+    ev = _wakeups.setdefault(job_id, asyncio.Event())
+    try:
+        await asyncio.wait_for(ev.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+def _admit(kind: str):
+    if _inflight[kind] >= MAX_QUEUE[kind]:
+        raise HttpError(429, f"{kind} queue is full ({MAX_QUEUE[kind]} jobs)",
+                        {"Retry-After": "5"})
+    _inflight[kind] += 1
+
+def _release(kind: str):
+    _inflight[kind] = max(0, _inflight[kind] - 1)
+
+def _public_result(result):
+    """[{"url", "path"}]: cloud URLs as-is, local files as /outputs/... URLs."""
+    def url_for(p):
+        try:
+            rel = Path(p).resolve().relative_to(OUTPUTS)
+        except (ValueError, OSError, TypeError):
+            return None
+        return "/outputs/" + rel.as_posix()
+    if not isinstance(result, list):
+        return result
+    out = []
+    for r in result:
+        url, path = (r.get("url"), r.get("path")) if isinstance(r, dict) else (None, r)
+        if isinstance(path, str) and path.startswith("http"):
+            url, path = path, None
+        out.append({"url": url or (url_for(path) if path else None), "path": path})
+    return out
+
+def _job_view(job, cursor: int = 0) -> dict:
+    events = job.events_since(cursor)
+    return {"job_id": job.id, "status": job.status, "done": job.done,
+            "events": events, "cursor": cursor + len(events),
+            "result": _public_result(job.result), "error": job.error}
+
+async def _track(kind: str, job):
+    """Release the queue slot once the job ends."""
+    try:
+        while not job.done:
+            await _next_change(job.id, 30)
+    finally:
+        _release(kind)
+
+# ---------- HTTP plumbing ----------
+class Request:
+    def __init__(self, method, target, headers, body, reader=None):
+        parts = urlsplit(target)
+        self.method = method
+        self.path = unquote(parts.path)
+        self.query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        self.headers = headers
+        self.body = body
+        self.reader = reader                # to notice a client that hangs up mid-request
+
+    def json(self) -> dict:
+        if not self.body:
+            return {}
+        try:
+            data = json.loads(self.body)
+        except ValueError:
+            raise HttpError(400, "body is not valid JSON")
+        if not isinstance(data, dict):
+            raise HttpError(400, "body must be a JSON object")
+        return data
+
+async def _read_request(reader) -> Request | None:
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    except asyncio.LimitOverrunError:
+        raise HttpError(413, "headers too large")
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, _ = lines[0].split(" ", 2)
+    except ValueError:
+        raise HttpError(400, "bad request line")
+    headers = {}
+    for ln in lines[1:]:
+        if ":" in ln:
+            k, v = ln.split(":", 1)
+            headers[k.strip().lower()] = v.strip()
+    length = _num(headers.get("content-length") or 0, "Content-Length")
+    if length < 0:
+        raise HttpError(400, "bad Content-Length")
+    if length > MAX_BODY:
+        raise HttpError(413, "body too large")
+    body = await reader.readexactly(length) if length else b""
+    return Request(method.upper(), target, headers, body, reader)
+
+async def _send(writer, status: int, body: bytes = b"", headers: dict | None = None,
+                ctype: str = "application/json"):
+    h = {"Content-Type": ctype, "Content-Length": str(len(body)), **(headers or {})}
+    head = f"HTTP/1.1 {status} {_REASONS.get(status, 'OK')}\r\n" + \
+        "".join(f"{k}: {v}\r\n" for k, v in h.items()) + "\r\n"
+    writer.write(head.encode("latin-1") + body)
+    await writer.drain()
+
+async def _send_json(writer, status: int, obj, headers: dict | None = None):
+    await _send(writer, status, json.dumps(obj, ensure_ascii=False, default=str).encode(),
+                headers)
+
+# ---------- handlers ----------
+async def h_health(req, writer):
+    await _send_json(writer, 200, {"status": "ok", "queues": {
+        k: {"inflight": _inflight[k], "max": MAX_QUEUE[k]} for k in MAX_QUEUE},
+        "stages": backend_main.pipeline.depth(),
+        "coalescing": {**singleflight.stats, "in_flight": singleflight.in_flight()},
+        "local_queue": local_scheduler.status(),
+        "backends": backend_main.router.status()})
+
+def _gen_kwargs(body: dict) -> dict:
+    kw = {k: body[k] for k in _GEN_FIELDS if k in body}
+    if "sd_overrides" in body and "sd_params" not in kw:       # test_client naming
+        kw["sd_params"] = body["sd_overrides"]
+    return kw
+
+async def _submit_and_answer(kind: str, body: dict, writer, submit):
+    _admit(kind)
+    try:
+        job = submit()
+    except ValueError as e:
+        _release(kind)
+        raise HttpError(400, str(e))
+    except Exception:
+        _release(kind)
+        raise
+    asyncio.ensure_future(_track(kind, job))
+    if body.get("wait", True) is False:
+        await _send_json(writer, 202, {"job_id": job.id, "status": job.status,
+                                       "poll": f"/jobs/{job.id}",
+                                       "events": f"/jobs/{job.id}/events"},
+                         {"Location": f"/jobs/{job.id}"})
+        return
+    while not job.done:
+        await _next_change(job.id, 30)
+    view = _job_view(job)
+    status = {"completed": 200, "cancelled": 409}.get(job.status, 500)
+    await _send_json(writer, status, {k: view[k] for k in
+                                      ("job_id", "status", "result", "error")})
+
+async def h_generate(req, writer):
+    body = req.json()
+    prompt = (body.get("prompt") or "").strip()
+    if not prompt:
+        raise HttpError(400, "prompt is required")
+    kw = _gen_kwargs(body)
+    await _submit_and_answer("generate", body, writer,
+                             lambda: submit_prompt_job(prompt, **kw))
+
+async def h_chat(req, writer):
+    body = req.json()
+    text = (body.get("user_input") or body.get("text") or "").strip()
+    if not text:
+        raise HttpError(400, "user_input is required")
+    kw = _gen_kwargs(body)
+    provider = body.get("provider", "auto")
+    await _submit_and_answer("chat", body, writer,
+                             lambda: submit_chat_job(text, provider, **kw))
+
+async def h_prompt(req, writer):
+    body = req.json()
+    text = (body.get("user_input") or body.get("text") or "").strip()
+    if not text:
+        raise HttpError(400, "user_input is required")
+    _admit("prompt")
+    hooks, abandoned = [], threading.Event()
+
+    def on_cancel(fn):                      # executor thread: chat_generate_prompt's warm-up
+        hooks.append(fn)
+        if abandoned.is_set():
+            fn()
+
+    try:
+        fut = asyncio.get_running_loop().run_in_executor(
+            None, lambda: chat_generate_prompt(text, body.get("provider", "auto"),
+                                               body.get("model"), on_cancel=on_cancel))
+        while not fut.done():
+            await asyncio.wait({fut}, timeout=0.5)
+            if not fut.done() and req.reader is not None and req.reader.at_eof():
+                raise ConnectionError("client disconnected")   # _serve_conn closes
+        data = fut.result()
+    except (asyncio.CancelledError, ConnectionError):
+        # nobody will read the prompt: stop the speculative WebUI start / checkpoint load
+        abandoned.set()
+        for fn in list(hooks):
+            fn()
+        raise
+    finally:
+        _release("prompt")
+    await _send_json(writer, 200, data)
+
+def _find_job(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise HttpError(404, f"unknown job {job_id}")
+    return job
+
+async def h_job(req, writer, job_id):
+    job = _find_job(job_id)
+    if req.method == "DELETE":
+        job.cancel()
+        await _send_json(writer, 202, {"job_id": job.id, "cancelled": True})
+        return
+    cursor = max(0, _num(req.query.get("cursor", 0), "cursor"))
+    wait = min(_num(req.query.get("wait", 0), "wait", float), 60.0)
+    deadline = time.monotonic() + wait
+    while not job.done and len(job.events_since(cursor)) == 0 and time.monotonic() < deadline:
+        await _next_change(job.id, deadline - time.monotonic())
+    await _send_json(writer, 200, _job_view(job, cursor))
+
+async def h_job_events(req, writer, job_id):
+    job = _find_job(job_id)
+    cursor = max(0, _num(req.headers.get("last-event-id", -1), "Last-Event-ID") + 1)
+    head = ("HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+            "Cache-Control: no-cache\r\nConnection: close\r\n\r\n")
+    writer.write(head.encode())
+    await writer.drain()
+    while True:
+        for ev in job.events_since(cursor):
+            if ev["status"] == "completed":
+                ev = {**ev, "result": _public_result(ev.get("result"))}
+            writer.write(f"id: {ev['seq']}\nevent: {ev['stage']}\n"
+                         f"data: {json.dumps(ev, ensure_ascii=False, default=str)}\n\n".encode())
+            cursor = ev["seq"] + 1
+        await writer.drain()
+        if job.done and not job.events_since(cursor):
+            break
+        before = cursor
+        await _next_change(job.id, SSE_HEARTBEAT_S)
+        if not job.events_since(before):
+            writer.write(b": ping\n\n")
+    writer.close()
+
+async def h_outputs(req, writer, rel):
+    path = (OUTPUTS / rel).resolve()
+    if OUTPUTS not in path.parents or not path.is_file():
+        raise HttpError(404, "not found")
+    st = path.stat()
+    etag = '"' + hashlib.sha1(f"{st.st_size}-{st.st_mtime_ns}".encode()).hexdigest()[:16] + '"'
+    base = {"ETag": etag, "Accept-Ranges": "bytes", "Cache-Control": "public, max-age=3600",
+            "Content-Type": mimetypes.guess_type(path.name)[0] or "application/octet-stream"}
+    if req.headers.get("if-none-match") == etag:
+        await _send(writer, 304, headers={k: base[k] for k in ("ETag", "Cache-Control")},
+                    ctype=base["Content-Type"])
+        return
+    start, end, status = 0, st.st_size - 1, 200
+    rng = req.headers.get("range", "")
+    if rng.startswith("bytes=") and "," not in rng:
+        a, _, b = rng[6:].partition("-")
+        try:
+            if a:
+                start, end = int(a), min(int(b) if b else end, end)
+            else:                                   # suffix range: last N bytes
+                start = max(0, st.st_size - int(b))
+        except ValueError:
+            start = -1
+        if start < 0 or start > end:
+            await _send(writer, 416, headers={"Content-Range": f"bytes */{st.st_size}"})
+            return
+        status = 206
+        base["Content-Range"] = f"bytes {start}-{end}/{st.st_size}"
+    length = end - start + 1
+    head = f"HTTP/1.1 {status} {_REASONS[status]}\r\n" + "".join(
+        f"{k}: {v}\r\n" for k, v in {**base, "Content-Length": str(length)}.items()) + "\r\n"
+    writer.write(head.encode("latin-1"))
+    if req.method == "HEAD":
+        await writer.drain()
+        return
+    with open(path, "rb") as f:
+        f.seek(start)
+        left = length
+        while left > 0:
+            chunk = f.read(min(_CHUNK, left))
+            if not chunk:
+                break
+            writer.write(chunk)
+            left -= len(chunk)
+            await writer.drain()
+
+async def h_logs(req, writer):
+    limit = max(1, min(_num(req.query.get("limit", 200), "limit"), 5000))
+    try:
+        lines = LOG_PATH.read_text(encoding="utf-8", errors="replace").splitlines()[-limit:]
+    except OSError:
+        lines = []
+    await _send_json(writer, 200, {"lines": lines})
+
+async def _route(req: Request, writer):
+    p, m = req.path.rstrip("/") or "/", req.method
+    if p == "/healthz" and m == "GET":
+        return await h_health(req, writer)
+    if p == "/generate" and m == "POST":
+        return await h_generate(req, writer)
+    if p == "/chat" and m == "POST":
+        return await h_chat(req, writer)
+    if p == "/prompt" and m == "POST":
+        return await h_prompt(req, writer)
+    if p == "/logs" and m == "GET":
+        return await h_logs(req, writer)
+    if p.startswith("/outputs/") and m in ("GET", "HEAD"):
+        return await h_outputs(req, writer, p[len("/outputs/"):])
+    if p.startswith("/jobs/"):
+        rest = p[len("/jobs/"):]
+        if rest.endswith("/events") and m == "GET":
+            return await h_job_events(req, writer, rest[:-len("/events")])
+        if "/" not in rest and m in ("GET", "DELETE"):
+            return await h_job(req, writer, rest)
+    raise HttpError(404 if m in ("GET", "POST", "DELETE", "HEAD") else 405, "no such route")
+
+async def _serve_conn(reader, writer):
+    try:
+        while True:
+            req = None
+            try:
+                req = await _read_request(reader)
+                if req is None:
+                    break
+                await _route(req, writer)
+            except HttpError as e:
+                await _send_json(writer, e.status, {"error": str(e)}, e.headers)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                break
+            except Exception as e:
+                print(f"[api] {type(e).__name__}: {e}", file=sys.stderr)
+                await _send_json(writer, 500, {"error": "backend error", "detail": str(e)})
+            # req is None: the head was rejected and the body left unread, so
+            # the stream is out of sync; close
+            if writer.is_closing() or req is None or \
+                    req.headers.get("connection", "").lower() == "close":
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def serve(host: str = "127.0.0.1", port: int = 8000):
+    global _loop
+    _loop = asyncio.get_running_loop()
+    backend_main.pipeline.add_listener(_on_job_event)
+    server = await asyncio.start_server(_serve_conn, host, port, limit=64 * 1024)
+    print(f"🚀 Easy-Artistry API on http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default=os.getenv("API_HOST", "127.0.0.1"))
+    ap.add_argument("--port", type=int, default=int(os.getenv("API_PORT", "8000")))
+    a = ap.parse_args()
+    try:
+        asyncio.run(serve(a.host, a.port))
+    except KeyboardInterrupt:
+        pass
@@ -3,7 +3,9 @@
 backend_main.py   chat → prompt, local-server lifecycle, unified image generation
 """
 
-import os, sys, re, time, webbrowser
+import os, sys, re, time, json, uuid, random, threading, webbrowser
+from collections import OrderedDict
+from pathlib import Path
 from typing import List, Dict, Any, Optional
 
 # ---------- project modules ----------
@@ -11,21 +13,50 @@ from label import extract_tags, tags_to_prompt
 from model_lab import generate_image as sd_generate           # cloud Stable Diffusion
 from image import generate_image as dalle_generate            # DALL·E 3
 from local_sd import generate_image as local_sd_generate      # local A1111 txt2img
+from image_cache import prefetch as prefetch_images           # cloud URL → local file store
+from jobs import Pipeline, Job, SKIP                           # staged chat → image jobs
+from journal import JobJournal, TERMINAL                       # durable job log / crash resume
 
 # local server helpers
 from local_sd import start_server as _start_server
 from local_sd import shutdown_server as _shutdown_server
 from local_sd import _switch_model                            # checkpoint hot-swap
+from local_sd import _PRESETS as _LOCAL_PRESETS
+from local_sd import effective_params as _local_effective_params
+from local_sd import current_model as _current_local_model
+from local_sd import uses_tiles as _local_uses_tiles
+from local_sd import output_size as _local_output_size
+from local_sd import calibrate_threads as _calibrate_threads
+from local_sd import _server_running
+import singleflight                                           # coalesce duplicate in-flight renders
+import local_scheduler                                        # priority classes / preemption (local)
+import rate_limit
+from cost_model import model as cost_model                    # learned local render time
+from router import router, BadRequest                         # model="auto" back-end choice
+import tracing                                                # opt-in span tracing (EA_TRACE_SAMPLE)
 
 # ======================================================================
 # 1) chat → prompt
 # ======================================================================
 #DELL3 api DO NOT NEED TO CALL THIS FUNCTION,just call generate_image_from_prompt
-def chat_generate_prompt(user_input: str, provider: str) -> Dict[str, Any]:
+def chat_generate_prompt(user_input: str, provider: str,
+                         model: Optional[str] = None, on_cancel=None) -> Dict[str, Any]:
+    """`model`: back-end of the image request that will follow. A local one
+    starts warming the WebUI / checkpoint while the LLM runs (warm_up_local).
+    on_cancel(fn) arranges for fn() to run if the caller gives up (e.g. the
+    HTTP client disconnects); the warm-up is then cancelled."""
     user_input = user_input.strip()
     if not user_input:
         raise ValueError("user_input cannot be empty")
-    tags = extract_tags(user_input, provider)
+    warm = warm_up_local(model) if model else None
+    if warm and on_cancel is not None:
+        on_cancel(warm.cancel)
+    try:
+        tags = extract_tags(user_input, provider)
+    except BaseException:
+        if warm:
+            warm.cancel()
+        raise
     return {"tags": tags, "prompt": tags_to_prompt(tags)}
 
 # ======================================================================
@@ -33,28 +64,119 @@ def chat_generate_prompt(user_input: str, provider: str) -> Dict[str, Any]:
 # ======================================================================
 _local_up = False
 _default_checkpoint = "sd_xl_base_1.0.safetensors"
+# one start / switch / stop at a time: a render arriving while a warm-up
+# is loading waits for it instead of starting a second WebUI
+_server_lock = threading.RLock()
 
 def start_local_server(model_name: Optional[str] = None):
+    """Start the WebUI if needed and load `model_name`; None keeps the loaded
+    checkpoint (the default one only on a WebUI that has none)."""
     global _local_up
-    if not _local_up:
-        _start_server()
-        _local_up = True
-    _switch_model(model_name or _default_checkpoint)
+    with _server_lock:
+        if not _local_up:
+            _start_server(checkpoint=model_name)     # its calibrated thread count
+            _local_up = True
+        _switch_model(model_name or _current_local_model() or _default_checkpoint)
 
 def switch_local_model(model_name: str):
-    if not _local_up:
-        raise RuntimeError("Local server not running; call start_local_server() first.")
-    _switch_model(model_name)
+    with _server_lock:
+        if not _local_up:
+            raise RuntimeError("Local server not running; call start_local_server() first.")
+        _switch_model(model_name)
 
 def stop_local_server():
     global _local_up
-    if _local_up:
-        _shutdown_server()
-        _local_up = False
+    with _server_lock:
+        if _local_up:
+            _shutdown_server()
+            _local_up = False
+
+def calibrate_local_threads(checkpoint: Optional[str] = None, size: str = "512x512", **kw):
+    """
+    local_sd.calibrate_threads (restarts the WebUI per thread count) in an
+    interactive scheduler slot, so no render is in flight or preempts it, and
+    under the server lock, so warm-ups wait. _local_up follows the WebUI's
+    actual state afterwards, also if a restart failed.
+    """
+    def calibrate(ticket):
+        global _local_up
+        with _server_lock:
+            try:
+                return _calibrate_threads(checkpoint, size, **kw)
+            finally:
+                _local_up = _server_running()
+
+    return local_scheduler.run(calibrate, priority=rate_limit.PRIORITY_INTERACTIVE,
+                               label="calibrate_threads")
+
+class Warmup:
+    """
+    Speculative start_local_server(checkpoint) on a background thread, run
+    while the LLM turns the chat into a prompt; the render's own
+    start_local_server() then finds the WebUI up (or waits on the lock
+    for the warm-up instead of starting cold).
+
+    cancel() before the server lock is taken skips the warm-up; after a
+    cold start has begun it skips the checkpoint load (the started WebUI
+    stays up for the next request).
+    """
+
+    def __init__(self, checkpoint: Optional[str] = None):
+        self.checkpoint = checkpoint            # None: whatever start_local_server() keeps
+        self.error: Optional[BaseException] = None
+        self.done = threading.Event()
+        self._cancel = threading.Event()
+        threading.Thread(target=tracing.bind(self._run), name="sd-warmup", daemon=True).start()
+
+    def _run(self):
+        global _local_up
+        try:
+            with tracing.span("local_sd.warmup", checkpoint=self.checkpoint) as args, _server_lock:
+                if self._cancel.is_set():
+                    args["skipped"] = True
+                    return
+                if not _local_up:
+                    _start_server(checkpoint=self.checkpoint)
+                    _local_up = True
+                if self._cancel.is_set():
+                    args["skipped"] = "switch"
+                    return
+                _switch_model(self.checkpoint or _current_local_model() or _default_checkpoint)
+        except Exception as e:          # the render retries and reports the failure itself
+            self.error = e
+            print(f"[warmup] {type(e).__name__}: {e}")
+        finally:
+            self.done.set()
+
+    def cancel(self):
+        self._cancel.set()
+
+def warm_up_local(model: str, checkpoint: Optional[str] = None) -> Optional[Warmup]:
+    """Start a Warmup if `model` names the local back-end; None otherwise."""
+    if _BACKEND_ALIASES.get(model.lower().strip()) != "local":
+        return None
+    return Warmup(checkpoint)
 
 # ======================================================================
 # 3) unified image generation
 # ======================================================================
+_BACKEND_ALIASES = {
+    "stable-diffusion": "sd", "sd": "sd", "sdxl": "sd",
+    "dalle": "dalle", "dall-e": "dalle", "dalle3": "dalle",
+    "local_stable-diffusion": "local", "local": "local", "local_sd": "local",
+    "local_sdxl": "local",
+}
+
+def _work_units(size: str, n: int, preset: str, sd_params: Optional[Dict[str, Any]]) -> float:
+    """Megapixel-steps a local render needs (hires second pass included)."""
+    p = {**_LOCAL_PRESETS.get(preset.lower(), _LOCAL_PRESETS["balanced"]), **(sd_params or {})}
+    w, h = (int(v) for v in size.lower().split("x"))
+    mp = w * h / 1e6
+    work = mp * (p.get("steps") or 20)
+    if p.get("enable_hr"):
+        work += mp * float(p.get("hr_scale", 1.5)) ** 2 * (p.get("hr_second_pass_steps") or 12)
+    return work * max(1, n)
+
 def generate_image_from_prompt(
     prompt: str,
     *,
@@ -64,7 +186,12 @@ def generate_image_from_prompt(
     negative_prompt: str = "bad quality",
     preset: str = "balanced",
     sd_params: Optional[Dict[str, Any]] = None,
-) -> List[str]:
+    prefetch: bool = False,
+    max_latency_s: Optional[float] = None,
+    max_cost: Optional[float] = None,
+    deadline_s: Optional[float] = None,
+    priority: Optional[str] = None,
+) -> List[Any]:
     """
     ------------------------------------------------------------------------
     Universal image-generation entry for the front-end
@@ -86,6 +213,10 @@ def generate_image_from_prompt(
                   → call the **cloud SD API** (model_lab.py)  
             • "dalle" / "dall-e" / "dalle3"
                   → call **OpenAI DALL·E 3**
+            • "auto"
+                  → pick one of the above from live latency, queue depth,
+                    error rates and cost (router.py); falls back to the
+                    next back-end if the chosen one fails
 
     n : int, default 1  
         Number of images to generate (batch size).
@@ -120,45 +251,501 @@ def generate_image_from_prompt(
         The function first loads the chosen *preset*, then updates / adds every
         key in `sd_params` — so your dict **overrides** the preset.
 
+    prefetch : bool, default False
+        Download cloud image URLs concurrently into the local image cache
+        (image_cache.py) before returning. The result then becomes a list of
+        ``{"url": ..., "path": ...}`` dicts; ``path`` is None if a download
+        failed. For local SD both fields hold the PNG path.
+
+    max_latency_s / max_cost : float | None   (model="auto" only)
+        Latency target in seconds (default AUTO_LATENCY_TARGET_S) and the
+        most this request may cost in USD. Back-ends predicted to meet the
+        target are preferred, cheapest first; over-budget ones are skipped.
+
+    deadline_s : float | None   (local SD and model="auto")
+        Latency budget in seconds. Instead of `preset`, the best quality
+        rung predicted (cost_model.py, learned from past renders on this
+        machine) to finish in time is used; keys you set in `sd_params` stay
+        fixed. With model="auto" it is also the default `max_latency_s`.
+        Predicted vs. actual time: last_render_report() / cost_model.status().
+
+    priority : "interactive" | "normal" | "bulk" | None (normal)
+        Local renders run one at a time in priority order
+        (local_scheduler.py). An interactive arrival interrupts a running
+        normal / bulk render, which is requeued with the same seed (a random
+        one is pinned for it up front). Cloud API calls of the request are
+        queued at this priority too.
+
     Returns
     -------
     List[str]
         • For **local SD**   absolute file paths (PNG) on the server machine  
           (add ``file:///`` prefix or serve via static route to display).  
         • For **cloud SD / DALL·E**  direct HTTPS image URLs.
+        (List of {"url", "path"} dicts when ``prefetch=True``.)
+
+    Identical concurrent requests (same prompt and effective parameters)
+    share one render (singleflight.py); it is interrupted only when every
+    caller has been cancelled.
     """
     print("Entered GIFP",file=sys.stderr)
-    if not re.match(r"^\d+x\d+$", size):
-        raise ValueError('size must be like "1024x1024"')
+    level = _validate_request(size, model, n, sd_params, priority)
+
+    args = dict(size=size, model=model, n=n, negative_prompt=negative_prompt, preset=preset,
+                sd_params=sd_params, prefetch=prefetch, max_latency_s=max_latency_s,
+                max_cost=max_cost, deadline_s=deadline_s, priority=level)
+    state = {"backend": None, "ticket": None}   # back-end / scheduler ticket of this flight
+
+    def work():
+        _flight.state = state
+        with rate_limit.priority(level):
+            urls = _generate_image(prompt, **args)
+        return urls, last_render_report()
+
+    def cancel():
+        if state["ticket"] is not None:         # cloud calls cannot be recalled
+            state["ticket"].cancel()            # dequeue, or interrupt if rendering
+
+    urls, _report.value = singleflight.run(_flight_key(prompt, **args), work, cancel=cancel)
+    return list(urls)
+
+def _validate_request(size: str, model: str, n: int, sd_params, priority) -> int:
+    """Reject bad arguments before any back-end is tried; returns the priority level."""
+    if not isinstance(size, str) or not re.match(r"^\d+x\d+$", size):
+        raise BadRequest('size must be like "1024x1024"')
+    m = model.lower().strip() if isinstance(model, str) else None
+    if m != "auto" and m not in _BACKEND_ALIASES:
+        raise BadRequest(f"unsupported model: {model}")
+    if not isinstance(n, int) or isinstance(n, bool) or n < 1:
+        raise BadRequest("n must be a positive integer")
     if sd_params and not isinstance(sd_params, dict):
-        raise ValueError("sd_params must be a dict")
+        raise BadRequest("sd_params must be a dict")
+    try:
+        return local_scheduler.parse_priority(priority)
+    except (TypeError, ValueError) as e:
+        raise BadRequest(str(e)) from None
 
+def _flight_key(prompt: str, *, size, model, n, negative_prompt, preset, sd_params, prefetch,
+                max_latency_s, max_cost, deadline_s, priority) -> str:
+    """Canonical effective parameters: requests that would render the same thing."""
     m = model.lower().strip()
+    backend = "auto" if m == "auto" else _BACKEND_ALIASES.get(m, m)
+    key: Dict[str, Any] = {"prompt": prompt.strip(), "size": size, "backend": backend, "n": n,
+                           "negative_prompt": negative_prompt, "prefetch": bool(prefetch)}
+    if backend in ("local", "auto"):             # preset / sd_params only matter locally
+        extra = {k: v for k, v in (sd_params or {}).items()
+                 if not (k == "seed" and v in (None, -1))}
+        key["sd"] = {**_local_effective_params(preset, **extra), **extra}
+        key["deadline_s"] = deadline_s
+        key["priority"] = priority               # a bulk flight must not carry interactive callers
+    if backend == "auto":
+        key.update(max_latency_s=max_latency_s, max_cost=max_cost)
+    return json.dumps(key, sort_keys=True, default=str)
 
-    if m in ("stable-diffusion", "sd", "sdxl"):
-        return sd_generate(prompt=prompt, n=n, size=size,
-                           negative_prompt=negative_prompt)
-
-    if m in ("dalle", "dall-e", "dalle3"):
-        return dalle_generate(prompt=prompt, n=n, size=size)
-
-    if m in ("local_stable-diffusion", "local", "local_sd", "local_sdxl"):
-        start_local_server()          # idempotent
-        kwargs = dict(
-            prompt=prompt,
-            n=n,
-            size=size,
-            negative_prompt=negative_prompt,
-            quality=preset.lower()
-        )
-        if sd_params:
-            kwargs.update(sd_params)  # custom overrides
-        return local_sd_generate(**kwargs)
+_flight = threading.local()
+# the caller gave up: neither a back-end failure nor a reason to try the next one
+_CANCELLED = (local_scheduler.Cancelled, singleflight.Cancelled)
+
+def _generate_image(prompt: str, *, size: str, model: str, n: int, negative_prompt: str,
+                    preset: str, sd_params: Optional[Dict[str, Any]], prefetch: bool,
+                    max_latency_s: Optional[float], max_cost: Optional[float],
+                    deadline_s: Optional[float], priority: int) -> List[Any]:
+    m = model.lower().strip()
+    _report.value = None
+
+    if m == "auto":
+        def call(backend: str):
+            return _generate_image(
+                prompt, size=size, model=backend, n=n, negative_prompt=negative_prompt,
+                preset=preset, sd_params=sd_params, prefetch=prefetch,
+                max_latency_s=None, max_cost=None, deadline_s=deadline_s, priority=priority)
+        if deadline_s is not None:
+            local_eta = cost_model.plan(_local_checkpoint(), size, n, deadline_s,
+                                        overrides=sd_params)["predicted_s"]
+        else:
+            local_eta = cost_model.predict(_local_checkpoint(),
+                                           _local_effective_params(preset, **(sd_params or {})),
+                                           size, n)
+        return router.run(call, work=_work_units(size, n, preset, sd_params), n=n, size=size,
+                          max_latency_s=max_latency_s if max_latency_s is not None else deadline_s,
+                          max_cost=max_cost, local_eta_s=local_eta, stop_on=_CANCELLED)
+
+    backend = _BACKEND_ALIASES.get(m)
+    if backend is None:
+        raise BadRequest(f"unsupported model: {model}")
+    state = getattr(_flight, "state", None)
+    if state is not None:
+        state["backend"] = backend
+
+    plan = None
+    if backend == "local" and deadline_s is not None:
+        plan = cost_model.plan(_local_checkpoint(), size, n, float(deadline_s),
+                               overrides=sd_params, queue_wait_s=router.estimate_local(0))
+        preset, sd_params = plan["preset"], plan["sd_params"]
+
+    # every call feeds the router's latency / error / queue measurements
+    t0 = time.monotonic()
+    if backend == "local":
+        router.local_started()
+    with tracing.span("generate", backend=backend, size=size, n=n):
+        try:
+            if backend == "sd":
+                urls = sd_generate(prompt=prompt, n=n, size=size,
+                                   negative_prompt=negative_prompt)
+
+            elif backend == "dalle":
+                urls = dalle_generate(prompt=prompt, n=n, size=size)
+
+            else:
+                kwargs = dict(
+                    prompt=prompt,
+                    n=n,
+                    size=size,
+                    negative_prompt=negative_prompt,
+                    quality=preset.lower()
+                )
+                if sd_params:
+                    kwargs.update(sd_params)  # custom overrides
+                if priority > rate_limit.PRIORITY_INTERACTIVE and kwargs.get("seed") in (None, -1):
+                    kwargs["seed"] = random.randrange(2 ** 32)   # preempted → same image on rerun
+                ticket = local_scheduler.Ticket(priority, label=prompt[:60])
+                if state is not None:
+                    state["ticket"] = ticket
+
+                def render(t):
+                    start_local_server()      # idempotent; inside the slot (may switch model)
+                    t_render = time.monotonic()
+                    out = local_sd_generate(**kwargs, should_stop=lambda: t.stop_requested)
+                    return out, time.monotonic() - t_render
+
+                urls, render_s = local_scheduler.run(render, ticket=ticket,
+                                                     discard=_discard_local)
+                _observe_local(size, n, preset, sd_params, render_s, plan, deadline_s)
+        except (BadRequest, *_CANCELLED):
+            raise                               # the caller's doing, not the back-end's
+        except Exception:
+            router.record(backend, time.monotonic() - t0, ok=False)
+            raise
+        finally:
+            if backend == "local":
+                router.local_finished()
+    router.record(backend, time.monotonic() - t0, ok=True,
+                  work=_work_units(size, n, preset, sd_params) if backend == "local" else None)
+
+    if prefetch:
+        return [{"url": u, "path": p} for u, p in zip(urls, prefetch_images(urls))]
+    return urls
+
+_report = threading.local()
+
+def _discard_local(result):
+    """Remove the PNGs of a preempted / cancelled local render."""
+    for path in result[0]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _local_checkpoint() -> str:
+    return _current_local_model() or _default_checkpoint
+
+def _observe_local(size, n, preset, sd_params, seconds, plan, deadline_s):
+    """Feed the cost model; keep predicted vs. actual for last_render_report()."""
+    params = _local_effective_params(preset, **(sd_params or {}))
+    if _local_uses_tiles(size, params, (sd_params or {}).get("tiled")):
+        return                                  # tiled renders follow a different cost curve
+    checkpoint = _local_checkpoint()
+    predicted = plan["predicted_s"] if plan else cost_model.predict(checkpoint, params, size, n)
+    cost_model.observe(checkpoint, params, size, n, seconds, predicted)
+    _report.value = {"backend": "local", "checkpoint": checkpoint, "preset": preset,
+                     "sd_params": sd_params, "deadline_s": deadline_s,
+                     "predicted_s": round(predicted, 2), "actual_s": round(seconds, 2)}
+    if plan:
+        print(f"[deadline] {deadline_s}s → preset={preset} {plan['sd_params']}: "
+              f"predicted {predicted:.1f}s, actual {seconds:.1f}s")
+
+def last_render_report() -> Optional[Dict[str, Any]]:
+    """Predicted vs. actual render time of this thread's last local render."""
+    return getattr(_report, "value", None)
 
-    raise ValueError(f"unsupported model: {model}")
+# ======================================================================
+# 3b) draft exploration (local SD): many cheap previews, refine the pick
+# ======================================================================
+_EXPLORE_KEEP = 64
+_explorations: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_explore_lock = threading.Lock()
+
+def _draft_size(size: str, scale: float) -> str:
+    w, h = (int(v) for v in size.lower().split("x"))
+    return f"{max(64, round(w * scale / 8) * 8)}x{max(64, round(h * scale / 8) * 8)}"
+
+def explore_images(
+    prompt: str,
+    *,
+    k: int = 8,
+    size: str = "1024x1024",
+    negative_prompt: str = "bad quality",
+    preset: str = "balanced",
+    sd_params: Optional[Dict[str, Any]] = None,
+    draft_scale: float = 0.5,
+    draft_steps: Optional[int] = None,
+    priority: Optional[str] = "interactive",
+) -> Dict[str, Any]:
+    """
+    Render `k` local drafts in one batched txt2img: `size` × draft_scale,
+    draft_steps (default a third of the preset's steps, at least 6), no hires
+    pass, seeds seed, seed+1, … (random base unless sd_params["seed"]).
+    Eight drafts cost about one full render at `size`.
+
+    Returns {"explore_id", "drafts": [{"index", "seed", "path"}],
+    "draft_size", "size", "preset"}; pass explore_id and the chosen index
+    to refine_image().
+    """
+    if not re.match(r"^\d+x\d+$", size):
+        raise BadRequest('size must be like "1024x1024"')
+    if not 1 <= int(k) <= 16:
+        raise BadRequest("k must be between 1 and 16")
+    if not 0 < draft_scale < 1:
+        raise BadRequest("draft_scale must be between 0 and 1")
+    extra = dict(sd_params or {})
+    seed = extra.pop("seed", None)
+    if seed in (None, -1):
+        seed = random.randrange(2 ** 31)
+    full = _local_effective_params(preset, **extra)
+    steps = int(draft_steps or max(6, full["steps"] // 3))
+    dsize = _draft_size(size, draft_scale)
+    draft = {**extra, "steps": steps, "enable_hr": False, "seed": seed, "tiled": False}
+    paths = generate_image_from_prompt(prompt, model="local", size=dsize, n=int(k),
+                                       negative_prompt=negative_prompt, preset=preset,
+                                       sd_params=draft, priority=priority)
+    explore_id = uuid.uuid4().hex[:12]
+    with _explore_lock:
+        _explorations[explore_id] = {"prompt": prompt, "size": size, "draft_size": dsize,
+                                     "negative_prompt": negative_prompt, "preset": preset,
+                                     "sd_params": extra, "steps": steps, "seed": seed,
+                                     "k": len(paths)}
+        while len(_explorations) > _EXPLORE_KEEP:
+            _explorations.popitem(last=False)
+    return {"explore_id": explore_id, "draft_size": dsize, "size": size, "preset": preset,
+            "drafts": [{"index": i, "seed": seed + i, "path": p} for i, p in enumerate(paths)]}
+
+def refine_image(explore_id: str, index: int, *, denoising_strength: float = 0.5,
+                 priority: Optional[str] = "interactive") -> List[Any]:
+    """
+    Full-quality render of draft `index`. The first pass repeats the draft
+    exactly (same seed, size, sampler and steps), so the composition is
+    kept; a hires pass then scales it to what the preset would output for
+    the original size, with the preset's steps at `denoising_strength`.
+    Outputs above the tiling threshold are tiled like any other render
+    (local_sd.uses_tiles); the tiled base is then the draft's first pass.
+    """
+    with _explore_lock:
+        ex = _explorations.get(explore_id)
+    if ex is None:
+        raise BadRequest(f"unknown or expired explore_id: {explore_id}")
+    if not 0 <= int(index) < ex["k"]:
+        raise BadRequest(f"index must be 0..{ex['k'] - 1}")
+    full = _local_effective_params(ex["preset"], **ex["sd_params"])
+    out_w, out_h = _local_output_size(ex["size"], full)
+    draft_w = int(ex["draft_size"].split("x")[0])
+    # hr_resize_x/y: exact target (draft sides are rounded separately); hr_scale
+    # only feeds the time / work estimates
+    params = {**ex["sd_params"], "steps": ex["steps"], "seed": ex["seed"] + int(index),
+              "enable_hr": True, "hr_scale": round(out_w / draft_w, 3),
+              "hr_resize_x": out_w, "hr_resize_y": out_h,
+              "hr_second_pass_steps": full["steps"], "denoising_strength": denoising_strength}
+    return generate_image_from_prompt(ex["prompt"], model="local", size=ex["draft_size"], n=1,
+                                      negative_prompt=ex["negative_prompt"], preset=ex["preset"],
+                                      sd_params=params, priority=priority)
+
+# ======================================================================
+# 4) staged chat → image jobs
+# ======================================================================
+# extract tags → compile prompt → check cache → render → save / post-process.
+# Each stage has its own pool, so LLM calls for job N+1 overlap with the
+# render of job N. Render runs several workers: the WebUI queues its own renders,
+# cloud calls overlap, and duplicate jobs must reach the stage to share a render.
+_GEN_KEYS = ("size", "model", "n", "negative_prompt", "preset", "sd_params", "prefetch",
+             "max_latency_s", "max_cost", "deadline_s", "priority")
+_RESULT_CACHE_SIZE = 256
+_result_cache: "OrderedDict[str, List[Any]]" = OrderedDict()
+_result_lock = threading.Lock()
+
+def _cache_key(ctx: Dict[str, Any]) -> Optional[str]:
+    """Only seeded requests are reproducible, so only they are cacheable."""
+    seed = (ctx.get("sd_params") or {}).get("seed")
+    if seed is None or seed == -1:
+        return None
+    return json.dumps({"prompt": ctx["prompt"], **{k: ctx.get(k) for k in _GEN_KEYS}},
+                      sort_keys=True, default=str)
+
+def _stage_extract(job: Job):
+    ctx = job.ctx
+    if ctx.get("prompt"):
+        return SKIP
+    with rate_limit.priority(local_scheduler.parse_priority(ctx.get("priority"))):
+        ctx["tags"] = extract_tags(ctx["user_input"].strip(), ctx.get("provider", "auto"))
+
+def _stage_compile(job: Job):
+    ctx = job.ctx
+    if ctx.get("prompt"):
+        return SKIP
+    ctx["prompt"] = tags_to_prompt(ctx["tags"])
+
+def _stage_cache(job: Job):
+    ctx = job.ctx
+    key = _cache_key(ctx)
+    with _result_lock:
+        hit = _result_cache.get(key) if key else None
+    paths = [r["path"] if isinstance(r, dict) else r for r in hit or []]
+    if not hit or not all(p and (p.startswith("http") or os.path.exists(p)) for p in paths):
+        return SKIP
+    with _result_lock:
+        if key in _result_cache:
+            _result_cache.move_to_end(key)
+    ctx["result"] = hit
+    ctx["cached"] = True
+
+def _stage_render(job: Job):
+    ctx = job.ctx
+    if ctx.get("cached"):
+        return SKIP
+    kwargs = {k: ctx[k] for k in _GEN_KEYS if k in ctx and k != "prefetch"}
+    with singleflight.cancel_scope(job.on_cancel):   # cancelled job leaves a shared render
+        ctx["result"] = generate_image_from_prompt(ctx["prompt"], **kwargs)
+    report = last_render_report()
+    if report:
+        ctx["render_report"] = report
+
+def _stage_save(job: Job):
+    ctx = job.ctx
+    if ctx.get("cached"):
+        return SKIP
+    if ctx.get("prefetch"):
+        urls = ctx["result"]
+        ctx["result"] = [{"url": u, "path": p} for u, p in zip(urls, prefetch_images(urls))]
+    key = _cache_key(ctx)
+    if key:
+        with _result_lock:
+            _result_cache[key] = ctx["result"]
+            while len(_result_cache) > _RESULT_CACHE_SIZE:
+                _result_cache.popitem(last=False)
+
+pipeline = Pipeline([
+    ("extract", _stage_extract, int(os.getenv("JOB_EXTRACT_WORKERS", "4"))),
+    ("compile", _stage_compile, 2),
+    ("cache",   _stage_cache,   1),
+    ("render",  _stage_render,  int(os.getenv("JOB_RENDER_WORKERS", "4"))),
+    ("save",    _stage_save,    2),
+])
+
+def submit_chat_job(user_input: str, provider: str = "auto", **gen_kwargs) -> Job:
+    """
+    Queue a chat → image job and return its handle at once.
+
+    `gen_kwargs` are the keyword arguments of generate_image_from_prompt
+    (size, model, n, negative_prompt, preset, sd_params, prefetch,
+    max_latency_s, max_cost, deadline_s, priority).
+    Iterate `job.events()` for stage events or call `job.wait()` for the
+    same result generate_image_from_prompt would return.
+    """
+    if not user_input or not user_input.strip():
+        raise ValueError("user_input cannot be empty")
+    return _submit({"user_input": user_input, "provider": provider}, gen_kwargs)
+
+def submit_prompt_job(prompt: str, **gen_kwargs) -> Job:
+    """Same as submit_chat_job for a ready-made prompt (extract/compile skipped)."""
+    return _submit({"prompt": prompt}, gen_kwargs)
+
+def _submit(params: Dict[str, Any], gen_kwargs: Dict[str, Any]) -> Job:
+    unknown = set(gen_kwargs) - set(_GEN_KEYS)
+    if unknown:
+        raise ValueError(f"unsupported job options: {sorted(unknown)}")
+    local_scheduler.parse_priority(gen_kwargs.get("priority"))     # reject typos up front
+    job = pipeline.submit({**params, **gen_kwargs})
+    if params.get("user_input"):            # LLM stage ahead: warm the WebUI meanwhile
+        warm = warm_up_local(gen_kwargs.get("model", "stable-diffusion"))
+        if warm is not None:
+            job.ctx["_warmup"] = warm
+            job.on_cancel(warm.cancel)
+            if job.status == "failed":
+                warm.cancel()
+    return job
+
+def get_job(job_id: str) -> Optional[Job]:
+    return pipeline.get(job_id)
+
+# ---------- durable journal: record every job, resume after a crash ----------
+# EA_JOB_JOURNAL=off disables it. (The repo-root requests.jsonl is a work-item
+# list, not a job log, so the journal keeps a file of its own.)
+_JOURNAL_PATH = os.getenv("EA_JOB_JOURNAL",
+                          str(Path(__file__).resolve().parents[1] / "job_journal.jsonl"))
+journal: Optional[JobJournal] = None if _JOURNAL_PATH.lower() == "off" else JobJournal(_JOURNAL_PATH)
+_MAX_RESUME_ATTEMPTS = 3
+_JOB_KEYS = ("user_input", "provider", "prompt") + _GEN_KEYS
+
+def _public_params(params: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in params.items() if not k.startswith("_")}
+
+def _journal_listener(job: Job, stage: str, status: str):
+    if journal is None:
+        return
+    ctx = job.ctx
+    if stage == "job" and status == "queued":
+        journal.record(job.id, "submitted", sync=True,
+                       kind="chat" if ctx.get("user_input") else "prompt",
+                       attempt=ctx.get("_attempt", 1), params=_public_params(job.params))
+    elif stage == "render" and status == "started":
+        journal.record(job.id, "started",
+                       params={"prompt": ctx.get("prompt"),
+                               **{k: ctx[k] for k in _GEN_KEYS if k in ctx}})
+    elif stage == "job" and status in TERMINAL:
+        journal.record(job.id, status, result=job.result, error=job.error)
+
+def _warmup_listener(job: Job, stage: str, status: str):
+    """A chat job that fails before rendering no longer needs its warm-up."""
+    warm = job.ctx.get("_warmup")
+    if warm is not None and stage == "job" and status == "failed":
+        warm.cancel()
+
+pipeline.add_listener(_journal_listener)
+pipeline.add_listener(_warmup_listener)
+
+def submit_from_params(params: Dict[str, Any], *, job_id: Optional[str] = None,
+                       attempt: int = 1) -> Job:
+    """Submit a job from recorded parameters (journal resume / traffic replay)."""
+    p = {k: v for k, v in params.items() if k in _JOB_KEYS}
+    if p.get("prompt"):
+        p.pop("user_input", None)
+        p.pop("provider", None)
+    p["_attempt"] = attempt
+    return pipeline.submit(p, job_id=job_id)
+
+def resume_jobs() -> List[Job]:
+    """
+    Re-submit every journaled job that never finished (worker / WebUI crash).
+    A chat job that already got its prompt resumes from that prompt, without
+    another LLM call. Jobs that crashed `_MAX_RESUME_ATTEMPTS` times are
+    marked failed instead of being retried forever.
+    """
+    if journal is None:
+        return []
+    pending = journal.unfinished()
+    journal.compact()
+    resumed = []
+    for j in pending:
+        attempt = j["attempts"] + 1
+        if attempt > _MAX_RESUME_ATTEMPTS:
+            journal.record(j["job"], "failed", error=f"gave up after {j['attempts']} attempts")
+            continue
+        params = dict(j["params"])
+        if (j.get("effective") or {}).get("prompt"):
+            params["prompt"] = j["effective"]["prompt"]
+        resumed.append(submit_from_params(params, job_id=j["job"], attempt=attempt))
+    return resumed
 
 # ======================================================================
-# 4) CLI demo
+# 5) CLI demo
 # ======================================================================
 if __name__ == "__main__":
     try:
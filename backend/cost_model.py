@@ -0,0 +1,200 @@
+# -----------------------------------------------
+# cost_model.py  ——  learned local render time + deadline planning
+# -----------------------------------------------
+"""
+Local WebUI render time is modelled per checkpoint as
+
+    seconds ≈ a + b · base_work + c · hires_work
+
+    base_work  = n · megapixels · steps · evals_per_step(sampler)
+    hires_work = n · megapixels · hr_scale² · hr_steps · evals_per_step(sampler)
+
+and fitted online with recursive least squares (forgetting factor, so the
+model follows driver / thread / machine changes). Until a checkpoint has a
+few samples the pooled model of all checkpoints is used; that one starts
+from a GPU / CPU prior.
+
+plan() walks a quality ladder (ultra → … → fast with fewer steps) and
+returns the best settings predicted to finish within a deadline; the
+caller's own sd_params are never changed. Every observation is compared to
+its prediction; status() reports the recent errors.
+
+State persists in outputs/cache/cost_model.json (keyed by hardware
+fingerprint, so a different machine starts fresh).
+"""
+
+import os, json, time, shutil, threading, collections
+from pathlib import Path
+from local_sd import effective_params, _parse_size
+from sd_launcher import _fingerprint
+
+STATE_PATH = Path(__file__).resolve().parents[1] / "outputs" / "cache" / "cost_model.json"
+_FORGET = 0.97                  # RLS forgetting factor (≈ last 30 renders dominate)
+_MIN_SAMPLES = 3                # per-checkpoint samples before trusting its own fit
+_POOLED = "*"
+# seconds of fixed overhead, seconds per base / hires work unit
+_PRIOR = (2.0, 0.1, 0.13) if shutil.which("nvidia-smi") else (5.0, 6.0, 8.0)
+# samplers that evaluate the model twice per step
+_TWO_EVAL = ("heun", "dpm2", "dpm++ sde", "dpm++ 2s", "restart")
+
+# best quality first; (preset, overrides applied on top of it)
+QUALITY_LADDER: list[tuple[str, dict]] = [
+    ("ultra", {}),
+    ("high", {}),
+    ("high", {"hr_scale": 1.4, "hr_second_pass_steps": 10}),
+    ("balanced", {}),
+    ("fast", {}),
+    ("fast", {"steps": 14}),
+    ("fast", {"steps": 10}),
+    ("fast", {"steps": 8}),
+]
+
+def evals_per_step(sampler: str | None) -> int:
+    s = (sampler or "").lower()
+    if s.startswith(("dpm++ 2m", "dpm++ 3m")):
+        return 1
+    return 2 if s.startswith(_TWO_EVAL) else 1
+
+def features(params: dict, size: str, n: int = 1) -> list[float]:
+    w, h = _parse_size(size)
+    mp = w * h / 1e6
+    ev = evals_per_step(params.get("sampler_name"))
+    base = n * mp * (params.get("steps") or 20) * ev
+    hires = 0.0
+    if params.get("enable_hr"):
+        hires = n * mp * (params.get("hr_scale") or 1.5) ** 2 * \
+            (params.get("hr_second_pass_steps") or params.get("steps") or 20) * ev
+    return [1.0, base, hires]
+
+
+class _RLS:
+    """3-parameter recursive least squares with exponential forgetting."""
+
+    def __init__(self, theta=_PRIOR, p_diag=(100.0, 25.0, 25.0), samples=0):
+        self.theta = list(theta)
+        self.P = [[p_diag[i] if i == j else 0.0 for j in range(3)] for i in range(3)]
+        self.samples = samples
+
+    def predict(self, x: list[float]) -> float:
+        # clamp coefficients: an early, noisy fit must not predict negative time
+        return max(0.0, sum(max(0.0, t) * xi for t, xi in zip(self.theta, x)))
+
+    def update(self, x: list[float], y: float):
+        Px = [sum(self.P[i][j] * x[j] for j in range(3)) for i in range(3)]
+        denom = _FORGET + sum(x[i] * Px[i] for i in range(3))
+        k = [v / denom for v in Px]
+        err = y - sum(t * xi for t, xi in zip(self.theta, x))
+        self.theta = [t + ki * err for t, ki in zip(self.theta, k)]
+        self.P = [[(self.P[i][j] - k[i] * Px[j]) / _FORGET for j in range(3)] for i in range(3)]
+        self.samples += 1
+
+    def to_dict(self) -> dict:
+        return {"theta": self.theta, "P": self.P, "samples": self.samples}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "_RLS":
+        m = cls(samples=d.get("samples", 0))
+        m.theta, m.P = list(d["theta"]), [list(r) for r in d["P"]]
+        return m
+
+
+class RenderCostModel:
+    def __init__(self, path: Path = STATE_PATH, history: int = 50):
+        self.path = Path(path)
+        self._models: dict[str, _RLS] = {}
+        self._history = collections.deque(maxlen=history)
+        self._lock = threading.Lock()
+        self._load()
+
+    # ----- persistence -----
+    def _load(self):
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return
+        if data.get("fingerprint") != _fingerprint():
+            return
+        for name, d in data.get("models", {}).items():
+            try:
+                self._models[name] = _RLS.from_dict(d)
+            except (KeyError, TypeError):
+                continue
+
+    def _save(self):
+        data = {"fingerprint": _fingerprint(),
+                "models": {k: m.to_dict() for k, m in self._models.items()}}
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(data), encoding="utf-8")
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+    # ----- prediction / learning -----
+    def _model_for(self, checkpoint: str | None) -> _RLS:
+        own = self._models.get(checkpoint or _POOLED)
+        if own is not None and own.samples >= _MIN_SAMPLES:
+            return own
+        return self._models.get(_POOLED) or _RLS()
+
+    def predict(self, checkpoint: str | None, params: dict, size: str, n: int = 1) -> float:
+        with self._lock:
+            return self._model_for(checkpoint).predict(features(params, size, n))
+
+    def observe(self, checkpoint: str | None, params: dict, size: str, n: int,
+                seconds: float, predicted: float | None = None):
+        x = features(params, size, n)
+        with self._lock:
+            if predicted is None:
+                predicted = self._model_for(checkpoint).predict(x)
+            for name in {checkpoint or _POOLED, _POOLED}:
+                if name not in self._models:        # start from what the pool knows
+                    seed = self._models.get(_POOLED)
+                    self._models[name] = _RLS(theta=seed.theta) if seed else _RLS()
+                self._models[name].update(x, seconds)
+            self._history.append({"ts": round(time.time(), 1), "checkpoint": checkpoint,
+                                  "size": size, "n": n, "steps": params.get("steps"),
+                                  "hires": bool(params.get("enable_hr")),
+                                  "predicted_s": round(predicted, 2),
+                                  "actual_s": round(seconds, 2)})
+            self._save()
+
+    # ----- deadline planning -----
+    def plan(self, checkpoint: str | None, size: str, n: int, deadline_s: float, *,
+             overrides: dict | None = None, queue_wait_s: float = 0.0) -> dict:
+        """
+        Highest-quality ladder rung predicted to finish within `deadline_s`
+        (after `queue_wait_s`). Keys in `overrides` are pinned by the caller.
+        Falls back to the fastest rung when nothing fits.
+        Returns {"preset", "sd_params", "params", "predicted_s" (render only),
+        "queue_wait_s", "fits"}.
+        """
+        pinned = {k: v for k, v in (overrides or {}).items() if v is not None}
+        budget = deadline_s - queue_wait_s
+        best = None
+        for rung_preset, rung in QUALITY_LADDER:
+            params = effective_params(rung_preset, **{**rung, **pinned})
+            eta = self.predict(checkpoint, params, size, n)
+            cand = {"preset": rung_preset, "sd_params": {**rung, **pinned}, "params": params,
+                    "predicted_s": round(eta, 2), "queue_wait_s": round(queue_wait_s, 2),
+                    "fits": eta <= budget}
+            if cand["fits"]:
+                return cand
+            if best is None or cand["predicted_s"] < best["predicted_s"]:
+                best = cand
+        return best
+
+    def status(self) -> dict:
+        with self._lock:
+            hist = list(self._history)
+            models = {k: {"samples": m.samples,
+                          "overhead_s": round(m.theta[0], 3),
+                          "s_per_base_unit": round(m.theta[1], 4),
+                          "s_per_hires_unit": round(m.theta[2], 4)}
+                      for k, m in self._models.items()}
+        errs = [abs(h["actual_s"] - h["predicted_s"]) / max(h["actual_s"], 1e-6) for h in hist]
+        return {"models": models, "recent": hist[-10:],
+                "mean_abs_pct_error": round(100 * sum(errs) / len(errs), 1) if errs else None}
+
+model = RenderCostModel()
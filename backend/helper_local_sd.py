@@ -1,41 +1,15 @@
 # helper_local_sd.py
-import subprocess, time, requests, psutil
+import subprocess
+import sd_supervisor, sd_launcher
 
 def start_sd(port=7860) -> subprocess.Popen:
-    proc = subprocess.Popen(
-        ["python", "backend/server_local_sd.py", "--port", str(port)]
-    )
-    _wait_ready(port)
+    proc = sd_launcher.launch(port)
+    sd_launcher.wait_ready(proc, f"http://127.0.0.1:{port}")
     return proc
 
-def _wait_ready(port, timeout=90):
-    url = f"http://127.0.0.1:{port}/sdapi/v1/sd-models"
-    for _ in range(timeout):
-        try:
-            requests.get(url, timeout=2)
-            return
-        except requests.exceptions.RequestException:
-            time.sleep(1)
-    raise TimeoutError("WebUI start timeout")
-
 def stop_sd(proc: subprocess.Popen, port=7860):
-    try:
-        requests.post(f"http://127.0.0.1:{port}/shutdown", timeout=2)
-    except requests.exceptions.RequestException:
-        pass
-    try:
-        proc.wait(timeout=8)
-    except subprocess.TimeoutExpired:
-        proc.terminate()
-        try:
-            proc.wait(timeout=5)
-        except subprocess.TimeoutExpired:
-            proc.kill()
-    # double-check if any process is still using the port
-    for p in psutil.process_iter(["pid", "connections"]):
-        for c in p.info["connections"]:
-            if c.laddr.port == port:
-                p.kill()
+    # graceful /shutdown → process tree → port scan (only if still bound)
+    sd_supervisor.stop(proc, port)
  
 # ==================== demo ====================
 if __name__ == "__main__":
@@ -1,9 +1,21 @@
 # -----------------------------------------------
 # image.py   ——   Calling DALL·E to generate images
 # -----------------------------------------------
-from openai import OpenAI
+from openai import OpenAI, RateLimitError
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
 import os, webbrowser
+from rate_limit import limiter, call_with_limit, retry_after, RateLimitExceeded
+import tracing
+
+_MODEL = os.getenv("OPENAI_IMAGE_MODEL", "dall-e-3")
+_SINGLE_IMAGE_MODELS = {"dall-e-3"}                          # n must be 1 per request
+_CONCURRENCY = int(os.getenv("DALLE_CONCURRENCY", "4"))
+_RPM = float(os.getenv("DALLE_RPM", "15"))
+_MAX_RETRIES = 4
+
+# shared by every caller in the process; burst = concurrency so one n=4 call is not throttled
+limiter("dalle", rpm=_RPM, burst=max(1, _CONCURRENCY))
 
 def _get_key():
     load_dotenv()
@@ -12,22 +24,54 @@ def _get_key():
         raise RuntimeError("Please set the OPENAI_API_KEY environment variable.")
     return k
 
-def generate_image(prompt: str, n: int = 1, size: str = "1024x1024") -> list[str]:
+def _generate_batch(client: OpenAI, prompt: str, n: int, size: str, model: str) -> list[str]:
+    """One images.generate call under the "dalle" limiter, retried on 429."""
+    def call():
+        try:
+            raw = client.images.with_raw_response.generate(
+                model=model,
+                prompt=prompt,
+                n=n,
+                size=size,
+                response_format="url"
+            )
+        except RateLimitError as e:
+            headers = getattr(getattr(e, "response", None), "headers", None)
+            raise RateLimitExceeded("dalle", retry_after(headers), str(e))
+        limiter("dalle").observe_headers(raw.headers)
+        return [item.url for item in raw.parse().data]
+    return call_with_limit("dalle", call, retries=_MAX_RETRIES)
+
+def generate_image(
+    prompt: str,
+    n: int = 1,
+    size: str = "1024x1024",
+    *,
+    model: str = _MODEL,
+    max_concurrency: int = _CONCURRENCY,
+) -> list[str]:
     """
-    Generate images using OpenAI's DALL·E model.    
+    Generate images using OpenAI's DALL·E model.
+
+    DALL·E 3 accepts only n=1 per request, so n>1 is fanned out into parallel
+    single-image requests (at most `max_concurrency` in flight, all sharing
+    the process-wide "dalle" limiter). URLs come back in request order.
     """
-    client = OpenAI(api_key=_get_key())
-    resp = client.images.generate(
-        prompt=prompt,
-        n=n,
-        size=size,
-        response_format="url"
-    )
-    return [item.url for item in resp.data]
+    client = OpenAI(api_key=_get_key(), max_retries=0)      # 429s are handled here
+    if model not in _SINGLE_IMAGE_MODELS or n <= 1:
+        return _generate_batch(client, prompt, n, size, model)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(n, max_concurrency)),
+                            thread_name_prefix="dalle") as pool:
+        # bind: the calls queue at the caller's rate_limit priority
+        futures = [pool.submit(tracing.bind(_generate_batch), client, prompt, 1, size, model)
+                   for _ in range(n)]
+        parts = [f.result() for f in futures]
+    return [url for part in parts for url in part]
 
 # Self-test
 if __name__ == "__main__":
     prompt="A lone chrome cyber-samurai kneeling on an ancient moss-covered stone bridge that arches over a crystal clear stream, in a mist-filled cherry-blossom forest at dawn, golden volumetric light shafts filtering through the trees, swirling pink petals and gentle bioluminescent fireflies, ultra-realistic cinematic 8K, octane render"
-    urls = generate_image(prompt,size="1024x1024") 
+    urls = generate_image(prompt,size="1024x1024")
     print(urls[0])
     webbrowser.open(urls[0])
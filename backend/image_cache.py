@@ -0,0 +1,170 @@
+# -----------------------------------------------
+# image_cache.py  ——  download cloud image URLs into a local store
+# -----------------------------------------------
+"""
+Cloud back-ends (model_lab, image) return short-lived HTTPS URLs. prefetch()
+downloads them concurrently through one pooled HTTP session into a
+content-addressed store:
+
+    outputs/cache/<sha256[:2]>/<sha256>.<ext>
+    outputs/cache/index.json            url → sha256 + ext
+
+A URL that was fetched before is answered from the index without network
+traffic. Files are streamed to disk while being hashed, so memory stays flat
+for large images. When the store grows past IMAGE_CACHE_MAX_MB the least
+recently used files are evicted.
+"""
+
+import os, json, hashlib, tempfile, threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import requests
+from requests.adapters import HTTPAdapter
+
+CACHE_DIR = Path(os.getenv("IMAGE_CACHE_DIR", "outputs/cache"))
+MAX_BYTES = int(float(os.getenv("IMAGE_CACHE_MAX_MB", "1024")) * 1024 * 1024)
+_MAX_WORKERS = 8
+_CHUNK = 64 * 1024
+_EXT_BY_TYPE = {"image/png": ".png", "image/jpeg": ".jpg", "image/webp": ".webp",
+                "image/gif": ".gif"}
+
+_lock = threading.Lock()
+_index: dict | None = None
+_session: requests.Session | None = None
+
+# ---------- index & session ----------
+def _index_path() -> Path:
+    return CACHE_DIR / "index.json"
+
+def _load_index() -> dict:
+    global _index
+    if _index is None:
+        try:
+            _index = json.loads(_index_path().read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            _index = {}
+    return _index
+
+def _save_index():
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = _index_path().with_suffix(".tmp")
+    tmp.write_text(json.dumps(_index, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, _index_path())
+
+def _get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        s = requests.Session()
+        adapter = HTTPAdapter(pool_connections=_MAX_WORKERS, pool_maxsize=_MAX_WORKERS,
+                              max_retries=2)
+        s.mount("https://", adapter)
+        s.mount("http://", adapter)
+        _session = s
+    return _session
+
+def _blob_path(sha: str, ext: str) -> Path:
+    return CACHE_DIR / sha[:2] / f"{sha}{ext}"
+
+# ---------- lookup / download ----------
+def cached_path(url: str) -> str | None:
+    """Local path for `url` if it is in the store, else None."""
+    with _lock:
+        entry = _load_index().get(url)
+    if not entry:
+        return None
+    p = _blob_path(entry["sha256"], entry["ext"])
+    if not p.exists():
+        return None
+    os.utime(p)                                  # mark as recently used
+    return str(p.resolve())
+
+def _download(url: str) -> str:
+    hit = cached_path(url)
+    if hit:
+        return hit
+
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    h = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f, _get_session().get(url, stream=True, timeout=60) as r:
+            r.raise_for_status()
+            ctype = r.headers.get("Content-Type", "").split(";")[0].strip()
+            for chunk in r.iter_content(_CHUNK):
+                h.update(chunk)
+                f.write(chunk)
+        ext = _EXT_BY_TYPE.get(ctype) or (Path(url.split("?")[0]).suffix or ".png")
+        sha = h.hexdigest()
+        dest = _blob_path(sha, ext)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp, dest)                    # same content → same file
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+    with _lock:
+        _load_index()[url] = {"sha256": sha, "ext": ext}
+    return str(dest.resolve())
+
+def prefetch(urls: list[str], *, max_workers: int = _MAX_WORKERS) -> list[str | None]:
+    """
+    Download every HTTP(S) URL in `urls` concurrently.
+    Returns local paths in input order (None where a download failed);
+    entries that are already local paths are passed through.
+    """
+    def one(u: str) -> str | None:
+        if not u.startswith(("http://", "https://")):
+            return u
+        try:
+            return _download(u)
+        except (requests.exceptions.RequestException, OSError):
+            return None
+
+    remote = [u for u in urls if u.startswith(("http://", "https://"))]
+    if len(remote) <= 1:
+        paths = [one(u) for u in urls]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(remote)),
+                                thread_name_prefix="image-prefetch") as pool:
+            paths = list(pool.map(one, urls))
+
+    if remote:
+        keep = {Path(p).stem for p in paths if p}
+        with _lock:
+            _evict(keep)
+            _save_index()
+    return paths
+
+# ---------- eviction ----------
+def _evict(keep: set):
+    """
+    Drop least recently used blobs until the store fits MAX_BYTES (lock held).
+    Blobs whose hash is in `keep` (the batch just returned) are never dropped.
+    """
+    blobs = []
+    for p in CACHE_DIR.glob("??/*"):
+        try:
+            st = p.stat()
+        except OSError:
+            continue
+        blobs.append((st.st_mtime, st.st_size, p))
+    total = sum(b[1] for b in blobs)
+    if total <= MAX_BYTES:
+        return
+    gone = set()
+    for _, size, p in sorted(blobs):
+        if total <= MAX_BYTES:
+            break
+        if p.stem in keep:
+            continue
+        try:
+            p.unlink()
+        except OSError:
+            continue
+        total -= size
+        gone.add(p.stem)
+    for url in [u for u, e in _index.items() if e["sha256"] in gone]:
+        del _index[url]
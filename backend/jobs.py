@@ -0,0 +1,208 @@
+# -----------------------------------------------
+# jobs.py  ——  staged, pipelined job runner
+# -----------------------------------------------
+"""
+A Pipeline is an ordered list of stages; each stage owns a bounded thread
+pool. A job moves from stage to stage by being resubmitted to the next
+pool, so while job N sits in a slow stage (render) job N+1 can already run
+the earlier ones (LLM extraction).
+
+Stage functions take the Job and update `job.ctx` in place; a stage that
+has nothing to do returns SKIP. Every transition is recorded as an
+event on the Job handle:
+
+    {"job": id, "seq": 3, "stage": "render", "status": "started", "t": 1.92}
+
+and the final event has stage "job" and status "completed" / "failed" /
+"cancelled".
+"""
+
+import threading, time, uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import tracing
+
+SKIP = object()                 # stage return value: nothing to do for this job
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    """Handle for one pipelined job: events, result and cancellation."""
+
+    def __init__(self, params: dict, job_id: str | None = None):
+        self.id = job_id or uuid.uuid4().hex
+        self.params = params
+        self.ctx: dict = dict(params)
+        self.status = "queued"
+        self.result = None
+        self.error: str | None = None
+        self._t0 = time.monotonic()
+        self._history: list[dict] = []
+        self._cv = threading.Condition()
+        self._cancel = threading.Event()
+        self._cancel_hooks: list = []
+
+    # ----- events -----
+    def _emit(self, stage: str, status: str, **extra):
+        with self._cv:
+            ev = {"job": self.id, "seq": len(self._history), "stage": stage,
+                  "status": status, "t": round(time.monotonic() - self._t0, 3), **extra}
+            self._history.append(ev)
+            self._cv.notify_all()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("completed", "failed", "cancelled")
+
+    def events_since(self, cursor: int = 0, wait: float = 0.0) -> list[dict]:
+        """Events with seq >= cursor; blocks up to `wait` seconds for new ones."""
+        with self._cv:
+            if wait and len(self._history) <= cursor and not self.done:
+                self._cv.wait(timeout=wait)
+            return self._history[cursor:]
+
+    def events(self, timeout: float | None = None):
+        """Yield every event (past and future) until the job finishes."""
+        cursor = 0
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            left = 1.0 if deadline is None else max(0.0, deadline - time.monotonic())
+            batch = self.events_since(cursor, wait=left)
+            for ev in batch:
+                yield ev
+            cursor += len(batch)
+            if self.done and cursor >= len(self._history):
+                return
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(f"job {self.id} still running")
+
+    def wait(self, timeout: float | None = None):
+        """Block until finished; return the result or raise on failure."""
+        with self._cv:
+            if not self._cv.wait_for(lambda: self.done, timeout=timeout):
+                raise TimeoutError(f"job {self.id} still running")
+        if self.status == "failed":
+            raise RuntimeError(self.error)
+        if self.status == "cancelled":
+            raise JobCancelled(self.id)
+        return self.result
+
+    # ----- cancellation -----
+    def cancel(self):
+        """Stop before the next stage starts and notify running-stage hooks."""
+        self._cancel.set()
+        for hook in list(self._cancel_hooks):
+            try:
+                hook()
+            except Exception:
+                pass
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def on_cancel(self, fn):
+        """Register fn() to run if the job is cancelled (e.g. abort a render)."""
+        self._cancel_hooks.append(fn)
+        if self._cancel.is_set():
+            fn()
+
+    def snapshot(self) -> dict:
+        return {"id": self.id, "status": self.status, "result": self.result,
+                "error": self.error, "events": len(self._history)}
+
+
+class Pipeline:
+    """Ordered stages, each with its own bounded worker pool."""
+
+    def __init__(self, stages: list[tuple[str, object, int]], *, keep: int = 256):
+        self.stages = [(name, fn, ThreadPoolExecutor(max_workers=max(1, workers),
+                                                     thread_name_prefix=f"stage-{name}"))
+                       for name, fn, workers in stages]
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._keep = keep
+        self._lock = threading.Lock()
+        self._listeners: list = []
+
+    def add_listener(self, fn):
+        """fn(job, stage, status) after every stage transition (journals, metrics)."""
+        self._listeners.append(fn)
+
+    def _notify(self, job: Job, stage: str, status: str):
+        for fn in list(self._listeners):
+            try:
+                fn(job, stage, status)
+            except Exception:
+                pass
+
+    def submit(self, params: dict, *, job_id: str | None = None) -> Job:
+        job = Job(params, job_id)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self._keep:
+                oldest = next(iter(self._jobs))
+                if not self._jobs[oldest].done:
+                    break
+                self._jobs.pop(oldest)
+        job._emit("job", "queued")
+        self._notify(job, "job", "queued")
+        self._advance(job, 0)
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def depth(self) -> dict:
+        """Jobs currently waiting in or running each stage."""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        out = {name: 0 for name, _, _ in self.stages}
+        for j in jobs:
+            if not j.done and j.status in out:
+                out[j.status] += 1
+        return out
+
+    def _advance(self, job: Job, idx: int):
+        if idx >= len(self.stages):
+            self._finish(job, "completed")
+            return
+        name, fn, pool = self.stages[idx]
+        job.status = name
+        pool.submit(self._run_stage, job, idx)
+
+    def _run_stage(self, job: Job, idx: int):
+        name, fn, _ = self.stages[idx]
+        if job.cancelled:
+            self._finish(job, "cancelled")
+            return
+        job._emit(name, "started")
+        self._notify(job, name, "started")
+        try:
+            # one trace per stage run; trace_id=job.id samples all stages of a job together
+            with tracing.trace(f"stage.{name}", trace_id=job.id, job=job.id):
+                out = fn(job)
+        except Exception as e:
+            if job.cancelled:
+                self._finish(job, "cancelled")
+                return
+            job.error = f"{name}: {e}"
+            job._emit(name, "failed", error=str(e))
+            self._finish(job, "failed")
+            return
+        status = "skipped" if out is SKIP else "done"
+        job._emit(name, status)
+        self._notify(job, name, status)
+        self._advance(job, idx + 1)
+
+    def _finish(self, job: Job, status: str):
+        if status == "completed":
+            job.result = job.ctx.get("result")
+        extra = {"result": job.result} if status == "completed" else {}
+        if job.error:
+            extra["error"] = job.error
+        with job._cv:                   # status and final event become visible together
+            job.status = status
+            job._emit("job", status, **extra)
+        self._notify(job, "job", status)
@@ -0,0 +1,205 @@
+# -----------------------------------------------
+# journal.py  ——  append-only job journal (crash resume + traffic replay)
+# -----------------------------------------------
+"""
+One JSON record per line:
+
+    {"ts": 1729230000.12, "job": "9f…", "state": "submitted", "kind": "chat",
+     "params": {...}}
+    {"ts": ..., "job": "9f…", "state": "started", "params": {<effective>}}
+    {"ts": ..., "job": "9f…", "state": "completed", "result": [...]}
+
+States: submitted → started → completed / failed / cancelled.
+
+Writes are buffered and flushed by one background thread with a single
+fsync per batch (group commit). record(..., sync=True) blocks until its
+batch is on disk — used for "submitted", so an acknowledged job survives a
+crash. Once the file passes `compact_bytes` it is rewritten with only the
+unfinished jobs.
+
+CLI (replay recorded traffic for benchmarking):
+    python journal.py replay job_journal.jsonl [--speed 2] [--dry-run]
+"""
+
+import os, json, time, threading
+from pathlib import Path
+
+TERMINAL = ("completed", "failed", "cancelled")
+
+def iter_records(path) -> "iter[dict]":
+    """Yield every well-formed record; a torn last line (crash) is skipped."""
+    try:
+        f = open(path, "r", encoding="utf-8")
+    except FileNotFoundError:
+        return
+    with f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+def fold(records) -> dict:
+    """job id → merged view {job, kind, state, params, effective, attempts, ts}."""
+    jobs: dict = {}
+    for r in records:
+        jid = r.get("job")
+        if not jid:
+            continue
+        j = jobs.setdefault(jid, {"job": jid, "attempts": 0})
+        state = r.get("state")
+        if state == "submitted":
+            j.update(kind=r.get("kind"), params=r.get("params", {}), ts=r.get("ts"))
+            j["attempts"] = max(j["attempts"], r.get("attempt", 1))
+        elif state == "started" and r.get("params"):
+            j["effective"] = r["params"]
+        j["state"] = state
+    return jobs
+
+
+class JobJournal:
+    def __init__(self, path, *, flush_interval: float = 0.2,
+                 compact_bytes: int = 4 * 1024 * 1024):
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+        self.compact_bytes = compact_bytes
+        self._buf: list[str] = []
+        self._seq = 0                # records queued
+        self._flushed = 0            # records on disk
+        self._sync_waiters = 0
+        self._cv = threading.Condition()
+        self._io = threading.Lock()          # file appends vs. compaction
+        self._thread: threading.Thread | None = None
+        self._closed = False
+
+    # ----- writing -----
+    def record(self, job_id: str, state: str, *, sync: bool = False, **fields):
+        line = json.dumps({"ts": round(time.time(), 3), "job": job_id, "state": state,
+                           **fields}, ensure_ascii=False, default=str)
+        with self._cv:
+            self._buf.append(line)
+            self._seq += 1
+            my_seq = self._seq
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="job-journal",
+                                                daemon=True)
+                self._thread.start()
+            if sync:
+                self._sync_waiters += 1
+            self._cv.notify_all()
+            if sync:
+                try:
+                    self._cv.wait_for(lambda: self._flushed >= my_seq or self._closed)
+                finally:
+                    self._sync_waiters -= 1
+
+    def _run(self):
+        while True:
+            with self._cv:
+                self._cv.wait_for(lambda: self._buf or self._closed)
+                if not self._buf and self._closed:
+                    return
+                if not self._sync_waiters and not self._closed:
+                    # let a batch accumulate unless someone is waiting on disk
+                    self._cv.wait_for(lambda: self._sync_waiters or self._closed,
+                                      timeout=self.flush_interval)
+                batch, self._buf = self._buf, []
+                upto = self._seq
+            self._write(batch)
+            with self._cv:
+                self._flushed = upto
+                self._cv.notify_all()
+            if self.compact_bytes and self._size() > self.compact_bytes:
+                self.compact()
+
+    def _write(self, lines: list[str]):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._io, open(self.path, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _size(self) -> int:
+        try:
+            return self.path.stat().st_size
+        except OSError:
+            return 0
+
+    def flush(self):
+        """Block until everything recorded so far is on disk."""
+        with self._cv:
+            target = self._seq
+            self._sync_waiters += 1
+            self._cv.notify_all()
+            try:
+                self._cv.wait_for(lambda: self._flushed >= target or self._thread is None)
+            finally:
+                self._sync_waiters -= 1
+
+    def close(self):
+        self.flush()
+        with self._cv:
+            self._closed = True
+            self._cv.notify_all()
+
+    # ----- reading / maintenance -----
+    def unfinished(self) -> list[dict]:
+        """Jobs that were submitted but never reached a terminal state."""
+        return [j for j in fold(iter_records(self.path)).values()
+                if j.get("params") is not None and j.get("state") not in TERMINAL]
+
+    def compact(self):
+        """Rewrite the file keeping only records of unfinished jobs."""
+        with self._io:                      # no batch can be appended meanwhile
+            live = {j["job"] for j in self.unfinished()}
+            keep = [json.dumps(r, ensure_ascii=False, default=str)
+                    for r in iter_records(self.path) if r.get("job") in live]
+            tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                if keep:
+                    f.write("\n".join(keep) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+
+
+# ---------- replay (benchmarking) ----------
+def _replay(path: str, speed: float, dry_run: bool):
+    subs = [r for r in iter_records(path) if r.get("state") == "submitted"]
+    if not subs:
+        print("no submitted jobs in", path)
+        return
+    from backend_main import submit_from_params
+    t0, base = time.monotonic(), subs[0]["ts"]
+    jobs = []
+    for r in subs:
+        delay = (r["ts"] - base) / speed - (time.monotonic() - t0)
+        if delay > 0:
+            time.sleep(delay)
+        p = r.get("params", {})
+        print(f"{time.monotonic() - t0:8.2f}s  {r.get('kind')}  {str(p.get('prompt') or p.get('user_input'))[:60]}")
+        if not dry_run:
+            jobs.append((time.monotonic(), submit_from_params(p)))
+    lat = []
+    for started, job in jobs:
+        try:
+            job.wait()
+        except Exception as e:
+            print("  failed:", job.id, e)
+        lat.append(time.monotonic() - started)
+    if lat:
+        lat.sort()
+        print(f"jobs={len(lat)}  p50={lat[len(lat) // 2]:.2f}s  max={lat[-1]:.2f}s")
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser()
+    ap.add_argument("command", choices=["replay"])
+    ap.add_argument("path")
+    ap.add_argument("--speed", type=float, default=1.0, help="time compression factor")
+    ap.add_argument("--dry-run", action="store_true")
+    a = ap.parse_args()
+    _replay(a.path, a.speed, a.dry_run)
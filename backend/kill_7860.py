@@ -1,7 +1,4 @@
 # kill_7860.py
-import psutil
-for p in psutil.process_iter(["pid", "connections"]):
-    for c in p.info["connections"]:
-        if c.laddr and c.laddr.port == 7860:
-            print("Killing PID", p.pid)
-            p.kill()
+import sd_supervisor
+for pid in sd_supervisor.kill_port(7860):
+    print("Killed process tree of PID", pid)
@@ -1,10 +1,19 @@
 # -----------------------------------------------
 # label.py   ——   GPT-4.1  + prompt 
 # -----------------------------------------------
-from openai import OpenAI 
+from openai import OpenAI, RateLimitError
 import requests
 from dotenv import load_dotenv
-import os, json, re
+import os, json, re, time, threading, collections
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from tag_builder import extract_tags_local, looks_like_tags
+from prompt_compiler import compile_prompt, CLIP_CHUNK_TOKENS
+from rate_limit import (limiter, call_with_limit, retry_after, priority,
+                        RateLimitExceeded, PRIORITY_BULK)
+import tracing
+
+# per-call network timeout for every provider (seconds)
+_REQUEST_TIMEOUT = float(os.getenv("PROMPT_REQUEST_TIMEOUT", "30"))
 
 
 def _get_key():
@@ -98,11 +107,15 @@ def extract_tags_cloudflare(user_input: str) -> dict:
     
     def run(model, inputs):
         input_data = { "messages": inputs }
-        response = requests.post(f"{api_base_url}{model}", headers=headers, json=input_data)
+        response = requests.post(f"{api_base_url}{model}", headers=headers, json=input_data,
+                                 timeout=_REQUEST_TIMEOUT)
+        limiter("cloudflare").observe_headers(response.headers)
+        if response.status_code == 429:
+            raise RateLimitExceeded("cloudflare", retry_after(response.headers))
         return response.json()
     
     try:
-        output = run("@cf/meta/llama-3-8b-instruct", inputs)
+        output = call_with_limit("cloudflare", lambda: run("@cf/meta/llama-3-8b-instruct", inputs))
         if "result" in output and "response" in output["result"]:
             raw = output["result"]["response"].strip()
             
@@ -114,6 +127,8 @@ def extract_tags_cloudflare(user_input: str) -> dict:
         else:
               raise RuntimeError(f"Cloudflare response format error: {output}")
             
+    except RateLimitExceeded:
+           raise
     except requests.exceptions.RequestException as e:
            raise RuntimeError(f"Cloudflare API request failed: {e}")
     except KeyError as e:
@@ -121,65 +136,23 @@ def extract_tags_cloudflare(user_input: str) -> dict:
     except Exception as e:
            raise RuntimeError(f"Cloudflare processing failed: {e}")
 
-def extract_tags_openai(user_input: str) -> dict:
-    """
-    returns a dictionary with keys "main_body", "background", and "foreground",
-    {
-        "main_body": [...],
-        "background": [...],
-        "foreground": [...]
-    }
-    """
-    client = OpenAI(api_key=_get_key())
-    '''
-    system_prompt = ("""**Role Description**  
-                You are a professional keyword-extraction specialist. 
-                Your task is to pull out image-generation keywords from the user's input. 
-                The output **must** follow the JSON schema exactly.
-
-                ---
-
-                ### Step-by-Step Workflow
-
-                1. **Input Check**  
-                - If the user is describing an image, proceed to the next steps.  
-                - Otherwise, output `null`.
-
-                2. **Main Subject Analysis**  
-                - Identify whether the subject is a *person* or an *object*.  
-                - Extract subject details (e.g., hair color, facial features, material, etc.).  
-                - List all subject attributes.
-
-                3. **Background Analysis**  
-                - Examine the background setting (e.g., meadow, forest, city skyline).  
-                - List every background element.
-
-                4. **Foreground Analysis**  
-                - Examine foreground effects (e.g., flames, lightning, particles).  
-                - List every foreground element.
-
-                5. **Output**  
-                - Collate all extracted keywords.  
-                - Return them in the required JSON format.
-
-                ---
-
-                ### Output Format (strictly enforced)
-
-                ```json
-                {
-                  "main_body": ["subject element 1", "subject element 2"],
-                  "background": ["background element 1", "background element 2"],
-                  "foreground": ["foreground element 1", "foreground element 2"]
-                }
-                ```
-
-                ### Notes
-                1. Focus solely on the classification task above.
-                2. For any unrelated user query, output null.
-                """)
-    '''
-    system_prompt = (
+def _openai_chat(client: OpenAI, messages: list, max_tokens: int, **kwargs):
+    """chat.completions.create under the shared "openai" limiter."""
+    def call():
+        try:
+            raw = client.chat.completions.with_raw_response.create(
+                model="gpt-4.1", messages=messages, temperature=0.2,
+                max_tokens=max_tokens, **kwargs)
+        except RateLimitError as e:
+            headers = getattr(getattr(e, "response", None), "headers", None)
+            raise RateLimitExceeded("openai", retry_after(headers), str(e))
+        limiter("openai").observe_headers(raw.headers)
+        return raw.parse()
+    # ~4 characters per token for the prompt, plus the completion budget
+    est = sum(len(m["content"]) for m in messages) // 4 + max_tokens
+    return call_with_limit("openai", call, tokens=est)
+
+_OPENAI_SYSTEM_PROMPT = (
     """**Role Description**
     You are a professional prompt-engineering assistant for *Stable Diffusion*.
     Your job is to convert the user's natural-language description into an
@@ -244,14 +217,73 @@ def extract_tags_openai(user_input: str) -> dict:
 
     For any unrelated user query, reply with null.
     """)
+
+def extract_tags_openai(user_input: str) -> dict:
+    """
+    returns a dictionary with keys "main_body", "background", and "foreground",
+    {
+        "main_body": [...],
+        "background": [...],
+        "foreground": [...]
+    }
+    """
+    client = OpenAI(api_key=_get_key(), timeout=_REQUEST_TIMEOUT, max_retries=0)
+    '''
+    system_prompt = ("""**Role Description**  
+                You are a professional keyword-extraction specialist. 
+                Your task is to pull out image-generation keywords from the user's input. 
+                The output **must** follow the JSON schema exactly.
+
+                ---
+
+                ### Step-by-Step Workflow
+
+                1. **Input Check**  
+                - If the user is describing an image, proceed to the next steps.  
+                - Otherwise, output `null`.
+
+                2. **Main Subject Analysis**  
+                - Identify whether the subject is a *person* or an *object*.  
+                - Extract subject details (e.g., hair color, facial features, material, etc.).  
+                - List all subject attributes.
+
+                3. **Background Analysis**  
+                - Examine the background setting (e.g., meadow, forest, city skyline).  
+                - List every background element.
+
+                4. **Foreground Analysis**  
+                - Examine foreground effects (e.g., flames, lightning, particles).  
+                - List every foreground element.
+
+                5. **Output**  
+                - Collate all extracted keywords.  
+                - Return them in the required JSON format.
+
+                ---
+
+                ### Output Format (strictly enforced)
+
+                ```json
+                {
+                  "main_body": ["subject element 1", "subject element 2"],
+                  "background": ["background element 1", "background element 2"],
+                  "foreground": ["foreground element 1", "foreground element 2"]
+                }
+                ```
+
+                ### Notes
+                1. Focus solely on the classification task above.
+                2. For any unrelated user query, output null.
+                """)
+    '''
+    system_prompt = _OPENAI_SYSTEM_PROMPT
     
-    resp = client.chat.completions.create(
-        model="gpt-4.1",
+    resp = _openai_chat(
+        client,
         messages=[
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_input}
         ],
-        temperature=0.2,
         max_tokens=512
     )
 
@@ -262,7 +294,48 @@ def extract_tags_openai(user_input: str) -> dict:
 
     return json.loads(match.group())
 
-def tags_to_prompt(tags: dict) -> str:
+_OPENAI_BATCH_SUFFIX = (
+    """
+    ---
+
+    ### Batch Mode
+    The user message is a JSON array of {"index": n, "text": "..."} items.
+    Apply the workflow above to every item independently and reply with ONE
+    JSON object, one entry per input index:
+    {"items": [{"index": n, "result": <output object as above, or null>}]}
+    """)
+
+def extract_tags_openai_packed(user_inputs: list[str]) -> list[dict | None]:
+    """
+    Extract tags for several descriptions in a single GPT call.
+    Returns one entry per input, None where the model skipped or mangled it.
+    """
+    client = OpenAI(api_key=_get_key(), timeout=_REQUEST_TIMEOUT * len(user_inputs),
+                    max_retries=0)
+    items = [{"index": i, "text": t} for i, t in enumerate(user_inputs)]
+    resp = _openai_chat(
+        client,
+        messages=[
+            {"role": "system", "content": _OPENAI_SYSTEM_PROMPT + _OPENAI_BATCH_SUFFIX},
+            {"role": "user", "content": json.dumps(items, ensure_ascii=False)}
+        ],
+        max_tokens=512 * len(user_inputs),
+        response_format={"type": "json_object"},
+    )
+
+    raw = resp.choices[0].message.content.strip()
+    match = re.search(r"\{.*\}", raw, re.S)
+    if not match:
+        raise ValueError("GPT-4 invalid batch JSON:\n" + raw)
+
+    out: list[dict | None] = [None] * len(user_inputs)
+    for item in json.loads(match.group()).get("items", []):
+        idx = item.get("index") if isinstance(item, dict) else None
+        if isinstance(idx, int) and 0 <= idx < len(out):
+            out[idx] = item.get("result")
+    return out
+
+def tags_to_prompt(tags: dict, *, max_chunks: int = 1) -> str:
     """
     Merge Stable Diffusion style prompt.
     
@@ -277,49 +350,249 @@ def tags_to_prompt(tags: dict) -> str:
     }
     
     Output: combined SD-style prompt string.
+
+    Keywords that repeat a term of sd_prompt are dropped, and the result is
+    trimmed to `max_chunks` CLIP chunks (75 tokens each) by removing the
+    lowest-priority terms first — see prompt_compiler.compile_prompt.
+    Without transformers' CLIP tokenizer the token counts are estimates.
+    """
+    return compile_prompt(tags.get("sd_prompt", "").strip(),
+                          tags.get("keywords", {}),
+                          max_tokens=max_chunks * CLIP_CHUNK_TOKENS)
+
+# ---------- provider latency stats & hedging ----------
+_HEDGE_PRIMARY = os.getenv("PROMPT_HEDGE_PRIMARY", "cloudflare")
+_HEDGE_SECONDARY = os.getenv("PROMPT_HEDGE_SECONDARY", "openai")
+_HEDGE_DEFAULT_DELAY = 1.5         # used until a provider has enough samples
+_HEDGE_MIN_DELAY = 0.25
+_HEDGE_MAX_DELAY = 8.0
+_HEDGE_MIN_SAMPLES = 10
+
+class _LatencyStats:
+    """Rolling window of call latencies (seconds) and failures for one provider."""
+
+    def __init__(self, size: int = 256):
+        self._lat = collections.deque(maxlen=size)
+        self._fail = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, ok: bool = True):
+        with self._lock:
+            if ok:
+                self._lat.append(seconds)
+            self._fail.append(0 if ok else 1)
+
+    def quantile(self, q: float) -> float | None:
+        with self._lock:
+            if len(self._lat) < _HEDGE_MIN_SAMPLES:
+                return None
+            xs = sorted(self._lat)
+        return xs[min(len(xs) - 1, int(q * len(xs)))]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            n, fails = len(self._lat), sum(self._fail)
+            calls = len(self._fail)
+        return {
+            "samples": n,
+            "p50": self.quantile(0.50),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "error_rate": fails / calls if calls else 0.0,
+        }
+
+_PROVIDERS = {
+    "openai": extract_tags_openai,
+    "cloudflare": extract_tags_cloudflare,
+}
+_STATS = {name: _LatencyStats() for name in _PROVIDERS}
+_hedge_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="prompt-hedge")
+
+def provider_stats() -> dict:
+    """Latency quantiles and error rate per provider, as seen by this process."""
+    return {name: st.snapshot() for name, st in _STATS.items()}
+
+def _valid_tags(data) -> bool:
+    """A usable answer has a non-empty sd_prompt and (optionally) a keywords dict."""
+    return (isinstance(data, dict)
+            and isinstance(data.get("sd_prompt"), str)
+            and bool(data["sd_prompt"].strip())
+            and isinstance(data.get("keywords", {}), dict))
+
+def _timed_call(provider: str, user_input: str) -> dict:
+    t0 = time.monotonic()
+    try:
+        with tracing.span(f"llm.{provider}", chars=len(user_input)):
+            data = _PROVIDERS[provider](user_input)
+    except Exception:
+        _STATS[provider].record(time.monotonic() - t0, ok=False)
+        raise
+    _STATS[provider].record(time.monotonic() - t0, ok=_valid_tags(data))
+    return data
+
+def _hedge_delay(provider: str) -> float:
+    """Fire the hedge once the primary is slower than its own p95."""
+    p95 = _STATS[provider].quantile(0.95)
+    if p95 is None:
+        return _HEDGE_DEFAULT_DELAY
+    return min(_HEDGE_MAX_DELAY, max(_HEDGE_MIN_DELAY, p95))
+
+def extract_tags_hedged(
+    user_input: str,
+    primary: str | None = None,
+    secondary: str | None = None,
+    *,
+    hedge_delay: float | None = None,
+) -> dict:
+    """
+    Send the request to `primary`; if it has not answered after `hedge_delay`
+    seconds (default: the primary's running p95), or it fails / returns an
+    invalid answer, also ask `secondary`. The first valid answer wins.
+
+    The losing call is cancelled if it has not started yet; a call already on
+    the wire is abandoned (its result is discarded, its latency still feeds
+    the stats).
     """
-    # Original sd_prompt (may include weights and modifiers)
-    sd_prompt = tags.get("sd_prompt", "").strip()
-
-    # Parts from keywords
-    keywords = []
-    for key in ["main_body", "background", "foreground"]:
-        keywords.extend(tags.get("keywords", {}).get(key, []))
-
-    # Clean whitespace and deduplicate while preserving order
-    keywords_cleaned = []
-    seen = set()
-    for kw in keywords:
-        kw_stripped = kw.strip()
-        if kw_stripped and kw_stripped not in seen:
-            keywords_cleaned.append(kw_stripped)
-            seen.add(kw_stripped)
-
-    # Merge: keep sd_prompt first, then append keywords (avoid duplicates)
-    if sd_prompt:
-        prompt_parts = [sd_prompt] + keywords_cleaned
-    else:
-        prompt_parts = keywords_cleaned
-
-    return ", ".join(prompt_parts)
-
-def extract_tags(user_input: str, provider: str = "openai") -> dict:
+    primary = (primary or _HEDGE_PRIMARY).lower()
+    secondary = (secondary or _HEDGE_SECONDARY).lower()
+    for name in (primary, secondary):
+        if name not in _PROVIDERS:
+            raise ValueError(f"Unsupported provider: {name}")
+    delay = hedge_delay if hedge_delay is not None else _hedge_delay(primary)
+
+    pending = {_hedge_pool.submit(tracing.bind(_timed_call), primary, user_input): primary}
+    hedged = primary == secondary
+    errors = []
+    deadline = time.monotonic() + delay + 2 * _REQUEST_TIMEOUT
+
+    def fire_hedge():
+        nonlocal hedged
+        if not hedged:
+            hedged = True
+            pending[_hedge_pool.submit(tracing.bind(_timed_call), secondary, user_input)] = secondary
+
+    while pending:
+        timeout = delay if not hedged else max(0.0, deadline - time.monotonic())
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            if hedged:
+                break
+            fire_hedge()
+            continue
+        for fut in done:
+            name = pending.pop(fut)
+            try:
+                data = fut.result()
+            except Exception as e:
+                errors.append(f"{name}: {e}")
+                fire_hedge()
+                continue
+            if _valid_tags(data):
+                for other in pending:
+                    other.cancel()
+                return data
+            errors.append(f"{name}: invalid answer {data!r}")
+            fire_hedge()
+
+    if not errors:
+        errors.append(f"no answer within {delay + 2 * _REQUEST_TIMEOUT:.1f}s")
+    raise RuntimeError("All prompt providers failed: " + "; ".join(errors))
+
+def extract_tags(user_input: str, provider: str = "openai", *, fast_path: bool | None = None) -> dict:
     """
     Unified Interface
     
     Args:
         user_input: description
-        provider: "openai" or "cloudflare"
+        provider: "openai", "cloudflare", "auto" (hedged across both,
+                  see extract_tags_hedged) or "local" (offline, tag_builder)
+        fast_path: answer tag-style input ("1girl, silver hair, classroom")
+                   locally without a network call. Defaults to True for
+                   "auto" and False for an explicitly named provider.
     
     Returns:
         dict with sd_prompt and keywords
     """
-    if provider.lower() == "openai":
-        return extract_tags_openai(user_input)
-    elif provider.lower() == "cloudflare":
-        return extract_tags_cloudflare(user_input)
-    else:
-        raise ValueError(f"Unsupported provider: {provider}, please select 'openai' or 'cloudflare'")
+    p = provider.lower()
+    with tracing.span("label.extract_tags", provider=p) as span_args:
+        if p == "local":
+            return extract_tags_local(user_input)
+        if fast_path is None:
+            fast_path = p == "auto"
+        if fast_path and looks_like_tags(user_input):
+            span_args["fast_path"] = True
+            return extract_tags_local(user_input)
+        if p == "auto":
+            return extract_tags_hedged(user_input)
+        if p in _PROVIDERS:
+            return _timed_call(p, user_input)
+    raise ValueError(f"Unsupported provider: {provider}, please select 'openai', 'cloudflare', 'auto' or 'local'")
+
+
+# ---------- batch extraction ----------
+_BATCH_PACK_SIZE = 8            # descriptions per packed LLM call
+_BATCH_CONCURRENCY = 4          # concurrent provider calls per batch
+_PACKED_PROVIDERS = {"openai": extract_tags_openai_packed}
+
+def extract_tags_batch(
+    user_inputs: list[str],
+    provider: str = "openai",
+    *,
+    pack_size: int = _BATCH_PACK_SIZE,
+    max_concurrency: int = _BATCH_CONCURRENCY,
+) -> list[dict]:
+    """
+    Extract tags for many descriptions.
+
+    Providers that can answer several items per call ("openai") get packs of
+    `pack_size`; every other provider gets one call per item. Either way at
+    most `max_concurrency` calls are in flight. Items the pack answered badly
+    are retried one by one.
+
+    Returns one dict per input, in input order: the usual {sd_prompt, keywords}
+    result, or {"error": "..."} for an item that failed. A failing item never
+    fails the batch.
+    """
+    p = provider.lower()
+    results: list[dict | None] = [None] * len(user_inputs)
+    todo = []
+    for i, text in enumerate(user_inputs):
+        text = (text or "").strip()
+        if not text:
+            results[i] = {"error": "user_input cannot be empty"}
+        elif p == "local" or (p == "auto" and looks_like_tags(text)):
+            results[i] = extract_tags_local(text)
+        else:
+            todo.append((i, text))
+
+    def run_single(i, text):
+        try:
+            with priority(PRIORITY_BULK):
+                results[i] = extract_tags(text, p, fast_path=False)
+        except Exception as e:
+            results[i] = {"error": str(e)}
+
+    def run_pack(pack):
+        try:
+            with priority(PRIORITY_BULK):
+                answers = _PACKED_PROVIDERS[p]([t for _, t in pack])
+        except Exception:
+            answers = [None] * len(pack)
+        for (i, text), data in zip(pack, answers):
+            if _valid_tags(data):
+                results[i] = data
+            else:
+                run_single(i, text)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency),
+                            thread_name_prefix="prompt-batch") as pool:
+        if p in _PACKED_PROVIDERS and pack_size > 1:
+            packs = [todo[k:k + pack_size] for k in range(0, len(todo), pack_size)]
+            list(pool.map(run_pack, packs))
+        else:
+            list(pool.map(lambda item: run_single(*item), todo))
+
+    return results
 
 
 if __name__ == "__main__":
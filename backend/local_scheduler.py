@@ -0,0 +1,191 @@
+# -----------------------------------------------
+# local_scheduler.py  ——  priority classes + preemption for local renders
+# -----------------------------------------------
+"""
+The WebUI renders one request at a time, so local renders are admitted one
+at a time here, by priority class instead of arrival order:
+
+    urls = local_scheduler.run(render, priority="interactive")
+
+Classes are rate_limit's: interactive (0) < normal (1) < bulk (2); lower
+runs first, FIFO within a class. render(ticket) may be called more than
+once and should poll ticket.stop_requested between expensive steps.
+
+Preemption: an arrival of a strictly higher class interrupts the running
+render (/sdapi/v1/interrupt), throws away its partial output (discard) and
+requeues it ahead of its class. Callers pin the seed before run(), so the
+requeued render produces the same image.
+
+Starvation protection:
+  - a waiting ticket gains one class per LOCAL_SCHED_AGING_S seconds
+    (default 120), so an overnight bulk queue still moves;
+  - a render is preempted at most LOCAL_SCHED_MAX_PREEMPT times (default 2)
+    and never by a class it has aged into.
+
+status() reports queue depth, wait times per class and preemption cost
+(render seconds thrown away).
+"""
+
+import os, time, threading, itertools
+from rate_limit import PRIORITIES, PRIORITY_INTERACTIVE, PRIORITY_NORMAL
+from local_sd import interrupt
+import tracing
+
+AGING_S = float(os.getenv("LOCAL_SCHED_AGING_S", "120"))
+MAX_PREEMPT = int(os.getenv("LOCAL_SCHED_MAX_PREEMPT", "2"))
+_NAMES = {v: k for k, v in PRIORITIES.items()}
+
+class Cancelled(Exception):
+    """The ticket was cancelled before its render finished."""
+
+class Ticket:
+    def __init__(self, priority=None, label: str = ""):
+        self.priority = parse_priority(priority)
+        self.label = label
+        self.seq = next(_seq)
+        self.arrived = time.monotonic()
+        self.started: float | None = None
+        self.run_class = priority           # effective class when it started running
+        self.preemptions = 0
+        self.preempted = False
+        self.cancelled = False
+
+    def effective(self, now: float) -> int:
+        if AGING_S <= 0:
+            return self.priority
+        return max(PRIORITY_INTERACTIVE, self.priority - int((now - self.arrived) // AGING_S))
+
+    @property
+    def stop_requested(self) -> bool:
+        return self.preempted or self.cancelled
+
+    def cancel(self):
+        """Leave the queue, or interrupt the render if it is running."""
+        with _cv:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            if _running is self:
+                interrupt()             # under the lock: the next render cannot start yet
+            _cv.notify_all()
+
+_seq = itertools.count()
+_cv = threading.Condition()
+_queue: list[Ticket] = []
+_running: Ticket | None = None
+
+def _class_stats() -> dict:
+    return {"submitted": 0, "started": 0, "completed": 0, "wait_s": 0.0, "max_wait_s": 0.0}
+
+stats = {"classes": {name: _class_stats() for name in PRIORITIES},
+         "preemptions": 0, "wasted_s": 0.0, "cancelled": 0}
+
+def parse_priority(priority) -> int:
+    """None → normal; "interactive" / "normal" / "bulk" or the rate_limit int."""
+    if priority is None:
+        return PRIORITY_NORMAL
+    if isinstance(priority, str):
+        if priority.lower() not in PRIORITIES:
+            raise ValueError(f"unknown priority: {priority} (use {', '.join(PRIORITIES)})")
+        return PRIORITIES[priority.lower()]
+    return int(priority)
+
+def _head(now: float) -> Ticket | None:
+    # requeued (preempted) tickets keep their seq, so they go first within a class
+    return min(_queue, key=lambda t: (t.effective(now), t.seq), default=None)
+
+def _maybe_preempt(t: Ticket, now: float) -> bool:
+    r = _running
+    if r is None or r.preempted or r.cancelled or r.preemptions >= MAX_PREEMPT:
+        return False
+    if t.effective(now) >= r.run_class:
+        return False
+    r.preempted = True
+    r.preemptions += 1
+    stats["preemptions"] += 1
+    # under the lock: r cannot hand over the WebUI to the next render before
+    # the interrupt lands (A1111 resets the flag when a new render begins)
+    interrupt()
+    return True
+
+def run(render, *, priority=None, ticket: Ticket | None = None, discard=None,
+        label: str = ""):
+    """
+    render(ticket) under the scheduler; returns its result. Pass a Ticket
+    made beforehand to cancel() it from another thread. discard(result)
+    cleans up the output of a preempted or cancelled run.
+    """
+    global _running
+    t = ticket or Ticket(priority, label)
+    cls = stats["classes"][_NAMES.get(t.priority, "normal")]
+    with _cv:
+        cls["submitted"] += 1
+    while True:
+        with tracing.span("local_sched.wait", priority=t.priority, requeued=t.preemptions):
+            with _cv:
+                _queue.append(t)
+                _maybe_preempt(t, time.monotonic())
+                try:
+                    while True:
+                        if t.cancelled:
+                            stats["cancelled"] += 1
+                            raise Cancelled(t.label)
+                        now = time.monotonic()
+                        if _running is None and _head(now) is t:
+                            break
+                        _cv.wait(timeout=min(5.0, AGING_S) if AGING_S > 0 else 5.0)
+                finally:
+                    _queue.remove(t)
+                if t.started is None:
+                    cls["started"] += 1
+                    waited = now - t.arrived
+                    cls["wait_s"] += waited
+                    cls["max_wait_s"] = max(cls["max_wait_s"], waited)
+                t.started, t.run_class, t.preempted = now, t.effective(now), False
+                _running = t
+        result, error = None, None
+        try:
+            result = render(t)
+        except Exception as e:
+            error = e
+        with _cv:
+            _running = None
+            elapsed = time.monotonic() - t.started
+            stop = t.stop_requested
+            if t.preempted:
+                stats["wasted_s"] += elapsed
+            _cv.notify_all()
+        if stop:
+            if discard is not None and result is not None:
+                try:
+                    discard(result)
+                except Exception:
+                    pass
+            if t.cancelled:
+                with _cv:
+                    stats["cancelled"] += 1
+                raise Cancelled(t.label)
+            continue                        # preempted: requeue, same seq
+        if error is not None:
+            raise error
+        with _cv:
+            cls["completed"] += 1
+        return result
+
+def status() -> dict:
+    now = time.monotonic()
+    with _cv:
+        queued = {name: 0 for name in PRIORITIES}
+        for t in _queue:
+            queued[_NAMES.get(t.priority, "normal")] += 1
+        r = _running
+        running = None if r is None else {
+            "priority": _NAMES.get(r.priority, r.priority), "label": r.label,
+            "running_s": round(now - r.started, 1), "preemptions": r.preemptions}
+        classes = {k: {**v, "wait_s": round(v["wait_s"], 2),
+                       "mean_wait_s": round(v["wait_s"] / v["started"], 2) if v["started"] else None,
+                       "max_wait_s": round(v["max_wait_s"], 2)}
+                   for k, v in stats["classes"].items()}
+        return {"running": running, "queued": queued, "classes": classes,
+                "preemptions": stats["preemptions"], "wasted_s": round(stats["wasted_s"], 1),
+                "cancelled": stats["cancelled"]}
@@ -4,7 +4,8 @@
 """
 Features
 1. start_server()       start Automatic1111 WebUI (skips if already running)
-2. shutdown_server()    stop WebUI via REST / port-kill
+   calibrate_threads()  measure s/step per CPU thread count, remember the best
+2. shutdown_server()    stop WebUI via REST / process tree (sd_supervisor)
 3. generate_image()     call /sdapi/v1/txt2img  (no longer changes model)
 
 Checkpoint selection is now handled **outside** this module via:
@@ -13,8 +14,9 @@ Checkpoint selection is now handled **outside** this module via:
 Default presets are tuned for SD-1.5 on CPU; SD-XL works but will be slower.
 """
 
-import os, re, subprocess, time, requests, psutil, shutil, sys, webbrowser
+import os, re, subprocess, time, requests, sys, webbrowser
 from pathlib import Path
+import sd_supervisor, sd_launcher, sd_tiles, sd_checkpoints, postprocess, tracing
 _PRESETS: dict[str, dict] = {
     "fast": {
         "steps": 20,
@@ -50,7 +52,7 @@ _PRESETS: dict[str, dict] = {
     },
 }
 # ───────────── paths & server conf ──────────────
-ROOT = Path(__file__).resolve().parent / "stable-diffusion-webui"
+ROOT = sd_launcher.ROOT
 HOST = os.getenv("LOCAL_SD_HOST", "http://127.0.0.1:7860")
 PORT = int(HOST.split(":")[-1])
 
@@ -58,44 +60,55 @@ PORT = int(HOST.split(":")[-1])
 def _server_running() -> bool:
     """Return True if /sdapi endpoint responds."""
     try:
-        requests.get(f"{HOST}/sdapi/v1/sd-models", timeout=2)
+        with tracing.span("local_sd.readiness_probe"):
+            requests.get(f"{HOST}/sdapi/v1/sd-models", timeout=2)
         return True
     except requests.exceptions.RequestException:
         return False
 
 _proc: subprocess.Popen | None = None       # global handle
 
-def start_server(model_path: str | None = None):
-    """Launch WebUI if not already running."""
+def start_server(model_path: str | None = None, *, threads: int | None = None,
+                 cpus: list[int] | str | None = None, checkpoint: str | None = None):
+    """
+    Launch WebUI if not already running (flags from sd_launcher's hardware probe).
+
+    threads:    OpenMP / MKL / torch intra-op threads (default: the value
+                calibrated for `checkpoint`, else one per physical core; see
+                sd_launcher.cpu_policy)
+    cpus:       pin the WebUI to these cores, e.g. [0, 1, 2, 3] or "0-3"
+    checkpoint: the checkpoint about to be loaded (default: model_path's file)
+    """
     global _proc
     if _server_running():
+        if not _cache_ready:
+            _configure_cache()
         return
-    if not ROOT.exists():
-        raise RuntimeError(f"WebUI dir not found: {ROOT}")
-
-    cmd = [sys.executable, "launch.py",
-           "--api", "--listen", "--port", str(PORT),
-           "--precision", "full", "--no-half", "--skip-torch-cuda-test"]
-    if model_path:
-        cmd += ["--ckpt", model_path]
-    if _detect_cuda():
-        cmd += ["--xformers", "--medvram"]
-
-    _proc = subprocess.Popen(cmd, cwd=ROOT)
+    if checkpoint is None and model_path:
+        checkpoint = Path(model_path).name
+    _proc = sd_launcher.launch(PORT, model_path, threads=threads, cpus=cpus,
+                               checkpoint=sd_checkpoints.key(checkpoint))
     _wait_ready()
+    _configure_cache()
 
-def _wait_ready(timeout: int = 90):
-    """Block until WebUI is responsive or timeout."""
-    for _ in range(timeout):
-        if _server_running():
-            print(f"🚀 Local SD ready on {HOST}")
-            return
-        time.sleep(1)
-    raise TimeoutError("WebUI failed to start within timeout")
+_cache_ready = False
+
+def _configure_cache():
+    """Size the WebUI's checkpoint cache and learn which checkpoint it loaded."""
+    global _loaded_model, _cache_ready
+    try:
+        _loaded_model = sd_checkpoints.cache.configure(HOST)
+        _cache_ready = True
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"[local_sd] checkpoint cache not configured: {e}")
+
+def _wait_ready(timeout: int = 300):
+    """Block until WebUI is responsive (follows its log) or timeout."""
+    sd_launcher.wait_ready(_proc, HOST, timeout)
 
 def _detect_cuda() -> bool:
-    """Simple check for NVIDIA GPU via nvidia-smi."""
-    return shutil.which("nvidia-smi") is not None
+    """NVIDIA GPU present (cached nvidia-smi probe, no torch import)."""
+    return sd_launcher.has_cuda()
 
 # ---------- 2. txt2img -------------------------- 
 def generate_image(
@@ -115,6 +128,10 @@ def generate_image(
     hr_upscaler: str | None = None,
     denoising_strength: float | None = None,
     hr_second_pass_steps: int | None = None,
+    hr_resize_x: int | None = None,            # exact hires target (overrides hr_scale)
+    hr_resize_y: int | None = None,
+    tiled: bool | None = None,                 # None: auto above sd_tiles.THRESHOLD_PX
+    should_stop=None,                          # () -> bool: give up (local_scheduler preemption)
 ) -> list[str]:
     """
     Generate images via local Stable Diffusion WebUI API.
@@ -126,25 +143,33 @@ def generate_image(
       can override preset values, but do not modify the presets themselves.
     - High-resolution options (enable_hr, hr_scale, etc.) follow the same rule:
       per-call overrides > preset values > default values.
+    - Outputs larger than sd_tiles.THRESHOLD_PX (size, or size × hr_scale
+      with hires on) are rendered tiled: small base image, upscale, img2img
+      refinement per overlapping tile (see sd_tiles.py). tiled=True/False
+      forces the mode. With hires on, the tiled base is the first pass
+      itself (size, steps, seed) and the tiles act as the second pass.
+    - should_stop() is checked before each WebUI call; when it turns True
+      the render raises Interrupted (pair it with interrupt()).
     - Returns a list of file paths pointing to locally saved PNG images.
     """
     start_server()                          # ensure the WebUI server is running
     w, h = _parse_size(size)
 
-    # ---------- get baseline from immutable presets ----------
-    base = _PRESETS.get(quality.lower(), _PRESETS["balanced"])
-
-    # basic parameters: caller overrides > preset
-    eff_steps = steps if steps is not None else base.get("steps")
-    eff_sampler = sampler_name if sampler_name is not None else base.get("sampler_name")
-    eff_cfg = cfg_scale if cfg_scale is not None else base.get("cfg_scale")
+    eff = effective_params(quality, steps=steps, sampler_name=sampler_name, cfg_scale=cfg_scale,
+                           enable_hr=enable_hr, hr_scale=hr_scale, hr_upscaler=hr_upscaler,
+                           denoising_strength=denoising_strength,
+                           hr_second_pass_steps=hr_second_pass_steps,
+                           hr_resize_x=hr_resize_x, hr_resize_y=hr_resize_y)
+    eff_steps, eff_sampler, eff_cfg = eff["steps"], eff["sampler_name"], eff["cfg_scale"]
+    eff_enable_hr, eff_hr_scale, eff_hr_upscaler = eff["enable_hr"], eff["hr_scale"], eff["hr_upscaler"]
+    eff_denoise, eff_hr_steps = eff["denoising_strength"], eff["hr_second_pass_steps"]
 
-    # high-resolution parameters: caller overrides > preset > defaults
-    eff_enable_hr = enable_hr if enable_hr is not None else base.get("enable_hr", False)
-    eff_hr_scale = hr_scale if hr_scale is not None else base.get("hr_scale", 1.5)
-    eff_hr_upscaler = hr_upscaler if hr_upscaler is not None else base.get("hr_upscaler", "R-ESRGAN 4x+")
-    eff_denoise = denoising_strength if denoising_strength is not None else base.get("denoising_strength", 0.4)
-    eff_hr_steps = hr_second_pass_steps if hr_second_pass_steps is not None else base.get("hr_second_pass_steps", 12)
+    out_w, out_h = output_size(size, eff)
+    if uses_tiles(size, eff, tiled):
+        return sd_tiles.generate_tiled(prompt, out_w, out_h, params=eff, host=HOST, n=n,
+                                       negative_prompt=negative_prompt, seed=seed,
+                                       checkpoint=_loaded_model, should_stop=should_stop,
+                                       first_pass=(w, h) if eff_enable_hr else None)
 
     payload = {
         "prompt": prompt,
@@ -168,10 +193,16 @@ def generate_image(
             "denoising_strength": eff_denoise,
             "hr_second_pass_steps": eff_hr_steps,
         })
+        if eff["hr_resize_x"] or eff["hr_resize_y"]:
+            payload.update(hr_resize_x=eff["hr_resize_x"], hr_resize_y=eff["hr_resize_y"])
 
     # ---- retry loop: handle 404 if API not yet ready ----
     for _ in range(5):
-        r = requests.post(f"{HOST}/sdapi/v1/txt2img", json=payload, timeout=600)
+        if should_stop is not None and should_stop():
+            raise Interrupted("render stopped before txt2img")
+        with tracing.span("local_sd.txt2img_http", width=w, height=h, steps=eff_steps, n=n,
+                          hires=bool(eff_enable_hr)):
+            r = requests.post(f"{HOST}/sdapi/v1/txt2img", json=payload, timeout=600)
         if r.status_code == 404:            # API not ready yet
             time.sleep(1)
             continue
@@ -183,6 +214,44 @@ def generate_image(
 
 
 # ---------- helpers -----------------------------
+def output_size(size: str, eff: dict) -> tuple[int, int]:
+    """Final image size: size, or size × hr_scale (hr_resize_x/y if set) with hires fix on."""
+    w, h = _parse_size(size)
+    if not eff.get("enable_hr"):
+        return w, h
+    rx, ry = eff.get("hr_resize_x") or 0, eff.get("hr_resize_y") or 0
+    if rx or ry:                            # as A1111: a 0 side follows the aspect ratio
+        return rx or int(ry * w / h) // 8 * 8, ry or int(rx * h / w) // 8 * 8
+    return int(w * eff["hr_scale"]) // 8 * 8, int(h * eff["hr_scale"]) // 8 * 8
+
+def uses_tiles(size: str, eff: dict, tiled: bool | None = None) -> bool:
+    if tiled is not None:
+        return tiled
+    w, h = output_size(size, eff)
+    return w * h > sd_tiles.THRESHOLD_PX
+
+def effective_params(quality: str = "balanced", **overrides) -> dict:
+    """
+    Preset `quality` with every non-None override applied: exactly the
+    sampling / hires settings generate_image() sends.
+    Caller overrides > preset values > defaults; presets are not modified.
+    """
+    base = _PRESETS.get(quality.lower(), _PRESETS["balanced"])
+    eff = {
+        "steps": base.get("steps"),
+        "sampler_name": base.get("sampler_name"),
+        "cfg_scale": base.get("cfg_scale"),
+        "enable_hr": base.get("enable_hr", False),
+        "hr_scale": base.get("hr_scale", 1.5),
+        "hr_upscaler": base.get("hr_upscaler", "R-ESRGAN 4x+"),
+        "denoising_strength": base.get("denoising_strength", 0.4),
+        "hr_second_pass_steps": base.get("hr_second_pass_steps", 12),
+        "hr_resize_x": base.get("hr_resize_x", 0),
+        "hr_resize_y": base.get("hr_resize_y", 0),
+    }
+    eff.update({k: v for k, v in overrides.items() if v is not None and k in eff})
+    return eff
+
 def _parse_size(sz: str) -> tuple[int, int]:
     m = re.match(r"\s*(\d+)[xX](\d+)\s*$", sz)
     if not m:
@@ -190,40 +259,118 @@ def _parse_size(sz: str) -> tuple[int, int]:
     return int(m.group(1)), int(m.group(2))
 
 def _save_images(b64_list: list[str]) -> list[str]:
-    """Decode base64 strings → PNG files under ./outputs/"""
-    import base64, datetime
+    """Decode base64 strings → PNG files under ./outputs/ (postprocess pool)"""
+    import datetime
     out_dir = Path("outputs")
     out_dir.mkdir(exist_ok=True)
     ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    paths = []
-    for i, b in enumerate(b64_list):
-        p = out_dir / f"local_{ts}_{i}.png"
-        p.write_bytes(base64.b64decode(b))
-        paths.append(str(p.resolve()))
-    return paths
+    paths = [str((out_dir / f"local_{ts}_{i}.png").resolve()) for i in range(len(b64_list))]
+    with tracing.span("local_sd.postprocess", n=len(b64_list),
+                      chars=sum(map(len, b64_list))):
+        saved = postprocess.save_b64_images(b64_list, paths)
+    return [s["path"] for s in saved]
 
-# ---------- 3. shutdown -------------------------
-def shutdown_server():
-    """Try REST /shutdown first; if still alive, kill by port."""
+# ---------- CPU thread calibration -------------
+def calibrate_threads(checkpoint: str | None = None, size: str = "512x512", *,
+                      steps: int = 6, candidates: list[int] | None = None,
+                      cpus: list[int] | str | None = None) -> dict:
+    """
+    Restart the WebUI once per candidate thread count (threads are fixed at
+    process start), time a short txt2img on `checkpoint` (default: the one
+    loaded) at `size`, and store the fastest count for start_server() to use
+    with that checkpoint. Returns the timings. The WebUI is back in its
+    previous state (running or not, same checkpoint) afterwards, also on error.
+
+    Restarts the WebUI under any render in flight: call it through
+    backend_main.calibrate_local_threads, which holds the scheduler slot.
+    """
+    was_running, prev_model = _server_running(), _loaded_model
+    w, h = _parse_size(size)
+    payload = {"prompt": "calibration", "width": w, "height": h, "seed": 1,
+               "sampler_name": "Euler a", "cfg_scale": 7, "batch_size": 1,
+               "save_images": False, "send_images": False}
+    timings: dict[int, float] = {}
+    best = None
     try:
-        requests.post(f"{HOST}/shutdown", timeout=2)
+        for t in candidates or sd_launcher.thread_candidates():
+            shutdown_server()
+            start_server(threads=t, cpus=cpus)
+            if checkpoint or prev_model:
+                _switch_model(checkpoint or prev_model)
+            # warm-up: first call pays for weight loading / kernel selection
+            requests.post(f"{HOST}/sdapi/v1/txt2img", json={**payload, "steps": 1},
+                          timeout=600).raise_for_status()
+            t0 = time.monotonic()
+            requests.post(f"{HOST}/sdapi/v1/txt2img", json={**payload, "steps": steps},
+                          timeout=600).raise_for_status()
+            timings[t] = round((time.monotonic() - t0) / steps, 3)
+            print(f"  threads={t:>3}  {timings[t]:.3f} s/step")
+        best = min(timings, key=timings.get)
+        sd_launcher.save_calibration(sd_checkpoints.key(_loaded_model), size, best, timings)
+    finally:
+        shutdown_server()
+        if was_running:
+            start_server(threads=best, cpus=cpus, checkpoint=prev_model)
+            if prev_model:
+                _switch_model(prev_model)
+    return {"threads": best, "s_per_step": timings}
+
+def progress(preview: bool = True) -> dict:
+    """WebUI progress (0–1), ETA and, if asked, the live preview as PNG bytes."""
+    import base64
+    r = requests.get(f"{HOST}/sdapi/v1/progress",
+                     params={"skip_current_image": "false" if preview else "true"}, timeout=10)
+    r.raise_for_status()
+    p = r.json()
+    img = p.get("current_image")
+    return {"progress": p.get("progress", 0.0), "eta_s": p.get("eta_relative"),
+            "state": p.get("state") or {},
+            "preview": base64.b64decode(img) if img else None}
+
+class Interrupted(RuntimeError):
+    """generate_image(should_stop=...) gave up part-way."""
+
+def interrupt():
+    """Abort the WebUI's current generation (best effort)."""
+    try:
+        requests.post(f"{HOST}/sdapi/v1/interrupt", timeout=5)
     except requests.exceptions.RequestException:
         pass
-    time.sleep(3)
-    for p in psutil.process_iter(["pid", "connections"]):
-        for c in p.info["connections"]:
-            if c.laddr and c.laddr.port == PORT:
-                p.kill()
+
+# ---------- 3. shutdown -------------------------
+def shutdown_server() -> str:
+    """REST /shutdown, then our process tree, then (last resort) whoever holds the port."""
+    global _proc, _loaded_model, _cache_ready
+    how = sd_supervisor.stop(_proc, PORT, host=HOST)
+    _proc, _loaded_model, _cache_ready = None, None, False
+    sd_checkpoints.cache.reset()
+    return how
 
 # ---------- helper: hot-swap checkpoint ----------
+_loaded_model: str | None = None            # checkpoint the WebUI has loaded (as far as we know)
+
+def current_model() -> str | None:
+    return _loaded_model
+
 def _switch_model(model_name: str, timeout: int = 90):
-    """Internal helper to change checkpoint (used by backend_main)."""
+    """Internal helper to change checkpoint (used by backend_main).
+    No-op when it is already loaded; resident ones (sd_checkpoints) are fast."""
+    if sd_checkpoints.key(model_name) == sd_checkpoints.key(_loaded_model):
+        return
+    with tracing.span("local_sd.switch_model", model=model_name,
+                      resident=sd_checkpoints.cache.is_resident(model_name)):
+        sd_checkpoints.cache.switch(model_name, HOST,
+                                    lambda name: _switch_model_wait(name, timeout))
+
+def _switch_model_wait(model_name: str, timeout: int):
+    global _loaded_model
     requests.post(f"{HOST}/sdapi/v1/options",
                   json={"sd_model_checkpoint": model_name},
                   timeout=10)
     for _ in range(timeout):
         p = requests.get(f"{HOST}/sdapi/v1/progress?skip_current_image=true", timeout=10).json()
         if not p.get("state", {}).get("job_count", 0):
+            _loaded_model = model_name
             return
         time.sleep(1)
     raise TimeoutError(f"Loading model '{model_name}' timed out")
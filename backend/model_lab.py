@@ -1,8 +1,10 @@
 # -----------------------------------------------
 # model_lab.py  ——  Unified format generate_image(prompt, n, size)
 # -----------------------------------------------
-import os, requests, json, re, webbrowser
+import os, requests, json, re, webbrowser, time, heapq, itertools, threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
 from dotenv import load_dotenv
+from rate_limit import limiter, call_with_limit, retry_after, RateLimitExceeded
 
 # ───────────────── API KEY ─────────────────────
 def _get_key() -> str:
@@ -12,24 +14,157 @@ def _get_key() -> str:
         raise RuntimeError("Please set MODELSLAB_API_KEY in .env")  
     return k
     
-def generate_image(
+def _post(url: str, payload: dict, timeout: float) -> dict:
+    """POST to ModelsLab, feeding the "modelslab" limiter; 429 → RateLimitExceeded."""
+    r = requests.post(url, json=payload, timeout=timeout)
+    limiter("modelslab").observe_headers(r.headers)
+    if r.status_code == 429:
+        raise RateLimitExceeded("modelslab", retry_after(r.headers))
+    data = r.json()
+    if data.get("status") == "error" and "rate limit" in str(data.get("message", "")).lower():
+        raise RateLimitExceeded("modelslab", None, str(data.get("message")))
+    return data
+
+# ───────────────── queued-job poller ──────────────
+_FETCH_URL = "https://modelslab.com/api/v6/realtime/fetch/{id}"
+_POLL_MIN_INTERVAL = 2.0      # seconds between fetches of one job
+_POLL_MAX_INTERVAL = 30.0
+_POLL_BACKOFF = 1.6
+_POLL_TIMEOUT = 600           # give up on a queued job after this long
+_POLL_WORKERS = int(os.getenv("MODELSLAB_POLL_WORKERS", "4"))   # concurrent fetches
+
+def _clean_urls(raw_urls: list[str]) -> list[str]:
+    return [u.replace("\\/", "/").replace("\\", "") for u in raw_urls]
+
+class _FetchPoller:
+    """
+    One daemon thread schedules every queued ModelsLab job; the fetches run
+    on a small pool (MODELSLAB_POLL_WORKERS), so one slow fetch does not
+    hold up the others.
+
+    Jobs sit in a heap ordered by their next due time; each fetch that is
+    still "processing" is rescheduled after the server's ETA (when given) or
+    an exponentially growing interval. A fetch never waits on the
+    "modelslab" limiter: if no slot is free it is re-queued after the
+    limiter's estimated wait. Results are delivered through the job's
+    Future; a cancelled Future is simply dropped.
+    """
+
+    def __init__(self):
+        self._heap: list = []
+        self._seq = itertools.count()
+        self._cv = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self._pool = ThreadPoolExecutor(max_workers=max(1, _POLL_WORKERS),
+                                        thread_name_prefix="modelslab-fetch")
+
+    def watch(self, fetch_url: str, eta: float | None = None) -> Future:
+        fut: Future = Future()
+        now = time.monotonic()
+        job = {
+            "url": fetch_url,
+            "future": fut,
+            "interval": _POLL_MIN_INTERVAL,
+            "deadline": now + _POLL_TIMEOUT,
+        }
+        self._push(now + self._delay(job, eta), job)
+        return fut
+
+    def pending(self) -> int:
+        with self._cv:
+            return len(self._heap)
+
+    def _push(self, due: float, job: dict):
+        with self._cv:
+            heapq.heappush(self._heap, (due, next(self._seq), job))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="modelslab-poller",
+                                                daemon=True)
+                self._thread.start()
+            self._cv.notify()
+
+    @staticmethod
+    def _delay(job: dict, eta) -> float:
+        try:
+            eta = float(eta)
+        except (TypeError, ValueError):
+            eta = None
+        if eta is not None and eta > 0:
+            delay = eta
+        else:
+            delay = job["interval"]
+            job["interval"] = min(_POLL_MAX_INTERVAL, job["interval"] * _POLL_BACKOFF)
+        return min(_POLL_MAX_INTERVAL, max(_POLL_MIN_INTERVAL, delay))
+
+    def _run(self):
+        while True:
+            with self._cv:
+                while not self._heap:
+                    if not self._cv.wait(timeout=60):
+                        self._thread = None
+                        return
+                due, _, job = self._heap[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self._cv.wait(timeout=wait)
+                    continue
+                heapq.heappop(self._heap)
+            self._pool.submit(self._poll, job)
+
+    def _poll(self, job: dict):
+        fut: Future = job["future"]
+        if fut.cancelled():
+            return
+        if time.monotonic() > job["deadline"]:
+            self._finish(fut, exc=TimeoutError(f"Modelslab job not ready: {job['url']}"))
+            return
+        wait = limiter("modelslab").try_acquire()
+        if wait > 0:                            # no slot: come back instead of blocking
+            self._push(time.monotonic() + wait, job)
+            return
+        try:
+            data = _post(job["url"], {"key": _get_key()}, timeout=15)
+        except RateLimitExceeded as e:
+            limiter("modelslab").backoff(e.retry_after or _POLL_MIN_INTERVAL)
+            self._push(time.monotonic() + self._delay(job, e.retry_after), job)
+            return
+        except (requests.exceptions.RequestException, ValueError):
+            self._push(time.monotonic() + self._delay(job, None), job)   # transient, retry
+            return
+
+        status = data.get("status")
+        if status == "success" and data.get("output"):
+            self._finish(fut, result=_clean_urls(data["output"]))
+        elif status in ("processing", "success"):
+            self._push(time.monotonic() + self._delay(job, data.get("eta")), job)
+        else:
+            self._finish(fut, exc=RuntimeError(
+                f"Modelslab error: {json.dumps(data, ensure_ascii=False)}"))
+
+    @staticmethod
+    def _finish(fut: Future, result=None, exc: BaseException | None = None):
+        if not fut.set_running_or_notify_cancel():
+            return                              # cancelled by the caller
+        if exc is not None:
+            fut.set_exception(exc)
+        else:
+            fut.set_result(result)
+
+_poller = _FetchPoller()
+
+# ───────────────── txt2img ─────────────────────
+def submit_image(
     prompt: str,
     n: int = 1,
     size: str = "1024x1024",
     *,
     negative_prompt: str = "bad quality",
     seed: int | None = None,
-) -> list[str]:
+) -> Future:
     """
-        Same signature as image.py:
-        prompt (str)       : Positive prompt
-        n (int)            : Number of images to generate, corresponds to Modelslab's samples
-        size (str)         : "widthxheight", e.g., "768x1024"
-        Optional keyword:
-            negative_prompt (str) : Negative prompt
-            seed (int|None)       : Random seed (None = random)
-        Returns:
-            list[str] : List of image URLs that can be directly accessed
+    Non-blocking variant of generate_image: returns a Future that resolves to
+    the list of image URLs. Jobs ModelsLab queues ("processing") are handed to
+    the shared poller; use `add_done_callback` for a completion event.
     """
     # ----------  size ----------
     m = re.match(r"^\s*(\d+)[xX](\d+)\s*$", size) # Matches "widthxheight" format
@@ -52,15 +187,49 @@ def generate_image(
         "webhook": None,
         "track_id": None,
     }
-    data = requests.post(url, json=payload, timeout=120).json()
+    data = call_with_limit("modelslab", lambda: _post(url, payload, timeout=120))
 
     # ---------- result ----------
-    if data.get("status") != "success":
-        raise RuntimeError(f"Modelslab error: {json.dumps(data, ensure_ascii=False)}")
+    status = data.get("status")
+    if status == "success":
+        fut: Future = Future()
+        fut.set_result(_clean_urls(data.get("output", [])))
+        return fut
+    if status == "processing":
+        fetch_url = data.get("fetch_result")
+        if not fetch_url and data.get("id") is not None:
+            fetch_url = _FETCH_URL.format(id=data["id"])
+        if fetch_url:
+            return _poller.watch(fetch_url, data.get("eta"))
+    raise RuntimeError(f"Modelslab error: {json.dumps(data, ensure_ascii=False)}")
 
-    raw_urls: list[str] = data.get("output", [])
-    clean_urls = [u.replace("\\/", "/").replace("\\", "") for u in raw_urls]
-    return clean_urls
+def generate_image(
+    prompt: str,
+    n: int = 1,
+    size: str = "1024x1024",
+    *,
+    negative_prompt: str = "bad quality",
+    seed: int | None = None,
+    timeout: float | None = _POLL_TIMEOUT,
+) -> list[str]:
+    """
+        Same signature as image.py:
+        prompt (str)       : Positive prompt
+        n (int)            : Number of images to generate, corresponds to Modelslab's samples
+        size (str)         : "widthxheight", e.g., "768x1024"
+        Optional keyword:
+            negative_prompt (str) : Negative prompt
+            seed (int|None)       : Random seed (None = random)
+            timeout (float|None)  : Max seconds to wait for a queued job
+        Returns:
+            list[str] : List of image URLs that can be directly accessed
+    """
+    fut = submit_image(prompt, n, size, negative_prompt=negative_prompt, seed=seed)
+    try:
+        return fut.result(timeout=timeout)
+    except FutureTimeout:
+        fut.cancel()
+        raise
 
 
 
@@ -0,0 +1,130 @@
+# -----------------------------------------------
+# postprocess.py  ——  process pool for image decode / write / hash
+# -----------------------------------------------
+"""
+save_b64_images() turns the WebUI's base64 PNGs into files. Large batches
+go to a pool of worker processes, so base64 decode, PNG write, SHA-256 and
+optional thumbnails run on other cores instead of holding this process's
+GIL (the worker keeps answering control messages meanwhile).
+
+Payloads travel through multiprocessing.shared_memory: the parent copies
+the base64 bytes into a block once, the child decodes straight from it,
+and only the block name and the output path are pickled.
+
+    POSTPROCESS_WORKERS     pool size (default min(4, CPUs); 0 = inline)
+    POSTPROCESS_INLINE_KB   batches below this size stay inline (default 256)
+    LOCAL_SD_THUMBNAIL_PX   also write <name>.thumb.jpg at this size (0 = off)
+"""
+
+import io, os, time, base64, hashlib, threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from pathlib import Path
+import tracing
+
+WORKERS = int(os.getenv("POSTPROCESS_WORKERS", str(min(4, os.cpu_count() or 1))))
+INLINE_BYTES = int(os.getenv("POSTPROCESS_INLINE_KB", "256")) * 1024
+THUMBNAIL_PX = int(os.getenv("LOCAL_SD_THUMBNAIL_PX", "0"))
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+# ---------- work (runs in the child, or inline) ----------
+def _process(data: bytes | memoryview, path: str, thumbnail_px: int) -> dict:
+    # spans only record inline (a child has no trace); the timings go back
+    # to the parent, which records them for pool runs (_record)
+    t0 = time.time()
+    with tracing.span("postprocess.decode", chars=len(data)):
+        raw = base64.b64decode(data)
+    t1 = time.time()
+    with tracing.span("postprocess.write", bytes=len(raw)):
+        with open(path, "wb") as f:
+            f.write(raw)
+    t2 = time.time()
+    out = {"path": path, "bytes": len(raw), "sha256": hashlib.sha256(raw).hexdigest(),
+           "decode_s": round(t1 - t0, 6), "write_s": round(t2 - t1, 6),
+           "_start": t0, "_pid": os.getpid()}
+    if thumbnail_px:
+        out["thumbnail"] = str(Path(path).with_suffix(".thumb.jpg"))
+        thumbnail(io.BytesIO(raw), thumbnail_px, out["thumbnail"])
+    return out
+
+def thumbnail(src, px: int, dest=None) -> bytes | None:
+    """JPEG of `src` (path or file object) fitting px×px; written to dest, else returned."""
+    from PIL import Image
+    with Image.open(src) as im:
+        im.thumbnail((px, px))
+        buf = dest if dest is not None else io.BytesIO()
+        im.convert("RGB").save(buf, format="JPEG", quality=85)
+    return None if dest is not None else buf.getvalue()
+
+def _process_shared(name: str, size: int, path: str, thumbnail_px: int) -> dict:
+    # spawn children share the parent's resource tracker, so attaching does
+    # not add a second registration; the parent unlinks the block.
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        view = shm.buf[:size]
+        try:
+            return _process(view, path, thumbnail_px)
+        finally:
+            view.release()
+    finally:
+        shm.close()
+
+# ---------- pool ----------
+def _get_pool() -> ProcessPoolExecutor | None:
+    global _pool
+    if WORKERS <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            # spawn: forking a process that runs HTTP / pipeline threads is unsafe
+            _pool = ProcessPoolExecutor(max_workers=WORKERS, mp_context=mp.get_context("spawn"))
+        return _pool
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True)
+            _pool = None
+
+def _record(out: dict) -> dict:
+    """Child-side decode / write timings as spans of the caller's trace."""
+    tracing.record("postprocess.decode", out["_start"], out["decode_s"], pid=out["_pid"],
+                   path=out["path"])
+    tracing.record("postprocess.write", out["_start"] + out["decode_s"], out["write_s"],
+                   pid=out["_pid"], bytes=out["bytes"])
+    return out
+
+def _strip(out: dict) -> dict:
+    out.pop("_start", None)
+    out.pop("_pid", None)
+    return out
+
+def save_b64_images(b64_list: list[str], paths: list[str], *,
+                    thumbnail_px: int | None = None) -> list[dict]:
+    """
+    Decode + write + hash each image; returns
+    [{path, bytes, sha256, decode_s, write_s[, thumbnail]}].
+    """
+    thumb = THUMBNAIL_PX if thumbnail_px is None else thumbnail_px
+    payloads = [b.split(",", 1)[-1].encode("ascii") for b in b64_list]   # drop data: prefix
+    pool = _get_pool() if sum(map(len, payloads)) >= INLINE_BYTES else None
+    if pool is None:
+        return [_strip(_process(d, p, thumb)) for d, p in zip(payloads, paths)]
+
+    blocks, futures = [], []
+    try:
+        for data, path in zip(payloads, paths):
+            shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+            blocks.append(shm)
+            shm.buf[:len(data)] = data
+            futures.append(pool.submit(_process_shared, shm.name, len(data), path, thumb))
+        del payloads
+        return [_strip(_record(f.result())) for f in futures]
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
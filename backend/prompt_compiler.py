@@ -0,0 +1,168 @@
+# -----------------------------------------------
+# prompt_compiler.py  ——  fit sd_prompt + keywords into CLIP chunks
+# -----------------------------------------------
+"""
+A1111 encodes prompts in chunks of 75 CLIP tokens; every extra chunk adds a
+conditioning pass and dilutes attention weights. compile_prompt():
+
+1. parses A1111 weighting syntax — "(term:1.3)", "(term)" = ×1.1,
+   "[term]" = ÷1.1, nested brackets multiply;
+2. drops keywords that repeat a term already present in sd_prompt
+   (case, "_", plurals, articles and filler words are ignored);
+3. counts CLIP tokens per term and drops the lowest-priority terms until
+   the prompt fits `max_tokens`.
+
+Priority: every sd_prompt term outranks every keyword; among sd_prompt terms
+higher weight wins, then earlier position. Keywords rank main_body >
+background > foreground. The surviving terms keep their original text and
+order.
+
+Token counts are exact only when `transformers` and a cached
+openai/clip-vit-large-patch14 tokenizer are available offline (both come
+with a WebUI install in the same environment; the worker does not install
+them). Otherwise they are an APPROXIMATION of CLIP's BPE on the same
+pre-tokenization rules, so a trimmed prompt can be a few tokens over or
+under the budget; the first fallback count logs a one-line notice.
+"""
+
+import re
+from functools import lru_cache
+
+CLIP_CHUNK_TOKENS = 75
+
+_KEYWORD_GROUPS = ("main_body", "background", "foreground")
+_FILLER = {"a", "an", "the", "of", "on", "in", "at", "with", "and", "background"}
+
+# ---------- tokenizer ----------
+_clip_tokenizer = None
+_clip_loaded = False
+
+def _load_clip_tokenizer():
+    global _clip_tokenizer, _clip_loaded
+    if not _clip_loaded:
+        _clip_loaded = True
+        try:
+            from transformers import CLIPTokenizer
+            _clip_tokenizer = CLIPTokenizer.from_pretrained(
+                "openai/clip-vit-large-patch14", local_files_only=True)
+        except Exception as e:
+            _clip_tokenizer = None
+            print(f"[prompt_compiler] CLIP tokenizer unavailable ({type(e).__name__}); "
+                  "token counts are estimates")
+    return _clip_tokenizer
+
+def exact_counts() -> bool:
+    """True if count_tokens() uses the real CLIP tokenizer, False if it estimates."""
+    return _load_clip_tokenizer() is not None
+
+# CLIP pre-tokenizer: letters runs, single digits, punctuation runs
+_PRETOKEN_RE = re.compile(r"'s|'t|'re|'ve|'m|'ll|'d|[^\W\d_]+|\d|[^\s\w]+|_")
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """CLIP tokens for `text` without start/end markers (estimated unless exact_counts())."""
+    tok = _load_clip_tokenizer()
+    if tok is not None:
+        return len(tok.tokenize(text))
+    n = 0
+    for piece in _PRETOKEN_RE.findall(text.lower()):
+        # common words are one BPE token; long/rare words split every ~6 chars
+        n += 1 if len(piece) <= 7 else 1 + (len(piece) - 2) // 6
+    return n
+
+# ---------- A1111 weight parsing ----------
+def split_terms(prompt: str) -> list[str]:
+    """Split on top-level commas; "(a, b:1.2)" stays one term."""
+    terms, depth, buf = [], 0, []
+    for ch in prompt:
+        if ch in "([{":
+            depth += 1
+        elif ch in ")]}":
+            depth = max(0, depth - 1)
+        if ch == "," and depth == 0:
+            terms.append("".join(buf).strip())
+            buf = []
+        else:
+            buf.append(ch)
+    terms.append("".join(buf).strip())
+    return [t for t in terms if t]
+
+def _enclosed(text: str, open_ch: str, close_ch: str) -> bool:
+    """True if the first bracket closes exactly at the end of `text`."""
+    if not (text.startswith(open_ch) and text.endswith(close_ch)):
+        return False
+    depth = 0
+    for i, ch in enumerate(text):
+        if ch == open_ch:
+            depth += 1
+        elif ch == close_ch:
+            depth -= 1
+            if depth == 0:
+                return i == len(text) - 1
+    return False
+
+_WEIGHT_RE = re.compile(r"^(.*):\s*(-?\d+(?:\.\d+)?)\s*$", re.S)
+
+def parse_weight(term: str) -> tuple[str, float]:
+    """"((red hair:1.2))" → ("red hair", 1.32)."""
+    text, weight = term.strip(), 1.0
+    while True:
+        if _enclosed(text, "(", ")"):
+            inner = text[1:-1].strip()
+            m = _WEIGHT_RE.match(inner)
+            if m:
+                text, weight = m.group(1).strip(), weight * float(m.group(2))
+            else:
+                text, weight = inner, weight * 1.1
+        elif _enclosed(text, "[", "]"):
+            text, weight = text[1:-1].strip(), weight / 1.1
+        else:
+            return text, weight
+
+def _words(text: str) -> frozenset:
+    out = set()
+    for w in re.findall(r"[a-z0-9]+", text.lower().replace("_", " ")):
+        if w in _FILLER:
+            continue
+        if len(w) > 3 and w.endswith("s") and not w.endswith("ss"):
+            w = w[:-1]
+        out.add(w)
+    return frozenset(out)
+
+# ---------- compiler ----------
+def compile_prompt(
+    sd_prompt: str,
+    keywords: dict | None = None,
+    *,
+    max_tokens: int = CLIP_CHUNK_TOKENS,
+) -> str:
+    """Merge sd_prompt and keyword groups into a prompt of at most `max_tokens`."""
+    terms = []          # (priority, position, text, words, cost)
+    seen: list[frozenset] = []
+
+    for pos, raw in enumerate(split_terms(sd_prompt or "")):
+        bare, weight = parse_weight(raw)
+        words = _words(bare)
+        if words and words in seen:
+            continue
+        seen.append(words)
+        terms.append(((1, weight, -pos), pos, raw, count_tokens(bare) + 1))
+
+    pos = len(terms)
+    for rank, group in enumerate(_KEYWORD_GROUPS):
+        for kw in (keywords or {}).get(group, []):
+            kw = (kw or "").strip()
+            words = _words(kw)
+            if not words or any(words <= s for s in seen):
+                continue                    # already said (or implied) by a term
+            seen.append(words)
+            terms.append(((0, -rank, -pos), pos, kw, count_tokens(kw) + 1))
+            pos += 1
+
+    total = sum(t[3] for t in terms)
+    if total > max_tokens:
+        keep = sorted(terms, key=lambda t: t[0], reverse=True)
+        while total > max_tokens and len(keep) > 1:
+            total -= keep.pop()[3]
+        terms = sorted(keep, key=lambda t: t[1])
+    return ", ".join(t[2] for t in terms)
@@ -0,0 +1,344 @@
+# -----------------------------------------------
+# rate_limit.py  ——  client-side rate limiting for cloud providers
+# -----------------------------------------------
+"""
+Every cloud caller (label, model_lab, image) takes a slot from the shared
+limiter of its provider before sending a request:
+
+    limiter("openai").acquire(tokens=est_tokens)    # blocks, priority-ordered
+    limiter("openai").observe_headers(resp.headers) # learn real limits
+    limiter("openai").backoff(retry_after)          # after a 429
+
+status() reports queue depth and estimated wait per provider; the worker
+exposes it as "ratelimit.status" and forwards wait notifications.
+"""
+import os, re, time, heapq, itertools, threading, contextlib, contextvars
+
+class TokenBucket:
+    """
+    Classic token bucket: `rate_per_min` tokens refill continuously up to
+    `burst`. acquire() blocks until enough tokens are available.
+
+    penalize(seconds) pauses the whole bucket, e.g. after a 429 with a
+    Retry-After header, so every caller sharing it backs off together.
+    """
+
+    def __init__(self, rate_per_min: float, burst: float | None = None):
+        self.rate = rate_per_min / 60.0
+        self.burst = burst if burst is not None else max(1.0, rate_per_min / 60.0)
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def wait_time(self, tokens: float = 1) -> float:
+        """Seconds until `tokens` could be taken (0 if available now)."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            pause = max(0.0, self._paused_until - now)
+            short = max(0.0, tokens - self._tokens)
+            return max(pause, short / self.rate if self.rate > 0 else float("inf"))
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """Take `tokens` if available right now; never sleeps."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now >= self._paused_until and self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def refund(self, tokens: float = 1):
+        """Give back tokens taken by try_acquire() for a call that was not sent."""
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + tokens)
+
+    def acquire(self, tokens: float = 1, timeout: float | None = None) -> float:
+        """Take `tokens`, sleeping as needed. Returns the seconds waited."""
+        start = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._paused_until and self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return now - start
+                pause = max(0.0, self._paused_until - now)
+                short = max(0.0, tokens - self._tokens)
+                delay = max(pause, short / self.rate if self.rate > 0 else 1.0)
+            if timeout is not None and now - start + delay > timeout:
+                raise TimeoutError("rate limit wait exceeds timeout")
+            time.sleep(min(delay, 1.0))
+
+    def penalize(self, seconds: float):
+        """Stop handing out tokens for `seconds` (server asked us to back off)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+# ---------- per-provider limiter with priority queue ----------
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+PRIORITIES = {"interactive": PRIORITY_INTERACTIVE, "normal": PRIORITY_NORMAL,
+              "bulk": PRIORITY_BULK}
+
+# provider → (requests per minute, tokens per minute or None); env overrides:
+# RATE_LIMIT_<PROVIDER>_RPM / RATE_LIMIT_<PROVIDER>_TPM
+_DEFAULT_LIMITS = {
+    "openai": (500, 30000),
+    "cloudflare": (300, None),
+    "modelslab": (60, None),
+    "dalle": (15, None),
+}
+
+class RateLimitExceeded(RuntimeError):
+    """A provider answered 429 (or equivalent); `retry_after` is in seconds."""
+
+    def __init__(self, provider: str, retry_after: float | None = None, detail: str = ""):
+        self.provider = provider
+        self.retry_after = retry_after
+        msg = f"{provider} rate limit exceeded"
+        if retry_after is not None:
+            msg += f", retry after {retry_after:.1f}s"
+        super().__init__(msg + (f": {detail}" if detail else ""))
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_UNIT = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+def _parse_duration(value) -> float | None:
+    """'6m0s' / '1.5s' / '20ms' / '12' → seconds."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_RE.findall(value)
+    return sum(float(n) * _UNIT[u] for n, u in parts) if parts else None
+
+def retry_after(headers) -> float | None:
+    """Retry-After / retry-after-ms header in seconds, if present."""
+    if not headers:
+        return None
+    h = {str(k).lower(): v for k, v in dict(headers).items()}
+    ms = _parse_duration(h.get("retry-after-ms"))
+    return ms / 1000 if ms is not None else _parse_duration(h.get("retry-after"))
+
+# a ContextVar, not a thread-local: pool work submitted through
+# tracing.bind (contextvars.copy_context) keeps the submitter's priority
+_priority: contextvars.ContextVar = contextvars.ContextVar("rate_limit_priority",
+                                                          default=PRIORITY_NORMAL)
+
+@contextlib.contextmanager
+def priority(level):
+    """Run the block's provider calls at `level` (int or "interactive"/"normal"/"bulk")."""
+    token = _priority.set(PRIORITIES.get(level, level) if isinstance(level, str) else level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+def current_priority() -> int:
+    return _priority.get()
+
+_wait_listeners: list = []
+
+def add_wait_listener(fn):
+    """fn(info: dict) is called whenever a caller has to queue for a provider."""
+    _wait_listeners.append(fn)
+
+def _notify(info: dict):
+    for fn in list(_wait_listeners):
+        try:
+            fn(info)
+        except Exception:
+            pass
+
+class ProviderLimiter:
+    """
+    Request bucket + optional token bucket + priority queue for one provider.
+
+    Callers queue in (priority, arrival) order; only the head of the queue
+    may draw from the buckets, so a bulk job never overtakes an interactive
+    one. observe_headers() learns the real limits and remaining budget from
+    x-ratelimit-* / Retry-After response headers.
+    """
+
+    def __init__(self, name: str, rpm: float, tpm: float | None = None,
+                 burst: float | None = None):
+        self.name = name
+        self.requests = TokenBucket(rpm, burst=burst if burst is not None else max(1.0, rpm / 10))
+        self.tokens = TokenBucket(tpm, burst=tpm / 10) if tpm else None
+        self._cv = threading.Condition()
+        self._queue: list = []
+        self._seq = itertools.count()
+        self.stats = {"acquired": 0, "waited": 0, "wait_s": 0.0, "throttled": 0}
+
+    # ----- queue -----
+    def _wait_for(self, tokens: float) -> float:
+        w = self.requests.wait_time(1)
+        if self.tokens is not None and tokens:
+            w = max(w, self.tokens.wait_time(min(tokens, self.tokens.burst)))
+        return w
+
+    def acquire(self, tokens: float = 0, priority: int | None = None,
+                timeout: float | None = None) -> float:
+        """Block until this call may be sent. Returns the seconds waited."""
+        prio = current_priority() if priority is None else priority
+        ticket = (prio, next(self._seq))
+        start = time.monotonic()
+        notified = False
+        with self._cv:
+            heapq.heappush(self._queue, ticket)
+            try:
+                while True:
+                    wait = self._wait_for(tokens) if self._queue[0] == ticket else None
+                    if wait == 0:
+                        if self._take(tokens):      # never sleeps under _cv
+                            break
+                        continue                    # a backoff() / header update came in between
+                    if not notified:
+                        notified = True
+                        info = self._wait_info(ticket)
+                        self._cv.release()          # listeners do I/O (worker stdout)
+                        try:
+                            _notify(info)
+                        finally:
+                            self._cv.acquire()
+                        continue
+                    if timeout is not None and time.monotonic() - start > timeout:
+                        raise RateLimitExceeded(self.name, wait, "queue wait timed out")
+                    self._cv.wait(timeout=min(wait if wait else 0.5, 1.0))
+            finally:
+                self._queue.remove(ticket)
+                heapq.heapify(self._queue)
+                self._cv.notify_all()
+        waited = time.monotonic() - start
+        self.stats["acquired"] += 1
+        if notified:
+            self.stats["waited"] += 1
+            self.stats["wait_s"] += waited
+        return waited
+
+    def try_acquire(self, tokens: float = 0) -> float:
+        """
+        Non-blocking acquire: 0.0 if this call may be sent now, else the
+        estimated seconds to wait (nothing taken). Never jumps the queue.
+        """
+        with self._cv:
+            if not self._queue and self._take(tokens):
+                self.stats["acquired"] += 1
+                return 0.0
+            return max(0.01, self._wait_for(tokens), self.estimated_wait())
+
+    def _take(self, tokens: float) -> bool:
+        """Draw from both buckets or neither."""
+        if not self.requests.try_acquire(1):
+            return False
+        if self.tokens is not None and tokens:
+            if not self.tokens.try_acquire(min(tokens, self.tokens.burst)):
+                self.requests.refund(1)
+                return False
+        return True
+
+    def _wait_info(self, ticket) -> dict:
+        return {"provider": self.name, "position": sorted(self._queue).index(ticket),
+                "queued": len(self._queue), "priority": ticket[0],
+                "estimated_wait_s": round(self.estimated_wait(ticket), 2)}
+
+    def estimated_wait(self, ticket=None) -> float:
+        """Rough seconds until `ticket` (or a new arrival) is served."""
+        ahead = sorted(self._queue).index(ticket) if ticket in self._queue else len(self._queue)
+        per_req = 1.0 / self.requests.rate if self.requests.rate > 0 else 0.0
+        return self.requests.wait_time(1) + ahead * per_req
+
+    # ----- feedback from responses -----
+    def observe_headers(self, headers) -> None:
+        """Learn limits / remaining budget from response headers."""
+        if not headers:
+            return
+        h = {str(k).lower(): v for k, v in dict(headers).items()}
+        retry = retry_after(h)
+        if retry:
+            self.backoff(retry)
+        for kind, bucket in (("requests", self.requests), ("tokens", self.tokens)):
+            if bucket is None:
+                continue
+            try:
+                limit = float(h[f"x-ratelimit-limit-{kind}"])
+                if limit > 0 and abs(limit / 60.0 - bucket.rate) > 1e-9:
+                    bucket.rate = limit / 60.0          # server-side limit per minute
+            except (KeyError, ValueError):
+                pass
+            try:
+                remaining = float(h[f"x-ratelimit-remaining-{kind}"])
+            except (KeyError, ValueError):
+                continue
+            if remaining <= 0:
+                self.backoff(_parse_duration(h.get(f"x-ratelimit-reset-{kind}")) or 1.0)
+
+    def backoff(self, seconds: float):
+        """Pause the provider (429 / Retry-After); queued callers wait it out."""
+        self.stats["throttled"] += 1
+        self.requests.penalize(seconds)
+        with self._cv:
+            self._cv.notify_all()
+
+    def status(self) -> dict:
+        with self._cv:
+            queued = len(self._queue)
+        return {
+            "queued": queued,
+            "estimated_wait_s": round(self.estimated_wait(), 2),
+            "rpm": round(self.requests.rate * 60, 2),
+            "tpm": round(self.tokens.rate * 60, 2) if self.tokens else None,
+            **self.stats,
+        }
+
+_limiters: dict[str, ProviderLimiter] = {}
+_limiters_lock = threading.Lock()
+
+def limiter(provider: str, *, rpm: float | None = None, tpm: float | None = None,
+            burst: float | None = None) -> ProviderLimiter:
+    """Shared limiter for `provider`; keyword defaults apply on first use only."""
+    name = provider.lower()
+    with _limiters_lock:
+        lim = _limiters.get(name)
+        if lim is None:
+            d_rpm, d_tpm = _DEFAULT_LIMITS.get(name, (60, None))
+            env = name.upper().replace("-", "_")
+            rpm = float(os.getenv(f"RATE_LIMIT_{env}_RPM", rpm or d_rpm))
+            tpm_env = os.getenv(f"RATE_LIMIT_{env}_TPM")
+            tpm = float(tpm_env) if tpm_env else (tpm or d_tpm)
+            lim = _limiters[name] = ProviderLimiter(name, rpm, tpm, burst)
+        return lim
+
+def status() -> dict:
+    """Queue depth, estimated wait and counters for every provider in use."""
+    with _limiters_lock:
+        items = list(_limiters.items())
+    return {name: lim.status() for name, lim in items}
+
+def call_with_limit(provider: str, fn, *, tokens: float = 0, retries: int = 3,
+                    priority: int | None = None):
+    """
+    Run fn() under `provider`'s limiter. fn raises RateLimitExceeded on a 429;
+    the provider is then paused (Retry-After, else exponential) and the call
+    retried up to `retries` times.
+    """
+    lim = limiter(provider)
+    for attempt in range(retries + 1):
+        lim.acquire(tokens, priority=priority)
+        try:
+            return fn()
+        except RateLimitExceeded as e:
+            lim.backoff(e.retry_after or min(60.0, 2.0 ** attempt))
+            if attempt == retries:
+                raise
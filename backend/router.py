@@ -0,0 +1,227 @@
+# -----------------------------------------------
+# router.py  ——  latency / availability aware backend choice for model="auto"
+# -----------------------------------------------
+"""
+BackendRouter ranks the image back-ends ("local", "sd", "dalle") per request
+from live measurements:
+
+* local: queue depth × recent render time, plus an estimate for this request
+  from a learned seconds-per-work-unit rate (work = megapixels × steps,
+  hires pass included);
+* cloud: running p95 latency of recent calls;
+* all: recent error rate and a circuit breaker (open after consecutive
+  failures, half-open trial after a cool-down that doubles on each re-trip).
+
+Ranking: back-ends expected to meet the latency target first, then the
+cheapest, then the fastest. So the free local WebUI wins while it can
+answer in time; once its queue is deep, interactive requests spill to the
+cloud. run() tries the ranking in order and falls through on failure.
+"""
+
+import os, time, shutil, threading, collections
+from dotenv import load_dotenv
+
+BACKENDS = ("local", "sd", "dalle")
+DEFAULT_LATENCY_TARGET_S = float(os.getenv("AUTO_LATENCY_TARGET_S", "60"))
+# USD per image; override with COST_<BACKEND>=...
+_DEFAULT_COST = {"local": 0.0, "sd": 0.0047, "dalle": 0.04}
+# latency priors (seconds) until a back-end has measurements
+_PRIOR_LATENCY = {"local": 30.0, "sd": 15.0, "dalle": 20.0}
+# local seconds per work unit (megapixel × step) until the first local render
+_PRIOR_LOCAL_RATE = 0.1 if shutil.which("nvidia-smi") else 6.0
+_DALLE_SIZES = {"1024x1024", "1792x1024", "1024x1792"}
+
+_BREAKER_THRESHOLD = 3          # consecutive failures that open the breaker
+_BREAKER_COOLDOWN_S = 30.0
+_BREAKER_MAX_COOLDOWN_S = 600.0
+_MIN_SAMPLES = 5
+
+class BadRequest(ValueError):
+    """The request itself is invalid: no back-end would accept it, so run()
+    neither records a failure nor falls back. Decode errors from a broken
+    back-end (requests' JSONDecodeError is also a ValueError) are not this."""
+
+class _Breaker:
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0.0
+        self.cooldown = _BREAKER_COOLDOWN_S
+        self.trial = False          # a half-open trial call is in flight
+
+    def allow(self, now: float) -> bool:
+        if self.failures < _BREAKER_THRESHOLD:
+            return True
+        if now < self.open_until or self.trial:
+            return False
+        self.trial = True           # half-open: let exactly one call through
+        return True
+
+    def success(self):
+        self.failures, self.trial, self.cooldown = 0, False, _BREAKER_COOLDOWN_S
+
+    def failure(self, now: float):
+        self.failures += 1
+        if self.trial:              # failed trial → re-open for longer
+            self.cooldown = min(_BREAKER_MAX_COOLDOWN_S, self.cooldown * 2)
+        self.trial = False
+        if self.failures >= _BREAKER_THRESHOLD:
+            self.open_until = now + self.cooldown
+
+    @property
+    def state(self) -> str:
+        if self.failures < _BREAKER_THRESHOLD:
+            return "closed"
+        return "half-open" if time.monotonic() >= self.open_until else "open"
+
+
+class BackendRouter:
+    def __init__(self, window: int = 100):
+        self._lat = {b: collections.deque(maxlen=window) for b in BACKENDS}
+        self._ok = {b: collections.deque(maxlen=window) for b in BACKENDS}
+        self._breaker = {b: _Breaker() for b in BACKENDS}
+        self._local_rate: float | None = None       # seconds per work unit (EWMA)
+        self._local_inflight = 0
+        self._lock = threading.Lock()
+        self._avail_cache: dict = {}
+
+    # ----- measurements -----
+    def local_started(self):
+        with self._lock:
+            self._local_inflight += 1
+
+    def local_finished(self):
+        with self._lock:
+            self._local_inflight = max(0, self._local_inflight - 1)
+
+    def record(self, backend: str, seconds: float, ok: bool, work: float | None = None):
+        with self._lock:
+            self._ok[backend].append(1 if ok else 0)
+            if ok:
+                self._lat[backend].append(seconds)
+                if backend == "local" and work:
+                    rate = seconds / work
+                    self._local_rate = rate if self._local_rate is None else \
+                        0.8 * self._local_rate + 0.2 * rate
+                self._breaker[backend].success()
+            else:
+                self._breaker[backend].failure(time.monotonic())
+
+    def _p95(self, backend: str) -> float:
+        xs = sorted(self._lat[backend])
+        if len(xs) < _MIN_SAMPLES:
+            return _PRIOR_LATENCY[backend] if not xs else max(xs)
+        return xs[min(len(xs) - 1, int(0.95 * len(xs)))]
+
+    def _error_rate(self, backend: str) -> float:
+        xs = self._ok[backend]
+        return 1.0 - sum(xs) / len(xs) if xs else 0.0
+
+    # ----- prediction -----
+    def estimate_local(self, work: float, own_s: float | None = None) -> float:
+        """Queue wait + this render, in seconds (own_s: render time from cost_model)."""
+        with self._lock:
+            rate = self._local_rate
+            depth = self._local_inflight
+            lat = list(self._lat["local"])
+        avg = sum(lat) / len(lat) if lat else work * (rate or _PRIOR_LOCAL_RATE)
+        own = own_s if own_s is not None else work * (rate if rate is not None else _PRIOR_LOCAL_RATE)
+        return depth * avg + own
+
+    def predict(self, backend: str, work: float, local_eta_s: float | None = None) -> float:
+        if backend == "local":
+            return self.estimate_local(work, local_eta_s)
+        with self._lock:
+            p95 = self._p95(backend)
+        # a flaky back-end costs a retry on average
+        return p95 * (1.0 + self._error_rate(backend))
+
+    @staticmethod
+    def cost(backend: str, n: int) -> float:
+        return float(os.getenv(f"COST_{backend.upper()}", _DEFAULT_COST[backend])) * n
+
+    def _available(self, backend: str, size: str) -> bool:
+        if backend == "dalle" and size not in _DALLE_SIZES:
+            return False
+        now = time.monotonic()
+        hit = self._avail_cache.get(backend)
+        if hit and now - hit[0] < 10:
+            return hit[1]
+        load_dotenv()
+        if backend == "local":
+            import local_sd
+            ok = local_sd.ROOT.exists() or local_sd._server_running()
+        elif backend == "sd":
+            ok = bool(os.getenv("MODELSLAB_API_KEY"))
+        else:
+            ok = bool(os.getenv("OPENAI_API_KEY"))
+        self._avail_cache[backend] = (now, ok)
+        return ok
+
+    # ----- routing -----
+    def rank(self, *, work: float, n: int, size: str,
+             max_latency_s: float | None = None, max_cost: float | None = None,
+             local_eta_s: float | None = None) -> list[dict]:
+        """Candidate back-ends, best first, with their predictions."""
+        target = max_latency_s if max_latency_s is not None else DEFAULT_LATENCY_TARGET_S
+        now = time.monotonic()
+        out = []
+        for b in BACKENDS:
+            if not self._available(b, size):
+                continue
+            cost = self.cost(b, n)
+            if max_cost is not None and cost > max_cost:
+                continue
+            with self._lock:
+                br = self._breaker[b]
+                blocked = br.failures >= _BREAKER_THRESHOLD and (now < br.open_until or br.trial)
+            if blocked:
+                continue
+            eta = self.predict(b, work, local_eta_s)
+            out.append({"backend": b, "eta_s": round(eta, 2), "cost": cost,
+                        "meets_latency": eta <= target})
+        out.sort(key=lambda c: (not c["meets_latency"], c["cost"], c["eta_s"]))
+        return out
+
+    def run(self, call, *, work: float, n: int, size: str,
+            max_latency_s: float | None = None, max_cost: float | None = None,
+            local_eta_s: float | None = None, stop_on: tuple = ()):
+        """
+        call(backend) on the best candidate, falling back down the ranking.
+        BadRequest and the `stop_on` exception types (e.g. the caller was
+        cancelled) end the run instead of trying the next back-end.
+        """
+        ranking = self.rank(work=work, n=n, size=size, max_latency_s=max_latency_s,
+                            max_cost=max_cost, local_eta_s=local_eta_s)
+        if not ranking:
+            raise RuntimeError("no image backend available for model='auto' "
+                               "(check API keys, latency / cost limits, circuit breakers)")
+        errors = []
+        for cand in ranking:
+            b = cand["backend"]
+            with self._lock:
+                if not self._breaker[b].allow(time.monotonic()):
+                    continue
+            try:
+                return call(b)
+            except (BadRequest, *stop_on):
+                with self._lock:
+                    self._breaker[b].trial = False
+                raise                       # another back-end will not help / nobody is waiting
+            except Exception as e:
+                errors.append(f"{b}: {e}")
+        raise RuntimeError("all image backends failed: " + "; ".join(errors))
+
+    def status(self) -> dict:
+        with self._lock:
+            depth = self._local_inflight
+            rate = self._local_rate
+        return {
+            "local_queue_depth": depth,
+            "local_s_per_work_unit": rate,
+            "backends": {b: {"p95_s": round(self._p95(b), 2),
+                             "error_rate": round(self._error_rate(b), 3),
+                             "breaker": self._breaker[b].state}
+                         for b in BACKENDS},
+        }
+
+router = BackendRouter()
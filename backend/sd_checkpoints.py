@@ -0,0 +1,199 @@
+# -----------------------------------------------
+# sd_checkpoints.py  ——  multi-checkpoint RAM cache for the local WebUI
+# -----------------------------------------------
+"""
+A1111 can keep several checkpoints loaded (option sd_checkpoints_limit;
+older builds: sd_checkpoint_cache, a RAM cache of state dicts). Switching
+to a loaded one takes well under a second instead of a full load.
+
+CheckpointCache
+  - sizes that limit from free RAM (psutil) and re-checks it before every
+    full load, so the WebUI never caches itself into swap;
+  - mirrors which checkpoints the WebUI holds (it evicts the least recently
+    used one when a new load goes over the limit);
+  - picks the victim itself by a decayed use count (recent and frequent
+    uses both count; half-life LOCAL_SD_CKPT_HALF_LIFE_H) and, if the WebUI's
+    LRU candidate scores higher, re-touches it first so the WebUI evicts
+    the right one.
+
+Use counts persist in outputs/cache/checkpoints.json; residency is reset
+whenever the WebUI (re)starts.
+
+    LOCAL_SD_CKPT_MAX         most checkpoints kept loaded (default 3)
+    LOCAL_SD_RAM_RESERVE_GB   RAM left for everything else (default 4)
+    LOCAL_SD_CKPT_GB          footprint when the file is not found (default 7)
+    LOCAL_SD_CKPT_RAM_FACTOR  RAM per file byte (default 1 on GPU, 2 on CPU:
+                              --no-half holds fp16 files as fp32)
+"""
+
+import os, json, time, threading
+from pathlib import Path
+import psutil
+import requests
+import sd_launcher
+
+STATE_PATH = Path(__file__).resolve().parents[1] / "outputs" / "cache" / "checkpoints.json"
+MODELS_DIR = sd_launcher.ROOT / "models" / "Stable-diffusion"
+MAX_LOADED = int(os.getenv("LOCAL_SD_CKPT_MAX", "3"))
+RESERVE = float(os.getenv("LOCAL_SD_RAM_RESERVE_GB", "4")) * 1024 ** 3
+DEFAULT_SIZE = float(os.getenv("LOCAL_SD_CKPT_GB", "7")) * 1024 ** 3
+HALF_LIFE_S = float(os.getenv("LOCAL_SD_CKPT_HALF_LIFE_H", "24")) * 3600
+_MAX_TOUCH = 2                  # extra switches spent steering one eviction
+
+def key(name: str | None) -> str | None:
+    """'model.safetensors [6ce0161689]' → 'model.safetensors' (the WebUI adds the hash)."""
+    return name.split(" [", 1)[0].strip() if name else None
+
+def _ram_factor() -> float:
+    env = os.getenv("LOCAL_SD_CKPT_RAM_FACTOR")
+    if env:
+        return float(env)
+    return 1.0 if sd_launcher.has_cuda() else 2.0
+
+
+class CheckpointCache:
+    def __init__(self, path: Path = STATE_PATH):
+        self.path = Path(path)
+        self.resident: list[str] = []            # most recently used first, like the WebUI
+        self.limit = 1
+        self.option: str | None = None           # which WebUI option holds the limit
+        self._uses: dict[str, dict] = {}         # name → {"score", "t", "count"}
+        self.stats = {"hits": 0, "loads": 0, "touches": 0}
+        self._lock = threading.Lock()
+        self._load()
+
+    # ----- persistence -----
+    def _load(self):
+        try:
+            self._uses = json.loads(self.path.read_text(encoding="utf-8")).get("uses", {})
+        except (OSError, ValueError):
+            self._uses = {}
+
+    def _save(self):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps({"uses": self._uses}), encoding="utf-8")
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+    # ----- scoring -----
+    def score(self, name: str, now: float | None = None) -> float:
+        u = self._uses.get(name)
+        if not u:
+            return 0.0
+        now = time.time() if now is None else now
+        return u["score"] * 0.5 ** ((now - u["t"]) / HALF_LIFE_S)
+
+    def _record_use(self, name: str):
+        now = time.time()
+        u = self._uses.setdefault(name, {"score": 0.0, "t": now, "count": 0})
+        u["score"], u["t"], u["count"] = self.score(name, now) + 1.0, now, u["count"] + 1
+        self._save()
+
+    # ----- memory -----
+    def footprint(self, name: str) -> float:
+        p = MODELS_DIR / name
+        try:
+            return p.stat().st_size * _ram_factor()
+        except OSError:
+            return DEFAULT_SIZE
+
+    def capacity(self, incoming: str | None = None) -> int:
+        """Checkpoints that fit: the resident ones plus what free RAM still holds."""
+        sizes = [self.footprint(n) for n in self.resident + ([incoming] if incoming else [])]
+        each = max(sizes) if sizes else DEFAULT_SIZE
+        spare = psutil.virtual_memory().available - RESERVE
+        # resident checkpoints are already out of `available`; the incoming
+        # one needs a slot from `extra`, else the LRU resident makes room
+        extra = int(spare // each) if spare > 0 else 0
+        return max(1, min(MAX_LOADED, len(self.resident) + extra))
+
+    # ----- WebUI options -----
+    def configure(self, host: str) -> str | None:
+        """
+        After a (re)start: find the limit option this WebUI build has, apply
+        capacity() and return the checkpoint it has loaded.
+        """
+        opts = requests.get(f"{host}/sdapi/v1/options", timeout=10).json()
+        with self._lock:
+            current = key(opts.get("sd_model_checkpoint"))
+            self.resident = [current] if current else []
+            self.option = ("sd_checkpoints_limit" if "sd_checkpoints_limit" in opts else
+                           "sd_checkpoint_cache" if "sd_checkpoint_cache" in opts else None)
+            update = {}
+            if self.option == "sd_checkpoints_limit" and opts.get("sd_checkpoint_cache"):
+                update["sd_checkpoint_cache"] = 0        # loaded models already live in RAM
+            self.limit = int(opts.get(self.option) or 1) if self.option else 1
+            self._apply_limit(host, self.capacity(), update)
+            return current
+
+    def _apply_limit(self, host: str, limit: int, update: dict | None = None):
+        update = dict(update or {})
+        if self.option and limit != self.limit:
+            update[self.option] = limit
+        if update:
+            requests.post(f"{host}/sdapi/v1/options", json=update, timeout=10).raise_for_status()
+        if self.option:
+            self.limit = limit
+
+    def reset(self):
+        with self._lock:
+            self.resident = []
+
+    # ----- switching -----
+    def is_resident(self, name: str) -> bool:
+        return key(name) in self.resident
+
+    def switch(self, name: str, host: str, load):
+        """
+        load(name) makes the WebUI switch (blocking). A non-resident switch
+        first re-sizes the limit and steers the eviction; a resident one is
+        just a reorder.
+        """
+        name = key(name)
+        with self._lock:
+            if name in self.resident:
+                self.stats["hits"] += 1
+                load(name)
+                self._touch(name)
+                self._record_use(name)
+                return
+            if self.option:
+                self._apply_limit(host, self.capacity(incoming=name))
+            self._steer_eviction(name, load)
+            self.stats["loads"] += 1
+            load(name)
+            self._touch(name)
+            del self.resident[max(1, self.limit):]       # the WebUI unloads the LRU tail
+            self._record_use(name)
+
+    def _touch(self, name: str):
+        if name in self.resident:
+            self.resident.remove(name)
+        self.resident.insert(0, name)
+
+    def _steer_eviction(self, incoming: str, load):
+        """Make the WebUI's LRU tail the lowest-scoring resident before a full load."""
+        if len(self.resident) < self.limit or len(self.resident) < 2:
+            return                                       # nothing will be evicted
+        now = time.time()
+        victim = min(self.resident, key=lambda n: (self.score(n, now), -self.resident.index(n)))
+        for _ in range(_MAX_TOUCH):
+            tail = self.resident[-1]
+            if tail == victim:
+                return
+            load(tail)                                   # resident: sub-second reorder
+            self.stats["touches"] += 1
+            self._touch(tail)
+
+    def status(self) -> dict:
+        # no lock: a switch holds it for the whole load
+        now = time.time()
+        return {"resident": list(self.resident), "limit": self.limit, "option": self.option,
+                "available_gb": round(psutil.virtual_memory().available / 1024 ** 3, 1),
+                "scores": {n: round(self.score(n, now), 2) for n in list(self._uses)},
+                **self.stats}
+
+cache = CheckpointCache()
@@ -0,0 +1,324 @@
+# -----------------------------------------------
+# sd_launcher.py  ——  one launcher for the A1111 WebUI
+# -----------------------------------------------
+"""
+probe()          cheap hardware probe (no torch import): CPU count / physical
+                 cores, RAM, AVX flags, NVIDIA GPU + VRAM via nvidia-smi.
+                 Cached in outputs/cache/hardware.json for a day.
+launch_flags()   A1111 flags derived from the probe (GPU: xformers + VRAM
+                 tier; CPU: full precision, --use-cpu all). After the first
+                 successful start --skip-prepare-environment is added
+                 (set LOCAL_SD_PREPARE=1 after updating the WebUI).
+cpu_policy()     thread count + core pinning: explicit args, LOCAL_SD_THREADS /
+                 LOCAL_SD_CPUS ("0-5,8"), the calibration stored for the
+                 checkpoint being started (backend_main.calibrate_local_threads)
+                 or one thread per physical core.
+                 OMP_NUM_THREADS also sets torch's intra-op pool size.
+launch()         start launch.py with stdout/stderr in sd_webui.log.
+wait_ready()     follow that log until the WebUI reports it is up, then
+                 confirm once over HTTP; fails fast if the process dies.
+
+local_sd.start_server, helper_local_sd.start_sd and server_local_sd.py
+all go through here, so every entry point launches the WebUI the same way.
+"""
+
+import os, sys, json, time, socket, shutil, subprocess
+from pathlib import Path
+import requests, psutil
+import sd_supervisor, tracing
+
+PROJ_ROOT = Path(__file__).resolve().parents[1]
+ROOT = Path(__file__).resolve().parent / "stable-diffusion-webui"
+LOG_PATH = Path(os.getenv("LOCAL_SD_LOG", PROJ_ROOT / "sd_webui.log"))
+PROBE_CACHE = PROJ_ROOT / "outputs" / "cache" / "hardware.json"
+THREADS_CACHE = PROJ_ROOT / "outputs" / "cache" / "threads.json"
+_PROBE_TTL_S = 24 * 3600
+# lines A1111 prints once the HTTP server is accepting requests
+_READY_MARKERS = ("Startup time:", "Running on local URL:")
+
+_probe: dict | None = None
+
+# ---------- hardware probe ----------
+def _avx_flags() -> list[str]:
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8", errors="ignore") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    return sorted(x for x in line.split(":", 1)[1].split()
+                                  if x.startswith("avx") or x == "fma")
+    except OSError:
+        pass
+    return []
+
+def _nvidia() -> dict | None:
+    exe = shutil.which("nvidia-smi")
+    if not exe:
+        return None
+    try:
+        out = subprocess.run([exe, "--query-gpu=name,memory.total", "--format=csv,noheader,nounits"],
+                             capture_output=True, text=True, timeout=5).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    gpus = []
+    for line in out.strip().splitlines():
+        name, _, mem = line.rpartition(",")
+        try:
+            gpus.append({"name": name.strip(), "vram_mb": int(float(mem))})
+        except ValueError:
+            continue
+    return max(gpus, key=lambda g: g["vram_mb"]) if gpus else None
+
+def _fingerprint() -> str:
+    return f"{socket.gethostname()}|{os.cpu_count()}|{bool(shutil.which('nvidia-smi'))}"
+
+def probe(refresh: bool = False) -> dict:
+    """Hardware summary; memoised in-process and on disk (keyed by host/CPU/GPU presence)."""
+    global _probe
+    if _probe is not None and not refresh:
+        return _probe
+    if not refresh:
+        try:
+            cached = json.loads(PROBE_CACHE.read_text(encoding="utf-8"))
+            if cached.get("fingerprint") == _fingerprint() and \
+                    time.time() - cached.get("ts", 0) < _PROBE_TTL_S:
+                _probe = cached
+                return _probe
+        except (OSError, ValueError):
+            pass
+    gpu = _nvidia()
+    _probe = {
+        "fingerprint": _fingerprint(),
+        "ts": time.time(),
+        "logical_cpus": os.cpu_count() or 1,
+        "physical_cores": psutil.cpu_count(logical=False) or os.cpu_count() or 1,
+        "ram_mb": psutil.virtual_memory().total // (1024 * 1024),
+        "avx": _avx_flags(),
+        "gpu": gpu,
+    }
+    try:
+        PROBE_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        PROBE_CACHE.write_text(json.dumps(_probe, indent=2), encoding="utf-8")
+    except OSError:
+        pass
+    return _probe
+
+def has_cuda() -> bool:
+    return probe()["gpu"] is not None
+
+# ---------- command line ----------
+def launch_flags(hw: dict | None = None) -> list[str]:
+    hw = hw or probe()
+    flags = ["--api", "--skip-version-check", "--no-download-sd-model"]
+    gpu = hw["gpu"]
+    if gpu:
+        flags += ["--xformers"]
+        if gpu["vram_mb"] < 6 * 1024:
+            flags += ["--lowvram"]
+        elif gpu["vram_mb"] < 12 * 1024:
+            flags += ["--medvram"]
+    else:
+        flags += ["--use-cpu", "all", "--precision", "full", "--no-half",
+                  "--skip-torch-cuda-test"]
+    if _prepared():
+        flags += ["--skip-prepare-environment"]    # deps already installed by a prior run
+    return flags
+
+# ---------- CPU threads / affinity ----------
+def parse_cpus(spec) -> list[int] | None:
+    """"0-3,6" / [0, 1, 2] / None → sorted core ids."""
+    if spec is None or spec == "":
+        return None
+    if isinstance(spec, str):
+        cpus = set()
+        for part in spec.split(","):
+            a, _, b = part.strip().partition("-")
+            cpus.update(range(int(a), int(b or a) + 1))
+        spec = cpus
+    return sorted(int(c) for c in spec)
+
+def _calibrations() -> dict:
+    try:
+        data = json.loads(THREADS_CACHE.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    return data if data.get("fingerprint") == _fingerprint() else {}
+
+def calibrated_threads(checkpoint: str | None = None, size: str | None = None) -> int | None:
+    """
+    Best thread count measured for this checkpoint/size; without a size (the
+    WebUI is started before any request is known) the checkpoint's most
+    recent run; else the latest one measured for any checkpoint.
+    """
+    data = _calibrations()
+    runs = data.get("runs", {})
+    hit = runs.get(f"{checkpoint}|{size}")
+    if hit is None and checkpoint is not None:
+        mine = [r for k, r in runs.items() if k.rpartition("|")[0] == checkpoint]
+        hit = max(mine, key=lambda r: r.get("ts", 0), default=None)
+    return hit["threads"] if hit else data.get("latest")
+
+def save_calibration(checkpoint: str | None, size: str, threads: int, timings: dict):
+    data = _calibrations() or {"fingerprint": _fingerprint(), "runs": {}}
+    data["runs"][f"{checkpoint}|{size}"] = {"threads": threads, "s_per_step": timings,
+                                             "ts": time.time()}
+    data["latest"] = threads
+    THREADS_CACHE.parent.mkdir(parents=True, exist_ok=True)
+    THREADS_CACHE.write_text(json.dumps(data, indent=2), encoding="utf-8")
+
+def thread_candidates(hw: dict | None = None) -> list[int]:
+    hw = hw or probe()
+    phys, logical = hw["physical_cores"], hw["logical_cpus"]
+    return sorted({max(1, phys // 2), max(1, phys * 3 // 4), phys, logical})
+
+def cpu_policy(threads: int | None = None, cpus=None, hw: dict | None = None,
+               checkpoint: str | None = None) -> dict:
+    """
+    {"threads": n | None, "cpus": [ids] | None}; threads stays None on GPU unless
+    asked. `checkpoint` (sd_checkpoints.key) selects that checkpoint's calibration.
+    """
+    hw = hw or probe()
+    cpus = parse_cpus(cpus if cpus is not None else os.getenv("LOCAL_SD_CPUS"))
+    if threads is None and os.getenv("LOCAL_SD_THREADS"):
+        threads = int(os.getenv("LOCAL_SD_THREADS"))
+    if threads is None and not hw["gpu"]:
+        threads = calibrated_threads(checkpoint) or (min(len(cpus), hw["physical_cores"]) if cpus
+                                           else hw["physical_cores"])
+    return {"threads": threads, "cpus": cpus}
+
+def thread_env(threads: int | None) -> dict:
+    """OpenMP / BLAS pool sizes; torch sizes its intra-op pool from OMP_NUM_THREADS."""
+    if not threads:
+        return {}
+    n = str(threads)
+    return {"OMP_NUM_THREADS": n, "MKL_NUM_THREADS": n, "OPENBLAS_NUM_THREADS": n}
+
+def _pin(pid: int, cpus: list[int]):
+    """
+    Pin a just-spawned process to `cpus`; threads and processes it creates
+    later inherit the mask. Done from here, not via preexec_fn, which can
+    deadlock the child of a multi-threaded parent.
+    """
+    if hasattr(os, "sched_setaffinity"):
+        try:                                     # Linux: every thread started so far
+            tids = [int(t) for t in os.listdir(f"/proc/{pid}/task")]
+        except OSError:
+            tids = [pid]
+        for tid in tids:
+            try:
+                os.sched_setaffinity(tid, cpus)
+            except OSError:                      # thread exited meanwhile
+                pass
+        return
+    try:                                         # Windows / macOS
+        psutil.Process(pid).cpu_affinity(cpus)
+    except (AttributeError, psutil.Error):
+        pass
+
+def python_exe() -> str:
+    """The WebUI venv interpreter if present, else ours (LOCAL_SD_PYTHON overrides)."""
+    env = os.getenv("LOCAL_SD_PYTHON")
+    if env:
+        return env
+    for rel in ("venv/bin/python", "venv/Scripts/python.exe"):
+        if (ROOT / rel).exists():
+            return str(ROOT / rel)
+    return sys.executable
+
+def build_command(port: int = 7860, model_path: str | None = None, *,
+                  listen: bool = True, extra: list[str] | None = None) -> list[str]:
+    cmd = [python_exe(), "launch.py", "--port", str(port), *launch_flags()]
+    if listen:
+        cmd += ["--listen"]
+    if model_path:
+        cmd += ["--ckpt", model_path]
+    return cmd + list(extra or [])
+
+_PREPARED_MARK = "prepared.ok"
+
+def _prepared() -> bool:
+    return (ROOT / _PREPARED_MARK).exists() and os.getenv("LOCAL_SD_PREPARE") != "1"
+
+# ---------- launch / readiness ----------
+def launch(port: int = 7860, model_path: str | None = None, *, env: dict | None = None,
+           extra: list[str] | None = None, log_path: Path | None = None,
+           threads: int | None = None, cpus=None,
+           checkpoint: str | None = None) -> subprocess.Popen:
+    """Start the WebUI in its own process group, output appended to the log."""
+    if not ROOT.exists():
+        raise RuntimeError(f"WebUI dir not found: {ROOT}")
+    log_path = Path(log_path or LOG_PATH)
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    cmd = build_command(port, model_path, extra=extra)
+    policy = cpu_policy(threads, cpus, checkpoint=checkpoint)
+    full_env = {**os.environ, **thread_env(policy["threads"]), **(env or {})}
+    log = open(log_path, "ab")
+    log.write(f"\n==== launch {time.strftime('%Y-%m-%d %H:%M:%S')}: {' '.join(cmd)}"
+              f"  (threads={policy['threads']}, cpus={policy['cpus']})\n".encode())
+    log.flush()
+    offset = log.tell()
+    try:
+        proc = sd_supervisor.spawn(cmd, cwd=ROOT, env=full_env, stdout=log,
+                                   stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+    finally:
+        log.close()                              # the child holds its own handle
+    if policy["cpus"]:
+        _pin(proc.pid, policy["cpus"])
+    proc.policy = policy
+    proc.log_path, proc.log_offset = log_path, offset   # wait_ready follows the log from here
+    return proc
+
+def _http_ready(host: str) -> bool:
+    try:
+        requests.get(f"{host}/sdapi/v1/sd-models", timeout=2)
+        return True
+    except requests.exceptions.RequestException:
+        return False
+
+def _tail(path: Path, n: int = 20) -> str:
+    try:
+        return "\n".join(path.read_text(encoding="utf-8", errors="replace").splitlines()[-n:])
+    except OSError:
+        return ""
+
+def wait_ready(proc: subprocess.Popen | None, host: str, timeout: float = 300) -> float:
+    """Block until the WebUI answers; returns seconds waited."""
+    with tracing.span("local_sd.wait_ready"):
+        return _wait_ready(proc, host, timeout)
+
+def _wait_ready(proc, host: str, timeout: float) -> float:
+    start = time.monotonic()
+    log_path = getattr(proc, "log_path", None)
+    offset = getattr(proc, "log_offset", 0)
+    f = open(log_path, "r", encoding="utf-8", errors="replace") if log_path else None
+    try:
+        if f:
+            f.seek(offset)
+        next_http = start
+        while time.monotonic() - start < timeout:
+            if proc is not None and proc.poll() is not None:
+                raise RuntimeError(f"WebUI exited with code {proc.returncode} during startup:\n"
+                                   + (_tail(log_path) if log_path else ""))
+            line = f.readline() if f else ""
+            if line:
+                if any(m in line for m in _READY_MARKERS) and _http_ready(host):
+                    break
+                continue
+            now = time.monotonic()
+            if now >= next_http:                 # log format changed / not ours: slow poll
+                if _http_ready(host):
+                    break
+                next_http = now + 2.0
+            time.sleep(0.05)
+        else:
+            raise TimeoutError("WebUI failed to start within timeout"
+                               + (f":\n{_tail(log_path)}" if log_path else ""))
+    finally:
+        if f:
+            f.close()
+    try:
+        (ROOT / _PREPARED_MARK).touch()
+    except OSError:
+        pass
+    waited = time.monotonic() - start
+    print(f"🚀 Local SD ready on {host} ({waited:.1f}s)")
+    return waited
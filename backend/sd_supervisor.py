@@ -0,0 +1,131 @@
+# -----------------------------------------------
+# sd_supervisor.py  ——  spawn / stop the WebUI process we own
+# -----------------------------------------------
+"""
+Shutdown order (each step only if the previous one did not finish the job):
+
+1. POST /shutdown and wait for our process to exit (no fixed sleep);
+2. terminate the whole process tree / process group, then kill it;
+3. port scan: find whoever still listens on the port (psutil.net_connections,
+   then a per-process scan if that is not permitted) — only needed when the
+   WebUI was started by someone else.
+
+spawn() starts the WebUI in its own session / process group so step 2 can
+take launch.py and everything it forked down in one go.
+"""
+
+import os, sys, time, signal, socket, subprocess
+import requests, psutil
+
+def spawn(cmd: list[str], cwd, **kwargs) -> subprocess.Popen:
+    """Popen in a new process group (POSIX session / Windows group)."""
+    if sys.platform.startswith("win"):
+        kwargs.setdefault("creationflags", subprocess.CREATE_NEW_PROCESS_GROUP)
+    else:
+        kwargs.setdefault("start_new_session", True)
+    return subprocess.Popen(cmd, cwd=cwd, **kwargs)
+
+def port_open(port: int, host: str = "127.0.0.1", timeout: float = 0.2) -> bool:
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+def wait_port_closed(port: int, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not port_open(port):
+            return True
+        time.sleep(0.1)
+    return not port_open(port)
+
+def terminate_tree(pid: int, timeout: float = 5.0) -> None:
+    """SIGTERM the process, its group and all descendants; SIGKILL survivors."""
+    try:
+        root = psutil.Process(pid)
+        procs = root.children(recursive=True) + [root]
+    except psutil.NoSuchProcess:
+        return
+    try:
+        if hasattr(os, "getpgid") and os.getpgid(pid) == pid:
+            _kill_group(pid)                    # we made it a group leader in spawn()
+    except ProcessLookupError:
+        pass
+    for p in procs:
+        try:
+            p.terminate()
+        except psutil.NoSuchProcess:
+            pass
+    _, alive = psutil.wait_procs(procs, timeout=timeout)
+    for p in alive:
+        try:
+            p.kill()
+        except psutil.NoSuchProcess:
+            pass
+    psutil.wait_procs(alive, timeout=timeout)
+
+def pids_on_port(port: int) -> set[int]:
+    """PIDs listening on `port`; system-wide table first, per-process scan as fallback."""
+    try:
+        return {c.pid for c in psutil.net_connections(kind="tcp")
+                if c.pid and c.laddr and c.laddr.port == port
+                and c.status == psutil.CONN_LISTEN}
+    except (psutil.AccessDenied, PermissionError):
+        pass
+    pids = set()
+    for p in psutil.process_iter(["pid"]):
+        try:
+            conns = p.net_connections(kind="tcp") if hasattr(p, "net_connections") \
+                else p.connections(kind="tcp")
+        except (psutil.AccessDenied, psutil.NoSuchProcess):
+            continue
+        if any(c.laddr and c.laddr.port == port for c in conns):
+            pids.add(p.pid)
+    return pids
+
+def kill_port(port: int, timeout: float = 5.0) -> list[int]:
+    """Terminate every process tree listening on `port`; returns the PIDs hit."""
+    pids = sorted(pids_on_port(port))
+    for pid in pids:
+        terminate_tree(pid, timeout)
+    return pids
+
+def stop(proc: subprocess.Popen | None, port: int, *, host: str | None = None,
+         grace: float = 8.0, timeout: float = 5.0) -> str:
+    """
+    Stop the WebUI on `port`. `proc` is the Popen we spawned (None if we did
+    not start it). Returns how it ended: "not-running", "graceful",
+    "terminated" or "port-kill".
+    """
+    host = host or f"http://127.0.0.1:{port}"
+    owned = proc is not None and proc.poll() is None
+    if not owned and not port_open(port):
+        return "not-running"
+    try:
+        requests.post(f"{host}/shutdown", timeout=2)
+    except requests.exceptions.RequestException:
+        pass
+    if owned:
+        try:
+            proc.wait(timeout=grace)
+        except subprocess.TimeoutExpired:
+            terminate_tree(proc.pid, timeout)
+            return "terminated"
+        if wait_port_closed(port, 1.0):
+            return "graceful"
+        _kill_group(proc.pid)                   # launch.py exited, a child still serves
+        if wait_port_closed(port, timeout):
+            return "terminated"
+    elif wait_port_closed(port, grace):
+        return "graceful"
+    kill_port(port, timeout)
+    return "port-kill"
+
+def _kill_group(pgid: int) -> None:
+    """SIGTERM what is left of a group spawn() created (leader may be gone)."""
+    if hasattr(os, "killpg"):
+        try:
+            os.killpg(pgid, signal.SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            pass
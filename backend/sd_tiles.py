@@ -0,0 +1,189 @@
+# -----------------------------------------------
+# sd_tiles.py  ——  memory-bounded tiled generation for large outputs
+# -----------------------------------------------
+"""
+A poster-size txt2img (or a large hr_scale) makes the WebUI allocate the
+whole latent and VAE decode at once. Tiled mode keeps every WebUI call at
+tile size instead:
+
+1. txt2img a base image at ≤ LOCAL_SD_TILE_BASE_PX pixels (aspect kept),
+   or, for a hires render, the first pass itself;
+2. upscale it to the target size here (PIL Lanczos);
+3. refine overlapping tiles through /sdapi/v1/img2img at low denoising;
+4. paste the tiles back in raster order, feathering the overlap with the
+   tiles already placed (linear alpha ramp on the left / top edges).
+
+WebUI peak memory is fixed by the tile size (LOCAL_SD_TILE, default 768);
+this process holds the canvas plus at most one tile per instance: a tile is
+submitted only when an earlier one has been pasted.
+
+Tiles run concurrently on every instance in LOCAL_SD_HOSTS
+("http://127.0.0.1:7860,http://127.0.0.1:7861"); at the start of each tiled
+render the extra instances are checked and, if needed, switched to the main
+instance's checkpoint (they may have restarted or been switched by hand).
+"""
+
+import io, os, base64, datetime, threading, collections
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import requests
+from PIL import Image, ImageChops
+import tracing
+from sd_checkpoints import key as _ckpt_key
+
+TILE = int(os.getenv("LOCAL_SD_TILE", "768"))
+OVERLAP = int(os.getenv("LOCAL_SD_TILE_OVERLAP", "128"))
+BASE_MAX_PX = int(os.getenv("LOCAL_SD_TILE_BASE_PX", str(512 * 768)))
+# outputs above this many pixels switch to tiled mode automatically
+THRESHOLD_PX = int(os.getenv("LOCAL_SD_TILE_THRESHOLD_PX", str(1536 * 1536)))
+REFINE_DENOISE = float(os.getenv("LOCAL_SD_TILE_DENOISE", "0.3"))
+
+def hosts(primary: str) -> list[str]:
+    """The main WebUI first, then any extra instances from LOCAL_SD_HOSTS."""
+    extra = [h.strip().rstrip("/") for h in os.getenv("LOCAL_SD_HOSTS", "").split(",") if h.strip()]
+    return [primary] + [h for h in extra if h != primary]
+
+def base_size(w: int, h: int, max_px: int = BASE_MAX_PX) -> tuple[int, int]:
+    """Largest 64-multiple size with the target's aspect and at most max_px pixels."""
+    scale = min(1.0, (max_px / (w * h)) ** 0.5)
+    return max(64, int(w * scale) // 64 * 64), max(64, int(h * scale) // 64 * 64)
+
+def tile_grid(length: int, tile: int, overlap: int) -> list[int]:
+    """Start offsets along one axis; the last tile is aligned to the far edge."""
+    if length <= tile:
+        return [0]
+    stride = max(8, tile - overlap)
+    starts = list(range(0, length - tile, stride))
+    return starts + [length - tile]
+
+def _feather_mask(w: int, h: int, left: int, top: int) -> Image.Image:
+    """Alpha mask: 0→255 ramps over `left` / `top` pixels, opaque elsewhere."""
+    col = [min(255, 255 * (x + 1) // (left + 1)) if left else 255 for x in range(w)]
+    row = [min(255, 255 * (y + 1) // (top + 1)) if top else 255 for y in range(h)]
+    mx = Image.new("L", (w, 1))
+    mx.putdata(col)
+    my = Image.new("L", (1, h))
+    my.putdata(row)
+    return ImageChops.multiply(mx.resize((w, h)), my.resize((w, h)))
+
+def _b64_png(img: Image.Image) -> str:
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return base64.b64encode(buf.getvalue()).decode()
+
+def _decode(b64: str) -> Image.Image:
+    return Image.open(io.BytesIO(base64.b64decode(b64.split(",", 1)[-1]))).convert("RGB")
+
+def _sync_checkpoint(host: str, checkpoint: str | None):
+    """Switch `host` to `checkpoint` unless it already has it loaded (asked every run)."""
+    if not checkpoint:
+        return
+    current = requests.get(f"{host}/sdapi/v1/options", timeout=10).json().get("sd_model_checkpoint")
+    if _ckpt_key(current) == _ckpt_key(checkpoint):
+        return
+    requests.post(f"{host}/sdapi/v1/options", json={"sd_model_checkpoint": checkpoint},
+                  timeout=600).raise_for_status()
+
+def generate_tiled(
+    prompt: str,
+    width: int,
+    height: int,
+    *,
+    params: dict,
+    host: str,
+    n: int = 1,
+    negative_prompt: str = "",
+    seed: int | None = None,
+    checkpoint: str | None = None,
+    tile: int = TILE,
+    overlap: int = OVERLAP,
+    denoising_strength: float = REFINE_DENOISE,
+    should_stop=None,
+    first_pass: tuple[int, int] | None = None,
+) -> list[str]:
+    """
+    Render `n` images of width×height via base txt2img + tiled img2img.
+    `params` are local_sd.effective_params() (steps / sampler / cfg);
+    the hires options are not used. Returns PNG paths under ./outputs/.
+    Once should_stop() is True no further tile starts (local_sd.Interrupted).
+    first_pass=(w, h): the base is the hires first pass at that size (same
+    composition as the untiled render with this seed) and the tiles use
+    hr_second_pass_steps.
+    """
+    pool_hosts = hosts(host)
+    for h in pool_hosts[1:]:
+        _sync_checkpoint(h, checkpoint)
+    bw, bh = first_pass or base_size(width, height)
+    common = {"prompt": prompt, "negative_prompt": negative_prompt,
+              "steps": params.get("steps"), "sampler_name": params.get("sampler_name"),
+              "cfg_scale": params.get("cfg_scale"), "save_images": False}
+    tile_steps = (params.get("hr_second_pass_steps") if first_pass else None) or common["steps"]
+    with tracing.span("local_sd.tiled_base", width=bw, height=bh, n=n):
+        r = requests.post(f"{host}/sdapi/v1/txt2img",
+                          json={**common, "width": bw, "height": bh, "batch_size": n,
+                                "n_iter": 1, "seed": seed if seed is not None else -1},
+                          timeout=600)
+        r.raise_for_status()
+        bases = r.json()["images"][:n]
+
+    tw, th = min(tile, width) // 8 * 8, min(tile, height) // 8 * 8
+    boxes = [(x, y) for y in tile_grid(height, th, overlap) for x in tile_grid(width, tw, overlap)]
+    free = list(pool_hosts)
+    free_cv = threading.Condition()
+
+    def refine(canvas: Image.Image, idx: int, x: int, y: int) -> Image.Image:
+        with free_cv:
+            free_cv.wait_for(lambda: free)
+            h = free.pop(0)
+        try:
+            if should_stop is not None and should_stop():
+                from local_sd import Interrupted        # local_sd imports this module
+                raise Interrupted("tiled render stopped")
+            crop = canvas.crop((x, y, x + tw, y + th))
+            with tracing.span("local_sd.tile_img2img", x=x, y=y, host=h):
+                r = requests.post(f"{h}/sdapi/v1/img2img", timeout=600, json={
+                    **common, "steps": tile_steps, "init_images": [_b64_png(crop)],
+                    "width": tw, "height": th,
+                    "denoising_strength": denoising_strength, "batch_size": 1,
+                    "seed": seed + idx if seed not in (None, -1) else -1})
+                r.raise_for_status()
+            return _decode(r.json()["images"][0]).resize((tw, th))
+        finally:
+            with free_cv:
+                free.append(h)
+                free_cv.notify()
+
+    out_dir = Path("outputs")
+    out_dir.mkdir(exist_ok=True)
+    ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    paths = []
+    with ThreadPoolExecutor(max_workers=len(pool_hosts), thread_name_prefix="sd-tile") as ex:
+        for i, b64 in enumerate(bases):
+            with tracing.span("local_sd.tiled_upscale", width=width, height=height):
+                canvas = _decode(b64).resize((width, height), Image.LANCZOS)
+            source = canvas.copy()          # tiles read the plain upscale, paste onto canvas
+            todo = iter(enumerate(boxes))
+            window = collections.deque()    # one outstanding tile per instance
+
+            def submit_next():
+                item = next(todo, None)
+                if item is not None:
+                    k, (x, y) = item
+                    window.append(ex.submit(tracing.bind(refine), source, k, x, y))
+
+            for _ in pool_hosts:
+                submit_next()
+            # raster-order paste: each tile blends into its left / top neighbours
+            for x, y in boxes:
+                tile_img = window.popleft().result()
+                submit_next()
+                left = overlap if x > 0 else 0
+                top = overlap if y > 0 else 0
+                canvas.paste(tile_img, (x, y), _feather_mask(tw, th, min(left, tw), min(top, th)))
+                del tile_img
+            del source
+            p = out_dir / f"local_{ts}_{i}.png"
+            with tracing.span("local_sd.write_png", tiled=True):
+                canvas.save(p, format="PNG")
+            paths.append(str(p.resolve()))
+    return paths
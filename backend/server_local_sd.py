@@ -2,20 +2,16 @@
 """
 Automatically detect GPU and launch Automatic1111 WebUI (with --api).
 
-• GPU detected  → add --xformers + half precision for extra speed  
-• No GPU       → start in CPU-only mode (--precision full --no-half --skip-torch-cuda-test)
+Flags come from sd_launcher's cached hardware probe (nvidia-smi, no torch import):
+• GPU detected  → --xformers (+ --medvram / --lowvram by VRAM)
+• No GPU       → CPU-only mode (--use-cpu all --precision full --no-half --skip-torch-cuda-test)
 
 Usage:
-    python serve_local_sd.py [--port 7860] [--model-path /path/to/model.safetensors]
+    python server_local_sd.py [--port 7860] [--model-path /path/to/model.safetensors]
 """
 
-import argparse, shutil, subprocess, sys, os, pathlib, time
-import torch, requests
-
-ROOT = pathlib.Path(__file__).resolve().parent / "stable-diffusion-webui"
-
-def detect_cuda() -> bool:
-    return torch.cuda.is_available() and shutil.which("nvidia-smi") is not None
+import argparse, sys
+import sd_launcher
 
 def main():
     ap = argparse.ArgumentParser()
@@ -23,38 +19,28 @@ def main():
     ap.add_argument("--model-path", default="")
     args = ap.parse_args()
 
-    if not ROOT.exists():
+    if not sd_launcher.ROOT.exists():
         print("Cannot find 'stable-diffusion-webui' directory; please git clone it first.")
         sys.exit(1)
 
-    cmd = [sys.executable, "launch.py", "--api", "--listen", "--port", args.port]
-
-    if detect_cuda():
-        print("✅ GPU detected (CUDA available). Launching with xformers + half precision …")
-        cmd += ["--xformers", "--medvram"]
+    hw = sd_launcher.probe()
+    if hw["gpu"]:
+        print(f"✅ GPU detected ({hw['gpu']['name']}, {hw['gpu']['vram_mb']} MB). Launching with xformers …")
     else:
-        print("⚠️ No GPU detected, running in CPU‑only mode (this will be slower) …")
-        cmd += ["--precision", "full", "--no-half", "--skip-torch-cuda-test"]
-
-    # add checkpoint path if provided
-    if args.model_path:
-        cmd += ["--ckpt", args.model_path]
+        print(f"⚠️ No GPU detected, running in CPU‑only mode on {hw['physical_cores']} cores (this will be slower) …")
 
     # start WebUI
+    cmd = sd_launcher.build_command(int(args.port), args.model_path or None)
     print("▶ Launch command:", " ".join(cmd))
-    subprocess.Popen(cmd, cwd=ROOT)
+    print("▶ Log:", sd_launcher.LOG_PATH)
+    proc = sd_launcher.launch(int(args.port), args.model_path or None)
 
-    # simple heartbeat check
     host = f"http://127.0.0.1:{args.port}"
-    for _ in range(30):
-        try:
-            requests.get(f"{host}/sdapi/v1/sd-models", timeout=3)
-            print(f"🚀 WebUI is ready at {host}")
-            break
-        except requests.exceptions.RequestException:
-            time.sleep(2)
-    else:
-        print("⏰ WebUI startup timed out; please check the log window.")
+    try:
+        sd_launcher.wait_ready(proc, host, timeout=300)
+    except (TimeoutError, RuntimeError) as e:
+        print("⏰ WebUI startup failed:", e)
+        sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,113 @@
+# -----------------------------------------------
+# singleflight.py  ——  coalesce identical in-flight calls
+# -----------------------------------------------
+"""
+    result = singleflight.run(key, fn, cancel=interrupt)
+
+The first caller for `key` starts fn() on its own thread; callers that
+arrive with the same key while it runs attach to it and get the same
+result (or exception). Each caller holds a reference; a caller leaves
+when its cancel scope fires:
+
+    with singleflight.cancel_scope(job.on_cancel):   # job cancelled → leave
+        generate_image_from_prompt(...)
+
+When the last caller has left, `cancel()` runs (e.g. the WebUI interrupt)
+and the key is released, so a later identical request starts afresh.
+"""
+
+import threading
+import contextlib, contextvars
+import tracing
+
+class Cancelled(Exception):
+    """This caller left the flight (its job was cancelled)."""
+
+class _Flight:
+    def __init__(self, key: str, cancel):
+        self.key = key
+        self.cancel = cancel
+        self.waiters = 0
+        self.done = False
+        self.abandoned = False
+        self.result = None
+        self.error: BaseException | None = None
+        self.cv = threading.Condition(_lock)
+
+_lock = threading.RLock()
+_flights: dict[str, _Flight] = {}
+_scope: contextvars.ContextVar = contextvars.ContextVar("singleflight_scope", default=None)
+stats = {"started": 0, "coalesced": 0, "cancelled": 0}
+
+@contextlib.contextmanager
+def cancel_scope(register):
+    """register(fn) arranges for fn() to run when the caller gives up (e.g. Job.on_cancel)."""
+    token = _scope.set(register)
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+def _leave(flight: _Flight, ticket: dict):
+    with _lock:
+        if ticket["left"]:
+            return
+        ticket["left"] = True
+        flight.waiters -= 1
+        fire = flight.waiters == 0 and not flight.done and not flight.abandoned
+        if fire:
+            flight.abandoned = True
+            stats["cancelled"] += 1
+            if _flights.get(flight.key) is flight:
+                del _flights[flight.key]
+        flight.cv.notify_all()
+    if fire and flight.cancel is not None:
+        try:
+            flight.cancel()
+        except Exception:
+            pass
+
+def _execute(flight: _Flight, fn):
+    try:
+        result, error = fn(), None
+    except BaseException as e:
+        result, error = None, e
+    with _lock:
+        flight.result, flight.error, flight.done = result, error, True
+        if _flights.get(flight.key) is flight:
+            del _flights[flight.key]
+        flight.cv.notify_all()
+
+def run(key: str, fn, *, cancel=None):
+    """fn() once per concurrent `key`; every caller gets its outcome."""
+    with _lock:
+        flight = _flights.get(key)
+        if flight is None:
+            flight = _flights[key] = _Flight(key, cancel)
+            stats["started"] += 1
+            leader = True
+        else:
+            stats["coalesced"] += 1
+            leader = False
+        flight.waiters += 1
+    ticket = {"left": False}
+    register = _scope.get()
+    if register is not None:
+        register(lambda: _leave(flight, ticket))
+    if leader:
+        threading.Thread(target=tracing.bind(_execute), args=(flight, fn),
+                         name="singleflight", daemon=True).start()
+    with tracing.span("singleflight.wait", leader=leader):
+        with _lock:
+            flight.cv.wait_for(lambda: flight.done or ticket["left"])
+            if ticket["left"] and not flight.done:
+                raise Cancelled(key)
+    _leave(flight, ticket)
+    if flight.error is not None:
+        raise flight.error
+    # callers must not see each other's mutations of a shared list
+    return list(flight.result) if isinstance(flight.result, list) else flight.result
+
+def in_flight() -> int:
+    with _lock:
+        return len(_flights)
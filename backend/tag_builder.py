@@ -0,0 +1,137 @@
+# -----------------------------------------------
+# tag_builder.py  ——  offline prompt builder for tag-style input
+# -----------------------------------------------
+"""
+Zero-network counterpart of label.extract_tags_*.
+
+Input that is already a comma-separated tag list ("1girl, silver hair,
+classroom") does not need an LLM: every tag is classified against a small
+local vocabulary and the result is assembled into the same structure the
+LLM providers return:
+
+    {
+      "sd_prompt": "(masterpiece:1.3), (best quality:1.2), 1girl, ...",
+      "keywords": {"main_body": [...], "background": [...], "foreground": [...]}
+    }
+
+Assembly order follows the LLM system prompt:
+[quality] + [subject] + [background] + [effects] + [style].
+"""
+
+import re
+
+# ---------- vocabulary ----------
+_QUALITY = {
+    "masterpiece", "best quality", "high quality", "highres", "absurdres",
+    "ultra detailed", "ultra-detailed", "extremely detailed", "high detail",
+    "highly detailed", "detailed", "sharp focus", "8k", "4k", "uhd", "hdr",
+    "official art", "award winning", "amazing quality", "very aesthetic",
+}
+_STYLE_WORDS = {
+    "anime", "illustration", "manga", "photo", "photograph", "photorealistic",
+    "realistic", "cinematic", "painting", "watercolor", "watercolour", "sketch",
+    "lineart", "cel", "3d", "render", "octane", "unreal", "pixel", "chibi",
+    "artstation", "concept", "comic", "ukiyo-e", "impressionism", "style",
+    "bokeh", "depth",
+}
+_FOREGROUND_WORDS = {
+    "particles", "particle", "petals", "petal", "sparkles", "sparkle", "glitter",
+    "fireflies", "firefly", "bubbles", "bubble", "rain", "raindrops", "snow",
+    "snowflakes", "smoke", "fog", "mist", "flames", "fire", "embers", "sparks",
+    "lightning", "magic", "glyphs", "runes", "aura", "glow", "glowing",
+    "lens flare", "light rays", "confetti", "feathers", "leaves", "dust",
+    "butterflies", "butterfly",
+}
+_BACKGROUND_WORDS = {
+    "background", "scenery", "landscape", "indoors", "outdoors", "interior",
+    "classroom", "room", "bedroom", "kitchen", "library", "cafe", "office",
+    "street", "city", "cityscape", "skyline", "town", "village", "alley",
+    "forest", "woods", "jungle", "meadow", "field", "garden", "park", "beach",
+    "ocean", "sea", "lake", "river", "stream", "waterfall", "mountain",
+    "mountains", "desert", "cave", "castle", "temple", "shrine", "ruins",
+    "bridge", "stage", "spaceship", "space", "sky", "clouds", "cloud", "moon",
+    "stars", "night", "sunset", "sunrise", "dawn", "dusk", "twilight", "day",
+    "sunlight", "moonlight", "lighting", "light", "shadows", "window",
+    "curtain", "wall", "floor", "grass", "flowers", "tree", "trees", "snowy",
+    "rainy", "weather", "autumn", "winter", "spring", "summer",
+}
+# subject actions win over any scene word they mention ("sitting on classroom chair")
+_POSE_WORDS = {
+    "sitting", "standing", "kneeling", "lying", "walking", "running", "jumping",
+    "holding", "touching", "wearing", "looking", "reaching", "leaning",
+    "smiling", "crying", "dancing", "playing", "reading", "flying",
+}
+_SUBJECT_RE = re.compile(r"^\d+(girl|boy|girls|boys|other|others)s?$")
+
+_DEFAULT_QUALITY = ["(masterpiece:1.3)", "(best quality:1.2)"]
+
+# ---------- tag-style detection ----------
+_SENTENCE_RE = re.compile(r"[.!?;:](\s|$)")          # ":" inside "(x:1.2)" is followed by a digit
+_STOPWORDS = {"a", "an", "the", "is", "are", "was", "who", "which", "that",
+              "i", "me", "my", "want", "please", "draw", "make", "picture", "image"}
+_MAX_WORDS_PER_TAG = 5
+
+def _split(text: str) -> list[str]:
+    return [s.strip() for s in re.split(r"[,\n]", text) if s.strip()]
+
+def _bare(tag: str) -> str:
+    """Strip A1111 weighting: "(silver hair:1.2)" → "silver hair"."""
+    t = tag.strip().strip("()[]{}")
+    t = re.sub(r":\s*[\d.]+$", "", t)
+    return t.strip().strip("()[]{}").replace("_", " ").lower()
+
+def looks_like_tags(text: str) -> bool:
+    """True if `text` is a comma-separated tag list rather than prose."""
+    tags = _split(text)
+    if len(tags) < 2 or _SENTENCE_RE.search(text):
+        return False
+    for t in tags:
+        words = _bare(t).split()
+        if len(words) > _MAX_WORDS_PER_TAG:
+            return False
+        if any(w in _STOPWORDS for w in words):
+            return False
+    return True
+
+# ---------- classification ----------
+def _classify(bare: str) -> str:
+    """Return one of quality / style / foreground / background / main_body."""
+    if bare in _QUALITY:
+        return "quality"
+    if _SUBJECT_RE.match(bare):
+        return "main_body"
+    words = set(bare.split())
+    if bare in _FOREGROUND_WORDS or words & _FOREGROUND_WORDS:
+        return "foreground"
+    if words & _STYLE_WORDS:
+        return "style"
+    if words & _POSE_WORDS:
+        return "main_body"
+    if bare in _BACKGROUND_WORDS or words & _BACKGROUND_WORDS:
+        return "background"
+    return "main_body"
+
+def extract_tags_local(user_input: str) -> dict:
+    """
+    Build {"sd_prompt", "keywords"} from tag-style input without any network
+    call. Prose input is still accepted (each comma-separated chunk becomes a
+    main-body tag), but callers should prefer an LLM for it.
+    """
+    groups = {"quality": [], "main_body": [], "background": [],
+              "foreground": [], "style": []}
+    keywords = {"main_body": [], "background": [], "foreground": []}
+    seen = set()
+    for tag in _split(user_input):
+        bare = _bare(tag)
+        if not bare or bare in seen:
+            continue
+        seen.add(bare)
+        kind = _classify(bare)
+        groups[kind].append(tag)
+        if kind in keywords:
+            keywords[kind].append(bare)
+
+    quality = groups["quality"] or _DEFAULT_QUALITY
+    parts = (quality + groups["main_body"] + groups["background"]
+             + groups["foreground"] + groups["style"])
+    return {"sd_prompt": ", ".join(parts), "keywords": keywords}
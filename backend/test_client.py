@@ -3,7 +3,7 @@ Tiny local tester for the Easy-Artistry API.
 
 Usage:
   1) Start the server in another terminal:
-        (easy_art) > python API.py
+        (easy_art) > python api_server.py
   2) Run this script:
         (easy_art) > python test_client.py
 """
@@ -0,0 +1,170 @@
+# -----------------------------------------------
+# tracing.py  ——  sampled span tracing in Chrome trace-event format
+# -----------------------------------------------
+"""
+    with tracing.trace("rpc", method=m):          # root: sampling decision
+        with tracing.span("protocol.parse"):
+            ...
+        with tracing.span("local_sd.txt2img_http", steps=28):
+            ...
+
+A root trace is sampled with probability EA_TRACE_SAMPLE (0 = off, the
+default; 1 = every request). Inside an unsampled trace, or outside any
+trace, span() is a no-op, so instrumentation can stay in hot paths.
+Passing trace_id makes the decision deterministic per id — every stage of
+one pipeline job lands in the same sample.
+
+Finished sampled traces are appended to
+    <EA_TRACE_DIR>/trace-<pid>.json          (default outputs/traces)
+in the Chrome trace-event array format; open it in chrome://tracing or
+https://ui.perfetto.dev. A file passing EA_TRACE_MAX_MB is rotated to
+.1, .2, … keeping EA_TRACE_KEEP files.
+
+Spans in worker threads join the caller's trace when the callable is
+wrapped with tracing.bind(fn) before being handed to a pool (which also
+carries the caller's rate_limit priority).
+"""
+
+import os, json, time, random, zlib, threading, contextlib, contextvars
+from pathlib import Path
+
+SAMPLE_RATE = float(os.getenv("EA_TRACE_SAMPLE", "0"))
+TRACE_DIR = Path(os.getenv("EA_TRACE_DIR", Path(__file__).resolve().parents[1] / "outputs" / "traces"))
+MAX_BYTES = int(float(os.getenv("EA_TRACE_MAX_MB", "16")) * 1024 * 1024)
+KEEP = int(os.getenv("EA_TRACE_KEEP", "5"))
+
+class _Trace:
+    __slots__ = ("id", "events")
+
+    def __init__(self, trace_id: str):
+        self.id = trace_id
+        self.events: list[dict] = []
+
+_current: contextvars.ContextVar = contextvars.ContextVar("ea_trace", default=None)
+_write_lock = threading.Lock()
+
+def _now_us() -> float:
+    return time.perf_counter_ns() / 1000.0
+
+def _sampled(trace_id: str | None) -> bool:
+    if SAMPLE_RATE <= 0:
+        return False
+    if SAMPLE_RATE >= 1:
+        return True
+    if trace_id is None:
+        return random.random() < SAMPLE_RATE
+    return (zlib.crc32(str(trace_id).encode()) % 10000) < SAMPLE_RATE * 10000
+
+def enabled() -> bool:
+    """True inside a sampled trace (use to skip building expensive span args)."""
+    return _current.get() is not None
+
+@contextlib.contextmanager
+def span(name: str, cat: str = "ea", **args):
+    """Record `name` as a complete event in the active trace (no-op if none)."""
+    tr = _current.get()
+    if tr is None:
+        yield args
+        return
+    start = _now_us()
+    try:
+        yield args                          # callers may add args while the span runs
+    except BaseException as e:
+        args["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        tr.events.append({"name": name, "cat": cat, "ph": "X", "ts": start,
+                          "dur": _now_us() - start, "pid": os.getpid(),
+                          "tid": threading.get_native_id(),
+                          "args": {"trace": tr.id, **args}})
+
+def record(name: str, start: float, dur_s: float, cat: str = "ea", pid: int | None = None,
+           **args):
+    """Add a span timed elsewhere, e.g. in a pool process: `start` is its
+    time.time() (the only clock shared across processes), `pid` the process
+    it ran in. No-op outside a sampled trace."""
+    tr = _current.get()
+    if tr is None:
+        return
+    tr.events.append({"name": name, "cat": cat, "ph": "X",
+                      "ts": _now_us() - (time.time() - start) * 1e6, "dur": dur_s * 1e6,
+                      "pid": pid or os.getpid(), "tid": pid or threading.get_native_id(),
+                      "args": {"trace": tr.id, **args}})
+
+@contextlib.contextmanager
+def trace(name: str, trace_id: str | None = None, **args):
+    """Root span: decides sampling and writes the trace when it ends.
+    Nested inside an active trace it behaves like span()."""
+    if _current.get() is not None:
+        with span(name, **args) as a:
+            yield a
+        return
+    if not _sampled(trace_id):
+        yield args
+        return
+    tr = _Trace(str(trace_id) if trace_id is not None else f"{random.getrandbits(48):012x}")
+    token = _current.set(tr)
+    try:
+        with span(name, **args) as a:
+            yield a
+    finally:
+        _current.reset(token)
+        _write(tr.events)
+
+def bind(fn):
+    """
+    Run fn in the caller's context when executed on another thread: its
+    trace, and every other ContextVar (e.g. rate_limit.priority).
+
+    The caller's context is captured here; each call runs in its own copy
+    of it, so one bound fn may run on several threads at once (pool.map).
+    """
+    ctx = contextvars.copy_context()
+    return lambda *a, **kw: ctx.copy().run(fn, *a, **kw)
+
+def traced(name: str | None = None):
+    """Decorator form of span()."""
+    def deco(fn):
+        label = name or fn.__qualname__
+        def wrapper(*a, **kw):
+            with span(label):
+                return fn(*a, **kw)
+        wrapper.__name__, wrapper.__doc__, wrapper.__wrapped__ = fn.__name__, fn.__doc__, fn
+        return wrapper
+    return deco
+
+# ---------- rolling trace file ----------
+def _path() -> Path:
+    return TRACE_DIR / f"trace-{os.getpid()}.json"
+
+def _rotate(path: Path):
+    for i in range(KEEP - 1, 0, -1):
+        src = path.with_name(f"{path.name}.{i}")
+        if src.exists():
+            if i + 1 >= KEEP:
+                src.unlink()
+            else:
+                os.replace(src, path.with_name(f"{path.name}.{i + 1}"))
+    if KEEP > 1:
+        os.replace(path, path.with_name(f"{path.name}.1"))
+    else:
+        path.unlink()
+
+def _write(events: list[dict]):
+    if not events:
+        return
+    # chrome://tracing accepts an array without the closing "]", so each
+    # trace is appended as ",\n"-separated objects after a leading "[".
+    body = ",\n".join(json.dumps(e, default=str) for e in events)
+    path = _path()
+    with _write_lock:
+        try:
+            TRACE_DIR.mkdir(parents=True, exist_ok=True)
+            size = path.stat().st_size if path.exists() else 0
+            if size and size > MAX_BYTES:
+                _rotate(path)
+                size = 0
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(("[\n" if size == 0 else ",\n") + body)
+        except OSError:
+            pass
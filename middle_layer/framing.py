@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# middle_layer/framing.py
+# Wire codecs for worker.py. JSON-Lines is the default (EaClient speaks it);
+# a client may switch to length-prefixed msgpack frames with the handshake
+#
+#   -> {"id": 1, "method": "protocol.negotiate", "params": {"framing": "msgpack"}}
+#   <- {"id": 1, "result": {"framing": "msgpack", "available": ["jsonl", "msgpack"]}}
+#
+# The reply is still a JSON line; the client sends nothing else until it has
+# read it. Every message after it, in both directions, is a frame:
+# 4-byte big-endian payload length, then one msgpack map.
+# bytes values (previews, thumbnails) travel as msgpack bin, i.e. raw. In
+# JSON-Lines mode the same values are sent base64-encoded.
+# If msgpack is not installed, "available" lacks it and the framing stays jsonl.
+
+import json, base64
+
+try:
+    import msgpack                      # optional: pip install msgpack
+except ImportError:
+    msgpack = None
+
+MAX_FRAME = 256 * 1024 * 1024           # refuse absurd lengths from a desynced stream
+
+class ProtocolError(Exception):
+    """The input stream is not valid for the active framing."""
+
+def _read_exact(stream, n: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = stream.read(n - len(buf))
+        if not chunk:
+            raise ProtocolError(f"stream closed mid-frame ({len(buf)}/{n} bytes)")
+        buf += chunk
+    return bytes(buf)
+
+def _json_default(obj):
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return base64.b64encode(bytes(obj)).decode("ascii")
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class JsonLines:
+    """Text lines on the stdio text streams, exactly as before negotiation."""
+    name = "jsonl"
+
+    def read(self, stdin) -> str | None:
+        """Next non-blank line, or None at EOF."""
+        while True:
+            line = stdin.readline()
+            if not line:
+                return None
+            if line.strip():
+                return line
+
+    def decode(self, raw: str) -> dict:
+        return json.loads(raw)
+
+    def write(self, stdout, obj: dict):
+        stdout.write(json.dumps(obj, ensure_ascii=False, default=_json_default) + "\n")
+        stdout.flush()
+
+
+class MsgpackFrames:
+    """Length-prefixed msgpack on the underlying binary buffers."""
+    name = "msgpack"
+
+    def read(self, stdin) -> bytes | None:
+        stream = stdin.buffer
+        header = stream.read(4)
+        if not header:
+            return None
+        if len(header) < 4:
+            header += _read_exact(stream, 4 - len(header))
+        size = int.from_bytes(header, "big")
+        if size > MAX_FRAME:
+            raise ProtocolError(f"frame of {size} bytes exceeds MAX_FRAME")
+        return _read_exact(stream, size)
+
+    def decode(self, raw: bytes) -> dict:
+        return msgpack.unpackb(raw, raw=False)
+
+    def write(self, stdout, obj: dict):
+        body = msgpack.packb(obj, use_bin_type=True, default=str)
+        stdout.flush()                  # text written before the switch goes out first
+        stdout.buffer.write(len(body).to_bytes(4, "big") + body)
+        stdout.buffer.flush()
+
+
+CODECS = {"jsonl": JsonLines}
+if msgpack is not None:
+    CODECS["msgpack"] = MsgpackFrames
+
+def available() -> list[str]:
+    return list(CODECS)
+
+def codec(name: str):
+    return CODECS[name]()
@@ -3,7 +3,7 @@
 # A native Worker for the JSON-Lines (one JSON per line) protocol.
 # This script is started by a C# subprocess; it receives requests from stdin and sends responses to stdout.
 
-import sys, os, json, traceback, contextlib
+import sys, os, mimetypes, traceback, contextlib, threading
 from pathlib import Path
 
 # ---------- Make Python able to import the backend directory ----------
@@ -18,12 +18,15 @@ backend_str = str(BACKEND)
 if backend_str not in sys.path:
     sys.path.insert(0, backend_str)
 
-# Always start with a fresh log for each worker process
-try:
-    LOG_PATH.write_text("", encoding="utf-8")
-except OSError:
-    # If another process still holds the file, append mode below will continue working
-    pass
+# Always start with a fresh log for each worker process. (postprocess pool
+# children re-import this file as __mp_main__; they must not truncate it.)
+_IS_WORKER = __name__ == "__main__"
+if _IS_WORKER:
+    try:
+        LOG_PATH.write_text("", encoding="utf-8")
+    except OSError:
+        # If another process still holds the file, append mode below will continue working
+        pass
 
 def _append_log(message: str) -> None:
     """Append a single line to backend.log."""
@@ -34,7 +37,8 @@ def _append_log(message: str) -> None:
             log_file.write("\n")
 
 
-_append_log("[startup] worker initializing")
+if _IS_WORKER:
+    _append_log("[startup] worker initializing")
 
 def _append_log(message: str) -> None:
     """Append a single line to backend.log."""
@@ -45,24 +49,45 @@ def _append_log(message: str) -> None:
             log_file.write("\n")
 
 
-_append_log("[startup] worker initializing")
+if _IS_WORKER:
+    _append_log("[startup] worker initializing")
 
 # ---------- Import your facade functions ----------
-try:
-    from backend.backend_main import generate_image_from_prompt
-    from backend.local_sd import start_server as _start_server
-    from backend.local_sd import shutdown_server as _shutdown_server
-    from backend.local_sd import _switch_model as _switch_model_inner
-except Exception:  # pragma: no cover - defensive logging
-    _append_log("[startup] failed to import backend modules")
-    _append_log(traceback.format_exc())
-    # Surface the failure via stderr so the host process can show it
-    sys.__stderr__.write("backend worker import failed\n")
-    sys.__stderr__.write(traceback.format_exc())
-    sys.__stderr__.flush()
-    raise
-else:
-    _append_log("[startup] backend modules loaded")
+import framing as wire                  # middle_layer/framing.py: jsonl / msgpack codecs
+
+# Only in the worker itself: postprocess pool children re-run this file as
+# __mp_main__; they need none of the backend (their tasks import postprocess),
+# so they skip these imports and the method tables below.
+if _IS_WORKER:
+    try:
+        from backend.backend_main import generate_image_from_prompt
+        from backend.backend_main import submit_chat_job, submit_prompt_job, get_job
+        from backend.backend_main import journal, resume_jobs
+        from backend.backend_main import router as backend_router
+        from backend.backend_main import cost_model
+        from backend.backend_main import explore_images, refine_image
+        from backend.backend_main import calibrate_local_threads
+        # flat imports: the same module instances backend_main / label / image use,
+        # so local_sd._proc is the WebUI process backend_main spawned
+        from local_sd import start_server as _start_server
+        from local_sd import shutdown_server as _shutdown_server
+        from local_sd import _switch_model as _switch_model_inner
+        import rate_limit
+        import local_scheduler
+        import tracing                      # EA_TRACE_SAMPLE>0 → outputs/traces/trace-<pid>.json
+        from local_sd import progress as _sd_progress
+        from sd_checkpoints import cache as _checkpoint_cache
+        from postprocess import thumbnail as _thumbnail
+    except Exception:  # pragma: no cover - defensive logging
+        _append_log("[startup] failed to import backend modules")
+        _append_log(traceback.format_exc())
+        # Surface the failure via stderr so the host process can show it
+        sys.__stderr__.write("backend worker import failed\n")
+        sys.__stderr__.write(traceback.format_exc())
+        sys.__stderr__.flush()
+        raise
+    else:
+        _append_log("[startup] backend modules loaded")
 
 REGISTRY = {}
 
@@ -71,27 +96,153 @@ def register(ns: str, table: dict):
         REGISTRY[f"{ns}.{name}"] = fn
 
 # 1) Main image generation function
-register("images", {
-    "generate": generate_image_from_prompt,
-})
+def generate_images(**params):
+    # Journaled like pipeline jobs, so a render in flight during a crash is
+    # re-run (as a background job) when the worker restarts.
+    if journal is None:
+        return generate_image_from_prompt(**params)
+    jid = f"rpc-{_current_rid or id(params)}"
+    journal.record(jid, "submitted", sync=True, kind="images.generate", params=params)
+    journal.record(jid, "started")
+    try:
+        result = generate_image_from_prompt(**params)
+    except Exception as e:
+        journal.record(jid, "failed", error=str(e))
+        raise
+    journal.record(jid, "completed", result=result)
+    return result
+
+# Raw file bytes (or a JPEG thumbnail) for previews in the UI. bytes go out
+# as-is with msgpack framing, base64 in JSON-Lines mode.
+def read_image(path: str, thumbnail_px: int | None = None):
+    p = Path(path).resolve()
+    outputs = (PROJ_ROOT / "outputs").resolve()
+    if outputs not in p.parents:
+        raise ValueError(f"Not under outputs/: {path}")
+    if thumbnail_px:
+        return {"path": str(p), "mime": "image/jpeg", "data": _thumbnail(p, int(thumbnail_px))}
+    mime = mimetypes.guess_type(p.name)[0] or "application/octet-stream"
+    return {"path": str(p), "mime": mime, "data": p.read_bytes()}
+
+if _IS_WORKER:
+    register("images", {
+        "generate": generate_images,
+        "read": read_image,                 # method: "images.read" (bytes; thumbnail_px → JPEG)
+        "explore": explore_images,          # method: "images.explore" (K cheap local drafts)
+        "refine": refine_image,             # method: "images.refine" (chosen draft at full quality)
+        "backends": backend_router.status,  # method: "images.backends" (model="auto" inputs)
+        "cost_model": cost_model.status,    # method: "images.cost_model" (predicted vs. actual render time)
+        "local_queue": local_scheduler.status,  # method: "images.local_queue" (priority classes, preemptions)
+    })
 
 # 2) Local SD server management - expose stable names to the outside
-def start_local_sd(model_path: str | None = None):
+def start_local_sd(model_path: str | None = None, threads: int | None = None,
+                   cpus: list[int] | str | None = None):
     # Idempotent, if local_sd.start_server is already running, it will return directly
-    _start_server(model_path)
+    _start_server(model_path, threads=threads, cpus=cpus)
 
 def shutdown_local_sd():
-    _shutdown_server()
+    return {"stopped": _shutdown_server()}
 
 def switch_local_model(model_name: str, timeout: int = 90):
     # Wrap it in a layer to prevent the frontend from directly depending on the internal function name `_switch_model`
     _switch_model_inner(model_name, timeout=timeout)
 
-register("local_sd", {
-    "start": start_local_sd,            # method: "local_sd.start"
-    "shutdown": shutdown_local_sd,      # method: "local_sd.shutdown"
-    "switch_model": switch_local_model, # method: "local_sd.switch_model"
-})
+if _IS_WORKER:
+    register("local_sd", {
+        "start": start_local_sd,            # method: "local_sd.start"
+        "shutdown": shutdown_local_sd,      # method: "local_sd.shutdown"
+        "switch_model": switch_local_model, # method: "local_sd.switch_model"
+        "calibrate_threads": calibrate_local_threads,  # method: "local_sd.calibrate_threads" (slow: restarts WebUI)
+        "progress": _sd_progress,           # method: "local_sd.progress" (preview as PNG bytes)
+        "checkpoints": _checkpoint_cache.status,  # method: "local_sd.checkpoints" (resident / cache limit)
+    })
+
+# 3) Cloud rate limits - queue depth / estimated wait per provider
+if _IS_WORKER:
+    register("ratelimit", {
+        "status": rate_limit.status,        # method: "ratelimit.status"
+    })
+
+# 4) Staged chat → image jobs (backend_main.pipeline); poll "jobs.events"
+def submit_job(user_input: str | None = None, prompt: str | None = None,
+               provider: str = "auto", **gen_kwargs):
+    if prompt:
+        job = submit_prompt_job(prompt, **gen_kwargs)
+    else:
+        job = submit_chat_job(user_input or "", provider, **gen_kwargs)
+    return {"job_id": job.id}
+
+def _job(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        raise ValueError(f"Unknown job: {job_id}")
+    return job
+
+def job_events(job_id: str, cursor: int = 0, wait: float = 0.0):
+    # Never blocks: the request loop is single-threaded, so a long-poll here
+    # would hold up every other call (jobs.cancel included). `wait` is
+    # accepted for compatibility and ignored; poll again, or long-poll the
+    # HTTP server (api_server.py) instead.
+    job = _job(job_id)
+    events = job.events_since(cursor)
+    return {"events": events, "cursor": cursor + len(events), "done": job.done}
+
+def job_status(job_id: str):
+    return _job(job_id).snapshot()
+
+def cancel_job(job_id: str):
+    _job(job_id).cancel()
+    return {"job_id": job_id, "cancelled": True}
+
+if _IS_WORKER:
+    register("jobs", {
+        "submit": submit_job,               # method: "jobs.submit"
+        "events": job_events,               # method: "jobs.events"
+        "status": job_status,               # method: "jobs.status"
+        "cancel": cancel_job,               # method: "jobs.cancel"
+    })
+
+# ---------- Output channel ----------
+# Responses carry "id"; notifications carry "event" and no "id", so EaClient
+# (which only resolves lines with a pending id) skips them safely.
+# _codec is JSON-Lines until a client negotiates another framing.
+_out_lock = threading.Lock()
+_current_rid = None
+_codec = wire.codec("jsonl")
+_pending_codec: str | None = None      # applied right after the negotiate reply
+
+def _emit(obj: dict, *, switch_to: str | None = None):
+    global _codec
+    with _out_lock:
+        _codec.write(sys.__stdout__, obj)
+        if switch_to:
+            _codec = wire.codec(switch_to)
+
+def negotiate(framing: str = "jsonl"):
+    global _pending_codec
+    if framing in wire.CODECS and framing != _codec.name:
+        _pending_codec = framing
+    chosen = _pending_codec or _codec.name
+    return {"framing": chosen, "available": wire.available()}
+
+if _IS_WORKER:
+    register("protocol", {
+        "negotiate": negotiate,             # method: "protocol.negotiate" (see framing.py)
+    })
+
+def _on_rate_limit_wait(info: dict):
+    _emit({"event": "ratelimit.wait", "request_id": _current_rid, **info})
+
+if _IS_WORKER:
+    rate_limit.add_wait_listener(_on_rate_limit_wait)
+
+def _error_payload(exc: BaseException) -> dict:
+    if isinstance(exc, rate_limit.RateLimitExceeded):
+        return {"code": "E_RATE_LIMIT", "message": str(exc),
+                "provider": exc.provider, "retry_after": exc.retry_after,
+                "trace": traceback.format_exc()}
+    return {"code": "E_RUNTIME", "message": "backend error", "trace": traceback.format_exc()}
 
 def dispatch(method: str, params: dict):
     fn = REGISTRY.get(method)
@@ -125,40 +276,54 @@ def redirect_print_to_log():
         sys.stdout = old_stdout
         log_file.close()
 
-def handle_one(line: str):
-    req = json.loads(line)
-    rid = req.get("id")
-    method = req.get("method")
-    _append_log(f"[request] id={rid} method={method}")
-    try:
-        with redirect_print_to_log():
-            result = dispatch(req.get("method"), req.get("params") or {})
-        out = {"id": rid, "result": result}
-        _append_log(f"[response] id={rid} method={method} status=ok")
-    except Exception:
-        _append_log(f"[error] id={rid} method={method} dispatch failed")
-        _append_log(traceback.format_exc())
-        out = {
-            "id": rid,
-            "error": {
-                "code": "E_RUNTIME",
-                "message": "backend error",
-                "trace": traceback.format_exc()
+def handle_one(raw: str | bytes):
+    global _current_rid, _pending_codec
+    with tracing.trace("rpc") as trace_args:
+        with tracing.span("protocol.parse", bytes=len(raw), framing=_codec.name):
+            req = _codec.decode(raw)
+        rid = req.get("id")
+        _current_rid = rid
+        method = req.get("method")
+        trace_args.update(id=rid, method=method)
+        _append_log(f"[request] id={rid} method={method}")
+        try:
+            with redirect_print_to_log(), tracing.span("dispatch", method=method):
+                result = dispatch(req.get("method"), req.get("params") or {})
+            out = {"id": rid, "result": result}
+            _append_log(f"[response] id={rid} method={method} status=ok")
+        except Exception as exc:
+            _append_log(f"[error] id={rid} method={method} dispatch failed")
+            _append_log(traceback.format_exc())
+            out = {
+                "id": rid,
+                "error": _error_payload(exc)
             }
-        }
-    sys.__stdout__.write(json.dumps(out, ensure_ascii=False) + "\n")
-    sys.__stdout__.flush()
+        switch_to, _pending_codec = _pending_codec, None
+        with tracing.span("protocol.write"):
+            _emit(out, switch_to=switch_to)
 
 def main():
     # -u/unbuffered is handled by the C# process; here we also ensure line-by-line processing.
+    try:
+        resumed = resume_jobs()
+        if resumed:
+            _append_log(f"[startup] resumed {len(resumed)} unfinished job(s) from the journal")
+    except Exception:
+        _append_log("[startup] journal resume failed")
+        _append_log(traceback.format_exc())
     _append_log("[startup] worker entering request loop")
-    while True:
-        line = sys.stdin.readline()
-        if not line:
-            break
-        if not line.strip():
-            continue
-        handle_one(line)
+    # Job stages print from background threads between requests, so stdout stays
+    # pointed at backend.log for the whole loop; protocol lines use sys.__stdout__.
+    with redirect_print_to_log():
+        while True:
+            try:
+                raw = _codec.read(sys.stdin)
+            except wire.ProtocolError as exc:
+                _append_log(f"[protocol] {exc}; exiting")
+                break
+            if raw is None:
+                break
+            handle_one(raw)
 
 if __name__ == "__main__":
     main()